@@ -0,0 +1,118 @@
+from app.database import (User, UserSubscription, UserSubscriptionArchive, ScheduledNotification, SubscriptionInvite,
+                          SubscriptionPlan, PlanChannel, ChannelMember)
+from app.membership import LEFT_STATUSES
+from app.migrations import telegram_id_column
+from datetime import datetime, timedelta
+from sqlalchemy import select, insert, delete, union_all, literal, exists, or_
+import logging
+import os
+
+# Сколько дней истекшая подписка остается в user_subscriptions: за это время force_cleanup_expired
+# много раз проверяет, что пользователя нет в канале. В архив попадают только подписки
+# с подтвержденным выходом из каналов (archivable_condition)
+ARCHIVE_RETENTION_DAYS = int(os.getenv('ARCHIVE_RETENTION_DAYS', '90'))
+# Строк за одну транзакцию: блокировки держатся недолго, горячие запросы не ждут
+ARCHIVE_BATCH_SIZE = 1000
+# Верхняя граница на один запуск задачи, остаток перенесется в следующий раз
+ARCHIVE_MAX_BATCHES = 50
+
+# Общие колонки горячей и архивной таблиц (без archived_at)
+HISTORY_COLUMNS = [column.name for column in UserSubscription.__table__.columns]
+
+
+def subscription_history(archived_flag: bool = False):
+    """
+    Вся история подписок: user_subscriptions UNION ALL user_subscriptions_archive.
+    Возвращает подзапрос с колонками user_subscriptions (и archived, если archived_flag),
+    к нему применяются обычные where/order_by.
+    """
+    hot = UserSubscription.__table__
+    cold = UserSubscriptionArchive.__table__
+    hot_columns = [hot.c[name] for name in HISTORY_COLUMNS]
+    cold_columns = [cold.c[name] for name in HISTORY_COLUMNS]
+    if archived_flag:
+        hot_columns.append(literal(False).label('archived'))
+        cold_columns.append(literal(True).label('archived'))
+    return union_all(select(*hot_columns), select(*cold_columns)).subquery('subscription_history')
+
+
+def _left_channel(channel_id):
+    """По channel_members пользователь подписки точно не в канале channel_id"""
+    return exists().where(
+        User.id == UserSubscription.user_id,
+        ChannelMember.channel_id == channel_id,
+        ChannelMember.telegram_id == telegram_id_column(User),
+        ChannelMember.status.in_(LEFT_STATUSES)
+    ).correlate_except(User, ChannelMember)
+
+
+def archivable_condition(now=None, retention_days=None):
+    """
+    Неактивные подписки, истекшие раньше окна хранения, без ожидающих уведомлений и с подтвержденным
+    выходом пользователя из всех каналов тарифа. is_active=False сам по себе выход не доказывает
+    (expire_due_subscriptions и create_subscription гасят подписки без проверки членства), поэтому
+    подписка без статуса left/kicked в channel_members остается для force_cleanup_expired.
+    """
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(days=ARCHIVE_RETENTION_DAYS if retention_days is None else retention_days)
+    pending_notification = exists().where(
+        ScheduledNotification.subscription_id == UserSubscription.id,
+        ScheduledNotification.status == 'pending'
+    )
+    # Каналы тарифа из plan_channels, у старых тарифов без них — SubscriptionPlan.channel_id
+    has_plan_channels = exists().where(PlanChannel.plan_id == UserSubscription.plan_id)
+    still_in_plan_channel = exists().where(
+        PlanChannel.plan_id == UserSubscription.plan_id, ~_left_channel(PlanChannel.channel_id)
+    )
+    left_main_channel = exists().where(
+        SubscriptionPlan.id == UserSubscription.plan_id,
+        or_(SubscriptionPlan.channel_id.is_(None), _left_channel(SubscriptionPlan.channel_id))
+    )
+    access_removed = or_(has_plan_channels & ~still_in_plan_channel, ~has_plan_channels & left_main_channel)
+    return (
+        (UserSubscription.is_active == False)
+        & (UserSubscription.end_date < cutoff)
+        & ~pending_notification
+        & access_removed
+    )
+
+
+async def archive_expired_subscriptions(session_maker, now=None, retention_days=None,
+                                        batch_size=ARCHIVE_BATCH_SIZE, max_batches=ARCHIVE_MAX_BATCHES):
+    """
+    Переносит давно истекшие подписки в user_subscriptions_archive пачками по batch_size.
+    Каждая пачка — отдельная короткая транзакция: INSERT ... SELECT в архив и DELETE из горячей
+    таблицы по тем же id. История уведомлений и ссылок таких подписок удаляется (ON DELETE CASCADE
+    делает то же самое на Postgres, здесь — явно для всех СУБД).
+    """
+    condition = archivable_condition(now, retention_days)
+    archived_at = datetime.utcnow()
+    total = 0
+    for _ in range(max_batches):
+        async with session_maker() as session:
+            result = await session.execute(
+                select(UserSubscription.id).where(condition).order_by(UserSubscription.id).limit(batch_size)
+            )
+            ids = result.scalars().all()
+            if not ids:
+                break
+
+            await session.execute(
+                insert(UserSubscriptionArchive).from_select(
+                    HISTORY_COLUMNS + ['archived_at'],
+                    select(*[UserSubscription.__table__.c[name] for name in HISTORY_COLUMNS],
+                           literal(archived_at))
+                    .where(UserSubscription.id.in_(ids))
+                )
+            )
+            await session.execute(delete(ScheduledNotification).where(ScheduledNotification.subscription_id.in_(ids)))
+            await session.execute(delete(SubscriptionInvite).where(SubscriptionInvite.subscription_id.in_(ids)))
+            await session.execute(delete(UserSubscription).where(UserSubscription.id.in_(ids)))
+            await session.commit()
+            total += len(ids)
+            if len(ids) < batch_size:
+                break
+
+    if total:
+        logging.info(f"[ARCHIVE] В архив перенесено подписок: {total}")
+    return total
@@ -0,0 +1,175 @@
+import json
+import logging
+import os
+import ssl
+import time
+
+import certifi
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, TraceConfig
+from aiohttp.hdrs import USER_AGENT
+from aiohttp.http import SERVER_SOFTWARE
+from aiogram.__meta__ import __version__ as aiogram_version
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
+
+from app.runtime_profile import RUNTIME_PROFILE, is_fast, json_codec
+
+logger = logging.getLogger(__name__)
+
+# Параметры HTTP-клиента Bot API (все можно переопределить через .env)
+TELEGRAM_API_BASE_URL = os.getenv('TELEGRAM_API_BASE_URL')
+CONNECTION_LIMIT = int(os.getenv('TELEGRAM_CONNECTION_LIMIT', '100'))
+# Почти все запросы идут на один хост api.telegram.org, поэтому лимит на хост и есть рабочий лимит
+CONNECTION_LIMIT_PER_HOST = int(os.getenv('TELEGRAM_CONNECTION_LIMIT_PER_HOST', '50'))
+KEEPALIVE_TIMEOUT = float(os.getenv('TELEGRAM_KEEPALIVE_TIMEOUT', '60'))
+CONNECT_TIMEOUT = float(os.getenv('TELEGRAM_CONNECT_TIMEOUT', '10'))
+REQUEST_TIMEOUT = float(os.getenv('TELEGRAM_REQUEST_TIMEOUT', '60'))
+DNS_CACHE_TTL = int(os.getenv('TELEGRAM_DNS_CACHE_TTL', '3600'))
+# orjson для запросов и ответов Bot API; по умолчанию включается профилем RUNTIME_PROFILE=fast
+FAST_JSON = os.getenv('TELEGRAM_FAST_JSON', str(is_fast(RUNTIME_PROFILE))).lower() in ('true', '1', 't')
+
+
+class PoolStats:
+    """Счетчики пула соединений по событиям aiohttp TraceConfig"""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.queued = 0
+        self.queued_time = 0.0
+        self.connect_time = 0.0
+
+    def trace_config(self) -> TraceConfig:
+        trace = TraceConfig()
+
+        async def on_request_start(session, ctx, params):
+            self.requests += 1
+            self.in_flight += 1
+
+        async def on_request_end(session, ctx, params):
+            self.in_flight -= 1
+
+        async def on_request_exception(session, ctx, params):
+            self.errors += 1
+            self.in_flight -= 1
+
+        async def on_queued_start(session, ctx, params):
+            ctx.queued_at = time.perf_counter()
+
+        async def on_queued_end(session, ctx, params):
+            self.queued += 1
+            self.queued_time += time.perf_counter() - ctx.queued_at
+
+        async def on_create_start(session, ctx, params):
+            ctx.connect_at = time.perf_counter()
+
+        async def on_create_end(session, ctx, params):
+            self.connections_created += 1
+            self.connect_time += time.perf_counter() - ctx.connect_at
+
+        async def on_reuseconn(session, ctx, params):
+            self.connections_reused += 1
+
+        trace.on_request_start.append(on_request_start)
+        trace.on_request_end.append(on_request_end)
+        trace.on_request_exception.append(on_request_exception)
+        trace.on_connection_queued_start.append(on_queued_start)
+        trace.on_connection_queued_end.append(on_queued_end)
+        trace.on_connection_create_start.append(on_create_start)
+        trace.on_connection_create_end.append(on_create_end)
+        trace.on_connection_reuseconn.append(on_reuseconn)
+        return trace
+
+    def as_dict(self) -> dict:
+        acquired = self.connections_created + self.connections_reused
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'in_flight': self.in_flight,
+            'connections_created': self.connections_created,
+            'connections_reused': self.connections_reused,
+            'reuse_ratio': round(self.connections_reused / acquired, 3) if acquired else 0.0,
+            'avg_connect_ms': round(self.connect_time / self.connections_created * 1000, 1) if self.connections_created else 0.0,
+            'queued': self.queued,
+            'avg_queued_ms': round(self.queued_time / self.queued * 1000, 1) if self.queued else 0.0,
+        }
+
+
+class TunedAiohttpSession(AiohttpSession):
+    """
+    AiohttpSession с настроенным пулом соединений:
+    - общий лимит и лимит на хост, keep-alive и кэш DNS у TCPConnector;
+    - отдельный таймаут на установку соединения;
+    - счетчики переиспользования соединений и ожидания свободного слота (stats()).
+    Свою ClientSession создает через публичные create_session/close, не трогая внутренние
+    поля aiogram. С прокси сессию создает aiogram (свой коннектор), настройки пула не применяются.
+    """
+
+    def __init__(self, limit: int = CONNECTION_LIMIT, limit_per_host: int = CONNECTION_LIMIT_PER_HOST,
+                 keepalive_timeout: float = KEEPALIVE_TIMEOUT, connect_timeout: float = CONNECT_TIMEOUT,
+                 dns_cache_ttl: int = DNS_CACHE_TTL, **kwargs):
+        super().__init__(limit=limit, **kwargs)
+        self.connect_timeout = connect_timeout
+        self.pool_stats = PoolStats()
+        self.connector_options = {
+            'ssl': ssl.create_default_context(cafile=certifi.where()),
+            'limit': limit,
+            'limit_per_host': limit_per_host,
+            'keepalive_timeout': keepalive_timeout,
+            'ttl_dns_cache': dns_cache_ttl,
+        }
+        self._client: ClientSession | None = None
+
+    async def create_session(self) -> ClientSession:
+        if self.proxy is not None:
+            return await super().create_session()
+        if self._client is None or self._client.closed:
+            self._client = ClientSession(
+                connector=TCPConnector(**self.connector_options),
+                headers={USER_AGENT: f"{SERVER_SOFTWARE} aiogram/{aiogram_version}"},
+                trace_configs=[self.pool_stats.trace_config()],
+            )
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None and not self._client.closed:
+            await self._client.close()
+        await super().close()
+
+    async def make_request(self, bot, method, timeout=None):
+        # aiogram передает в aiohttp число (общий таймаут), добавляем к нему таймаут соединения
+        total = self.timeout if timeout is None else timeout
+        return await super().make_request(bot, method, timeout=ClientTimeout(total=total, connect=self.connect_timeout))
+
+    def stats(self) -> dict:
+        stats = self.pool_stats.as_dict()
+        stats['limit'] = self.connector_options['limit']
+        stats['limit_per_host'] = self.connector_options['limit_per_host']
+        stats['json'] = 'orjson' if self.json_loads is not json.loads else 'json'
+        return stats
+
+
+def create_bot_session(base_url: str | None = TELEGRAM_API_BASE_URL, limit: int = CONNECTION_LIMIT,
+                       timeout: float = REQUEST_TIMEOUT, fast_json: bool = FAST_JSON, **kwargs) -> TunedAiohttpSession:
+    """
+    Сессия для Bot(...): свой сервер Bot API (локальный telegram-bot-api или
+    benchmarks/fake_bot_api.py) через base_url, orjson при fast_json и наличии пакета.
+    """
+    api = TelegramAPIServer.from_base(base_url) if base_url else PRODUCTION
+    codec, loads, dumps = json_codec(fast_json)
+    if codec != 'json':
+        kwargs.setdefault('json_loads', loads)
+        kwargs.setdefault('json_dumps', dumps)
+    session = TunedAiohttpSession(api=api, limit=limit, timeout=timeout, **kwargs)
+    logger.info(
+        f"HTTP-сессия Bot API: {base_url or 'api.telegram.org'}, limit={limit}, "
+        f"limit_per_host={session.connector_options['limit_per_host']}, json={session.stats()['json']}"
+    )
+    return session
+
+
+def format_pool_stats(stats: dict) -> str:
+    return "\n".join(f"{key}: {value}" for key, value in stats.items())
@@ -0,0 +1,317 @@
+from app.database import User, UserSubscription, BroadcastJob, BroadcastRecipient
+from app.subscription_service import subscription_service
+from app.migrations import telegram_id_column
+from app.rate_limiter import background_job
+from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from datetime import datetime
+from sqlalchemy import select, update, insert, func, literal, and_
+import asyncio
+import logging
+import os
+import random
+import time
+
+# Скорость рассылки: лимит Telegram — около 30 сообщений в секунду на бота
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '10'))
+# Статусы получателей сохраняются пачками такого размера
+BROADCAST_BATCH_SIZE = 100
+BROADCAST_MAX_ATTEMPTS = 3
+# Как часто (сек) обновлять сообщение с прогрессом
+PROGRESS_UPDATE_INTERVAL = 5
+
+AUDIENCES = {
+    'all': 'Все активные пользователи',
+    'subscribers': 'С активной подпиской',
+    'no_subscription': 'Без активной подписки',
+}
+
+
+class Throttle:
+    """Равномерно пропускает не больше rate отправок в секунду на все корутины рассылки"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds):
+        """После 429 притормаживаем все отправки, а не только ту, что получила ошибку"""
+        self._next = max(self._next, time.monotonic() + seconds)
+
+
+def audience_conditions(audience, now=None):
+    """Условия отбора пользователей для аудитории рассылки"""
+    if audience not in AUDIENCES:
+        raise ValueError(f"Неизвестная аудитория рассылки: {audience}")
+    now = now or datetime.utcnow()
+    has_active = User.subscriptions.any(and_(UserSubscription.is_active == True, UserSubscription.end_date > now))
+    conditions = [User.is_active == True]
+    if audience == 'subscribers':
+        conditions.append(has_active)
+    elif audience == 'no_subscription':
+        conditions.append(~has_active)
+    return conditions
+
+
+class BroadcastService:
+    def __init__(self, async_session_maker=None):
+        self._async_session_maker = async_session_maker
+        self.bot = None
+        self._tasks = {}
+
+    @property
+    def async_session_maker(self):
+        # По умолчанию — общий session maker сервиса подписок, берется при первом запросе к БД
+        return self._async_session_maker or subscription_service.async_session_maker
+
+    @async_session_maker.setter
+    def async_session_maker(self, value):
+        self._async_session_maker = value
+
+    def set_bot(self, bot):
+        self.bot = bot
+
+    async def count_audience(self, audience):
+        async with self.async_session_maker() as session:
+            result = await session.execute(select(func.count(User.id)).where(*audience_conditions(audience)))
+            return result.scalar_one()
+
+    async def create_job(self, text, audience='all', created_by=None):
+        """Создает задание и одним INSERT ... SELECT фиксирует список получателей"""
+        async with self.async_session_maker() as session:
+            async with session.begin():
+                job = BroadcastJob(text=text, audience=audience, created_by=int(created_by) if created_by else None)
+                session.add(job)
+                await session.flush()
+                await session.execute(
+                    insert(BroadcastRecipient).from_select(
+                        ['job_id', 'user_id', 'telegram_id'],
+                        select(literal(job.id), User.id, telegram_id_column(User))
+                        .where(*audience_conditions(audience))
+                        .order_by(User.id)
+                    )
+                )
+                total = (await session.execute(
+                    select(func.count(BroadcastRecipient.id)).where(BroadcastRecipient.job_id == job.id)
+                )).scalar_one()
+                job.total = total
+            logging.info(f"[BROADCAST] Создана рассылка #{job.id} ({audience}), получателей: {total}")
+            return job.id
+
+    async def set_progress_message(self, job_id, chat_id, message_id):
+        async with self.async_session_maker() as session:
+            await session.execute(
+                update(BroadcastJob).where(BroadcastJob.id == job_id)
+                .values(progress_chat_id=str(chat_id), progress_message_id=message_id)
+            )
+            await session.commit()
+
+    def start(self, job_id):
+        """Запускает доставку в фоне (повторный вызов для идущей рассылки ничего не делает)"""
+        task = self._tasks.get(job_id)
+        if task and not task.done():
+            return task
+        task = asyncio.create_task(self.run(job_id))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+        return task
+
+    async def resume_pending(self):
+        """При старте бота продолжаем рассылки, прерванные перезапуском"""
+        async with self.async_session_maker() as session:
+            result = await session.execute(
+                select(BroadcastJob.id).where(BroadcastJob.status.in_(('pending', 'running')))
+            )
+            job_ids = result.scalars().all()
+        for job_id in job_ids:
+            logging.info(f"[BROADCAST] Возобновляем рассылку #{job_id}")
+            self.start(job_id)
+        return job_ids
+
+    async def cancel(self, job_id):
+        """Останавливает рассылку; доставка прекращается после текущей пачки"""
+        async with self.async_session_maker() as session:
+            result = await session.execute(
+                update(BroadcastJob)
+                .where(BroadcastJob.id == job_id, BroadcastJob.status.in_(('pending', 'running')))
+                .values(status='cancelled', finished_at=datetime.utcnow())
+            )
+            await session.commit()
+            return result.rowcount > 0
+
+    @background_job
+    async def run(self, job_id):
+        if not self.bot:
+            logging.error("Бот не инициализирован в BroadcastService")
+            return
+
+        async with self.async_session_maker() as session:
+            job = await session.get(BroadcastJob, job_id)
+            if not job or job.status not in ('pending', 'running'):
+                return
+            job.status = 'running'
+            job.started_at = job.started_at or datetime.utcnow()
+            text = job.text
+            await session.commit()
+
+        throttle = Throttle(BROADCAST_RATE)
+        semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        last_progress = time.monotonic()
+        try:
+            while True:
+                async with self.async_session_maker() as session:
+                    status = (await session.execute(
+                        select(BroadcastJob.status).where(BroadcastJob.id == job_id)
+                    )).scalar_one()
+                    if status != 'running':
+                        break
+                    result = await session.execute(
+                        select(BroadcastRecipient.id, BroadcastRecipient.user_id,
+                               BroadcastRecipient.telegram_id, BroadcastRecipient.attempts)
+                        .where(BroadcastRecipient.job_id == job_id, BroadcastRecipient.status == 'pending')
+                        .order_by(BroadcastRecipient.id)
+                        .limit(BROADCAST_BATCH_SIZE)
+                    )
+                    recipients = result.all()
+
+                if not recipients:
+                    async with self.async_session_maker() as session:
+                        await session.execute(
+                            update(BroadcastJob).where(BroadcastJob.id == job_id, BroadcastJob.status == 'running')
+                            .values(status='done', finished_at=datetime.utcnow())
+                        )
+                        await session.commit()
+                    logging.info(f"[BROADCAST] Рассылка #{job_id} завершена")
+                    break
+
+                outcomes = await asyncio.gather(*(
+                    self._deliver(recipient, text, throttle, semaphore) for recipient in recipients
+                ))
+                await self._save_batch(job_id, outcomes)
+
+                if time.monotonic() - last_progress >= PROGRESS_UPDATE_INTERVAL:
+                    await self.update_progress(job_id)
+                    last_progress = time.monotonic()
+        finally:
+            await self.update_progress(job_id)
+
+    async def _deliver(self, recipient, text, throttle, semaphore):
+        """Отправка одному получателю: (recipient, статус, ошибка, попыток); 429 попыткой не считается"""
+        error = None
+        attempt = 1
+        async with semaphore:
+            while True:
+                await throttle.wait()
+                try:
+                    await self.bot.send_message(chat_id=recipient.telegram_id, text=text)
+                    return recipient, 'sent', None, attempt
+                except TelegramRetryAfter as e:
+                    # Сюда 429 доходит, только когда лимитер сессии (RateLimitMiddleware) исчерпал свои повторы.
+                    # Он ставит на паузу бакет одного чата, а у рассылки это обычно лимит всего бота, поэтому
+                    # пауза здесь общая для всех корутин рассылки. Счетчик попыток не растет
+                    throttle.pause(e.retry_after)
+                    await asyncio.sleep(e.retry_after)
+                except TelegramForbiddenError as e:
+                    # Бот заблокирован или аккаунт удалён — больше не пытаемся, пользователь гасится
+                    return recipient, 'blocked', str(e), attempt
+                except TelegramBadRequest as e:
+                    # Ошибка самого сообщения (разметка, длина) или чата: повтор не поможет,
+                    # но пользователя не гасим — такая ошибка может прийти всем получателям
+                    return recipient, 'failed', str(e), attempt
+                except Exception as e:
+                    error = str(e)
+                    logging.error(f"[BROADCAST] Ошибка отправки пользователю {recipient.telegram_id} (попытка {attempt}): {e}")
+                    if attempt == BROADCAST_MAX_ATTEMPTS:
+                        return recipient, 'failed', error, attempt
+                    await asyncio.sleep(1 + attempt + random.uniform(0, 1))
+                    attempt += 1
+
+    async def _save_batch(self, job_id, outcomes):
+        """Сохраняет статусы пачки, счетчики задания и гасит заблокировавших бота пользователей"""
+        now = datetime.utcnow()
+        counters = {'sent': 0, 'failed': 0, 'blocked': 0}
+        rows = []
+        for recipient, status, error, attempts in outcomes:
+            counters[status] += 1
+            rows.append({
+                'id': recipient.id,
+                'status': status,
+                'error': error,
+                'attempts': recipient.attempts + attempts,
+                'sent_at': now if status == 'sent' else None,
+            })
+        blocked_user_ids = [recipient.user_id for recipient, status, _, _ in outcomes if status == 'blocked']
+
+        async with self.async_session_maker() as session:
+            async with session.begin():
+                # Массовое обновление по первичному ключу (executemany)
+                await session.execute(update(BroadcastRecipient), rows)
+                await session.execute(
+                    update(BroadcastJob).where(BroadcastJob.id == job_id).values(
+                        sent=BroadcastJob.sent + counters['sent'],
+                        failed=BroadcastJob.failed + counters['failed'],
+                        blocked=BroadcastJob.blocked + counters['blocked'],
+                    )
+                )
+                if blocked_user_ids:
+                    await session.execute(
+                        update(User).where(User.id.in_(blocked_user_ids)).values(is_active=False)
+                    )
+        if blocked_user_ids:
+            logging.info(f"[BROADCAST] #{job_id}: {len(blocked_user_ids)} пользователей недоступны, помечены неактивными")
+
+    async def get_job(self, job_id):
+        async with self.async_session_maker() as session:
+            return await session.get(BroadcastJob, job_id)
+
+    async def update_progress(self, job_id):
+        """Редактирует одно сообщение с прогрессом рассылки"""
+        job = await self.get_job(job_id)
+        if not job or not job.progress_message_id or not self.bot:
+            return
+        try:
+            await self.bot.edit_message_text(
+                chat_id=job.progress_chat_id,
+                message_id=job.progress_message_id,
+                text=format_progress(job),
+                reply_markup=progress_keyboard(job),
+            )
+        except TelegramBadRequest as e:
+            # "message is not modified" и т.п. — не критично
+            logging.debug(f"[BROADCAST] Не удалось обновить прогресс #{job_id}: {e}")
+        except Exception as e:
+            logging.error(f"[BROADCAST] Ошибка обновления прогресса #{job_id}: {e}")
+
+
+def format_progress(job):
+    statuses = {'pending': '⏳ В очереди', 'running': '📤 Идет рассылка', 'done': '✅ Завершена', 'cancelled': '⛔ Остановлена'}
+    processed = job.sent + job.failed + job.blocked
+    return (
+        f"Рассылка #{job.id}: {statuses.get(job.status, job.status)}\n"
+        f"Аудитория: {AUDIENCES.get(job.audience, job.audience)}\n"
+        f"Обработано: {processed} из {job.total}\n"
+        f"Доставлено: {job.sent}, заблокировали бота: {job.blocked}, ошибок: {job.failed}"
+    )
+
+
+def progress_keyboard(job):
+    if job.status not in ('pending', 'running'):
+        return None
+    return InlineKeyboardMarkup(
+        inline_keyboard=[[InlineKeyboardButton(text="⛔ Остановить", callback_data=f"bc_stop:{job.id}")]]
+    )
+
+
+broadcast_service = BroadcastService()
@@ -0,0 +1,86 @@
+import asyncio
+import contextvars
+import logging
+import os
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Сколько операций одного канала выполняется одновременно (создание ссылок, заявки, отзыв доступа)
+CHANNEL_WORKER_CONCURRENCY = int(os.getenv('CHANNEL_WORKER_CONCURRENCY', '2'))
+
+
+class _ChannelQueue:
+    __slots__ = ('jobs', 'workers', 'done', 'failed')
+
+    def __init__(self):
+        self.jobs = deque()
+        self.workers = set()
+        self.done = 0
+        self.failed = 0
+
+
+class ChannelWorkers:
+    """
+    Очереди операций с Bot API по каналам: у каждого канала своя очередь и свои воркеры.
+    Медленный канал или канал на паузе после 429 копит очередь только у себя,
+    операции с остальными каналами выполняются без ожидания.
+    Воркеры запускаются при появлении работы и завершаются, когда очередь пуста.
+    """
+
+    def __init__(self, concurrency: int = CHANNEL_WORKER_CONCURRENCY):
+        self.concurrency = concurrency
+        self._queues: dict[str, _ChannelQueue] = {}
+
+    def submit(self, channel_id, func, *args, **kwargs) -> asyncio.Future:
+        """Ставит func(*args, **kwargs) в очередь канала, возвращает future с результатом"""
+        queue = self._queues.setdefault(str(channel_id), _ChannelQueue())
+        future = asyncio.get_running_loop().create_future()
+        # Контекст вызывающего кода (приоритет запросов к API и т.п.) сохраняется для операции
+        queue.jobs.append((func, args, kwargs, future, contextvars.copy_context()))
+        if len(queue.jobs) % 100 == 0:
+            logger.warning(f"Очередь канала {channel_id}: {len(queue.jobs)} операций в ожидании")
+        if len(queue.workers) < self.concurrency:
+            task = asyncio.create_task(self._work(str(channel_id), queue))
+            queue.workers.add(task)
+        return future
+
+    async def run(self, channel_id, func, *args, **kwargs):
+        """Выполняет операцию в очереди канала и ждет результат"""
+        return await self.submit(channel_id, func, *args, **kwargs)
+
+    async def run_all(self, channel_ids, func, *args, return_exceptions=False, **kwargs):
+        """func(channel_id, ...) по всем каналам параллельно, каждый вызов — в очереди своего канала"""
+        return await asyncio.gather(
+            *(self.submit(channel_id, func, channel_id, *args, **kwargs) for channel_id in channel_ids),
+            return_exceptions=return_exceptions
+        )
+
+    async def _work(self, channel_id, queue):
+        try:
+            while queue.jobs:
+                func, args, kwargs, future, context = queue.jobs.popleft()
+                if future.cancelled():
+                    continue
+                try:
+                    result = await asyncio.create_task(func(*args, **kwargs), context=context)
+                except Exception as e:
+                    queue.failed += 1
+                    if not future.cancelled():
+                        future.set_exception(e)
+                else:
+                    queue.done += 1
+                    if not future.cancelled():
+                        future.set_result(result)
+        finally:
+            queue.workers.discard(asyncio.current_task())
+
+    def stats(self) -> dict:
+        return {
+            channel_id: {'queued': len(queue.jobs), 'workers': len(queue.workers),
+                         'done': queue.done, 'failed': queue.failed}
+            for channel_id, queue in self._queues.items()
+        }
+
+
+channel_workers = ChannelWorkers()
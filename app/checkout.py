@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import os
+import time
+from collections import Counter, deque
+
+from app.invoice_links import parse_invoice_payload
+from app.subscription_service import subscription_service
+
+logger = logging.getLogger(__name__)
+
+# Бюджет (мс) на проверку pre_checkout_query. Telegram ждет ответ 10 сек; не уложились —
+# отвечаем ok (оплату все равно проверяет обработчик successful_payment) и считаем в метрике
+PRE_CHECKOUT_BUDGET_MS = float(os.getenv('PRE_CHECKOUT_BUDGET_MS', '1000'))
+# Сколько (сек) после ok на pre_checkout_query не принимать оплату другого счета того же пользователя.
+# Отказ провайдера (например, карта отклонена) successful_payment не присылает, поэтому окно короткое
+PENDING_CHECKOUT_TTL = float(os.getenv('PENDING_CHECKOUT_TTL', '30'))
+# Сколько последних замеров хранить для перцентилей
+LATENCY_WINDOW = 1000
+
+
+class PendingCheckouts:
+    """
+    Оплаты в процессе: pre_checkout_query подтвержден, successful_payment еще не пришел.
+    Хранятся в памяти процесса; оплата, от которой не пришло подтверждение, забывается через ttl.
+    """
+
+    def __init__(self, ttl=PENDING_CHECKOUT_TTL, clock=time.monotonic):
+        self.ttl = ttl
+        self._clock = clock
+        self._pending = {}  # telegram_id -> (query_id, payload, время подтверждения)
+
+    def active(self, telegram_id):
+        entry = self._pending.get(telegram_id)
+        if entry is not None and self._clock() - entry[2] > self.ttl:
+            del self._pending[telegram_id]
+            return None
+        return entry
+
+    def add(self, telegram_id, query_id, payload):
+        self._pending[telegram_id] = (query_id, payload, self._clock())
+
+    def complete(self, telegram_id):
+        return self._pending.pop(telegram_id, None)
+
+    def __len__(self):
+        now = self._clock()
+        self._pending = {key: entry for key, entry in self._pending.items() if now - entry[2] <= self.ttl}
+        return len(self._pending)
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class PreCheckoutValidator:
+    """
+    Проверка pre_checkout_query без обращений к БД: тариф и сумма — по каталогу тарифов в памяти
+    (load_plans, обычно subscription_service.get_active_plans), незавершенная оплата — по PendingCheckouts.
+    Отказ только при доказанной проблеме; тариф не из каталога, превышение бюджета и ошибки
+    проверки — ok с отметкой в метриках (outcomes).
+    """
+
+    def __init__(self, load_plans, pending=None, budget_ms=PRE_CHECKOUT_BUDGET_MS, window=LATENCY_WINDOW):
+        self.load_plans = load_plans
+        self.pending = pending if pending is not None else PendingCheckouts()
+        self.budget = budget_ms / 1000
+        self.outcomes = Counter()
+        self.validation_latency = deque(maxlen=window)
+        self.answer_latency = deque(maxlen=window)
+
+    async def check(self, query):
+        """Текст ошибки для ok=False или None — отвечать ok=True"""
+        started = time.perf_counter()
+        try:
+            error_message, outcome = await asyncio.wait_for(self._validate(query), self.budget)
+        except asyncio.TimeoutError:
+            error_message, outcome = None, 'budget_exceeded'
+            logger.warning(f"[PRE_CHECKOUT] Проверка {query.id} не уложилась в {self.budget * 1000:.0f} мс, отвечаем ok")
+        except Exception as e:
+            error_message, outcome = None, 'error'
+            logger.error(f"[PRE_CHECKOUT][ERROR] Ошибка проверки {query.id}, отвечаем ok: {e}")
+        self.outcomes[outcome] += 1
+        self.validation_latency.append(time.perf_counter() - started)
+        return error_message
+
+    async def _validate(self, query):
+        parsed = parse_invoice_payload(query.invoice_payload)
+        if parsed is None:
+            return "Ошибка обработки платежа: некорректный формат данных.", 'rejected'
+        kind, plan_id, _ = parsed
+
+        telegram_id = query.from_user.id
+        in_flight = self.pending.active(telegram_id)
+        # Повтор оплаты того же счета (после отказа по карте) не блокируется — блокируется второй счет
+        if in_flight is not None and in_flight[0] != query.id and in_flight[1] != query.invoice_payload:
+            return "Предыдущая оплата еще обрабатывается. Попробуйте через минуту.", 'rejected'
+
+        # Каталог в памяти; холодная загрузка из БД не отменяется по таймауту и прогреет каталог
+        plans = await asyncio.shield(self.load_plans())
+        plan = next((p for p in plans if p.id == plan_id), None)
+        if plan is None:
+            # Старый тариф (например, продление) — в каталоге его нет, проверит successful_payment
+            outcome = 'unverified'
+        elif isinstance(query.total_amount, int) and query.total_amount != plan.price:
+            return "Стоимость тарифа изменилась. Выберите тариф заново.", 'rejected'
+        else:
+            outcome = 'ok'
+        self.pending.add(telegram_id, query.id, query.invoice_payload)
+        return None, outcome
+
+    def record_answer(self, seconds):
+        """Время от получения pre_checkout_query до отправленного ответа"""
+        self.answer_latency.append(seconds)
+
+    def stats(self) -> dict:
+        stats = dict(self.outcomes)
+        stats['pending'] = len(self.pending)
+        for name, values in (('validation', self.validation_latency), ('answer', self.answer_latency)):
+            stats[f'{name}_p50_ms'] = round(_percentile(values, 0.5) * 1000, 1)
+            stats[f'{name}_p99_ms'] = round(_percentile(values, 0.99) * 1000, 1)
+            stats[f'{name}_max_ms'] = round(max(values, default=0.0) * 1000, 1)
+        return stats
+
+
+pre_checkout = PreCheckoutValidator(subscription_service.get_active_plans)
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import os
+import time
+
+from aiogram import BaseMiddleware
+
+logger = logging.getLogger(__name__)
+
+# Сколько обработчиков апдейтов может выполняться одновременно (пул БД ограничен)
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', '20'))
+
+
+class _KeyedLock:
+    __slots__ = ('lock', 'users')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0  # Сколько апдейтов держат или ждут блокировку
+
+
+class UpdateReceivedMiddleware(BaseMiddleware):
+    """
+    Первый внешний middleware апдейтов: время получения апдейта (perf_counter) в data['update_received'],
+    чтобы задержка ответа учитывала и ожидание в очередях следующих middleware
+    """
+
+    async def __call__(self, handler, event, data):
+        data['update_received'] = time.perf_counter()
+        return await handler(event, data)
+
+
+class UpdateConcurrencyMiddleware(BaseMiddleware):
+    """
+    Внешний middleware апдейтов:
+    - апдейты одного пользователя обрабатываются строго по очереди (двойное нажатие,
+      повторная доставка successful_payment не выполняются параллельно);
+    - блокировки по пользователям удаляются, как только у пользователя нет апдейтов в работе;
+    - общее число одновременно выполняемых обработчиков ограничено, остальные ждут;
+    - при насыщении дешевые команды (degraded_replies: /start, /help) получают быстрый
+      ответ без захода в обработчик и без обращения к БД;
+    - pre_checkout_query проходит сразу, без очереди пользователя и общего лимита: на ответ
+      у Telegram 10 сек, а его проверка не обращается к БД (app/checkout.py).
+    """
+
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT_UPDATES, degraded_replies: dict | None = None):
+        self.max_concurrent = max_concurrent
+        self.degraded_replies = degraded_replies or {}
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._locks: dict[int, _KeyedLock] = {}
+        self.active = 0
+        self.waiting = 0
+        self.degraded = 0
+
+    @property
+    def saturated(self) -> bool:
+        return self.active >= self.max_concurrent
+
+    def _degraded_reply(self, event):
+        message = getattr(event, 'message', None)
+        text = getattr(message, 'text', None)
+        if not text or not text.startswith('/'):
+            return None
+        command = text.split()[0].split('@')[0]
+        return self.degraded_replies.get(command)
+
+    async def __call__(self, handler, event, data):
+        if getattr(event, 'pre_checkout_query', None) is not None:
+            return await handler(event, data)
+
+        if self.saturated:
+            reply = self._degraded_reply(event)
+            if reply:
+                self.degraded += 1
+                await data['bot'].send_message(chat_id=event.message.chat.id, text=reply, parse_mode='HTML')
+                return None
+
+        user = data.get('event_from_user')
+        if user is None:
+            return await self._run_limited(handler, event, data)
+
+        keyed = self._locks.get(user.id)
+        if keyed is None:
+            keyed = self._locks[user.id] = _KeyedLock()
+        keyed.users += 1
+        try:
+            async with keyed.lock:
+                return await self._run_limited(handler, event, data)
+        finally:
+            keyed.users -= 1
+            if not keyed.users:
+                self._locks.pop(user.id, None)
+
+    async def _run_limited(self, handler, event, data):
+        if self.saturated:
+            self.waiting += 1
+            if self.waiting % 100 == 1:
+                logger.warning(f"Все {self.max_concurrent} слотов обработки заняты, в ожидании: {self.waiting}")
+            try:
+                await self._semaphore.acquire()
+            finally:
+                self.waiting -= 1
+        else:
+            await self._semaphore.acquire()
+        self.active += 1
+        try:
+            return await handler(event, data)
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            'active': self.active,
+            'waiting': self.waiting,
+            'degraded': self.degraded,
+            'user_locks': len(self._locks),
+        }
@@ -1,12 +1,24 @@
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Text, JSON
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, ForeignKey, DateTime, Date, Text, JSON, Index, text, inspect
 from sqlalchemy.orm import declarative_base, relationship
 from datetime import datetime
+import asyncio
+import logging
 import os
 
 # Создаем базовый класс для наших моделей
 Base = declarative_base()
 
+# Переход на BigInteger Telegram ID (см. migrations.py): пока живы обе колонки, при вставке
+# недостающая заполняется из переданной, так что любой код пишет их согласованно
+def _telegram_id_default(context):
+    value = context.get_current_parameters().get('telegram_user_id')
+    return int(value) if value is not None else None
+
+def _telegram_user_id_default(context):
+    value = context.get_current_parameters().get('telegram_id')
+    return str(value) if value is not None else None
+
 # Модель тарифного плана
 class SubscriptionPlan(Base):
     __tablename__ = 'subscription_plans'
@@ -20,17 +32,33 @@ class SubscriptionPlan(Base):
     
     # Отношение с подписками пользователей
     subscriptions = relationship("UserSubscription", back_populates="plan")
+    channels = relationship("PlanChannel", back_populates="plan", order_by="PlanChannel.position")
     
     def __repr__(self):
         return f"<SubscriptionPlan(id={self.id}, name='{self.name}', price={self.price/100})>"
 
+# Каналы тарифа: один тариф может давать доступ к нескольким каналам (пакет).
+# Для тарифов без строк здесь используется SubscriptionPlan.channel_id
+class PlanChannel(Base):
+    __tablename__ = 'plan_channels'
+
+    plan_id = Column(Integer, ForeignKey('subscription_plans.id', ondelete='CASCADE'), primary_key=True)
+    channel_id = Column(String, primary_key=True)
+    position = Column(Integer, nullable=False, default=0)  # Порядок каналов в сообщениях пользователю
+
+    plan = relationship("SubscriptionPlan", back_populates="channels")
+
+    def __repr__(self):
+        return f"<PlanChannel(plan_id={self.plan_id}, channel_id='{self.channel_id}')>"
+
 # Модель пользователя
 class User(Base):
     __tablename__ = 'users'
     
     id = Column(Integer, primary_key=True)
     first_name = Column(String, nullable=True)  # Имя пользователя
-    telegram_user_id = Column(String, nullable=False, unique=True)
+    telegram_id = Column(BigInteger, nullable=True, unique=True, index=True, default=_telegram_id_default)  # Telegram ID
+    telegram_user_id = Column(String, nullable=False, unique=True, default=_telegram_user_id_default)  # Устаревшая строковая копия
     is_active = Column(Boolean, default=True)
     email = Column(String, nullable=True)  # Поле для хранения электронной почты пользователя
     created_at = Column(DateTime, nullable=False, default=datetime.utcnow)  # Время регистрации
@@ -38,12 +66,19 @@ class User(Base):
     # Отношение с подписками пользователя
     subscriptions = relationship("UserSubscription", back_populates="user")
     
+    @property
+    def tg_id(self) -> int:
+        """Telegram ID числом; до окончания backfill — из строковой колонки"""
+        return self.telegram_id if self.telegram_id is not None else int(self.telegram_user_id)
+
     def __repr__(self):
-        return f"<User(id={self.id}, telegram_user_id='{self.telegram_user_id}')>"
+        return f"<User(id={self.id}, telegram_id={self.telegram_id})>"
 
 # Модель подписки пользователя
 class UserSubscription(Base):
     __tablename__ = 'user_subscriptions'
+    # Без переиспользования id в SQLite: архивные строки сохраняют исходный id
+    __table_args__ = {'sqlite_autoincrement': True}
     
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
@@ -64,12 +99,66 @@ class UserSubscription(Base):
     def __repr__(self):
         return f"<UserSubscription(id={self.id}, user_id={self.user_id}, plan_id={self.plan_id}, active={self.is_active})>"
 
+# Ссылки-приглашения подписки: по одной на каждый канал тарифа
+class SubscriptionInvite(Base):
+    __tablename__ = 'subscription_invites'
+    __table_args__ = (
+        Index('ix_subscription_invites_link', 'invite_link'),
+        Index('ix_subscription_invites_subscription', 'subscription_id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    subscription_id = Column(Integer, ForeignKey('user_subscriptions.id', ondelete='CASCADE'), nullable=False)
+    channel_id = Column(String, nullable=False)
+    invite_link = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    revoked_at = Column(DateTime, nullable=True)  # Отозвана после вступления или при отзыве доступа
+
+    def __repr__(self):
+        return f"<SubscriptionInvite(subscription_id={self.subscription_id}, channel_id='{self.channel_id}', revoked={self.revoked_at is not None})>"
+
+# Архив давно истекших подписок: те же колонки, что у user_subscriptions, и исходный id.
+# Строки переносит archive_expired_subscriptions (см. archive.py)
+class UserSubscriptionArchive(Base):
+    __tablename__ = 'user_subscriptions_archive'
+    __table_args__ = (Index('ix_user_subscriptions_archive_user', 'user_id'),)
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    plan_id = Column(Integer, ForeignKey('subscription_plans.id'), nullable=False)
+    start_date = Column(DateTime, nullable=False)
+    end_date = Column(DateTime, nullable=False)
+    is_active = Column(Boolean, default=False)
+    invite_link = Column(String)
+    reminder_sent = Column(Boolean, default=False)
+    last_day_reminder_sent = Column(Boolean, default=False)
+    expired_reminder_sent = Column(Boolean, default=False)
+    provider_payment_charge_id = Column(String, nullable=True)
+    archived_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<UserSubscriptionArchive(id={self.id}, user_id={self.user_id}, end_date={self.end_date})>"
+
+# Членство пользователей в наших каналах по апдейтам chat_member (см. membership.py).
+# Нет строки — статус неизвестен, тогда код спрашивает Telegram
+class ChannelMember(Base):
+    __tablename__ = 'channel_members'
+
+    channel_id = Column(String, primary_key=True)  # Как SubscriptionPlan.channel_id
+    telegram_id = Column(BigInteger, primary_key=True)
+    status = Column(String, nullable=False)  # member | administrator | creator | restricted | left | kicked
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)  # Время события в Telegram
+
+    def __repr__(self):
+        return f"<ChannelMember(channel_id='{self.channel_id}', telegram_id={self.telegram_id}, status='{self.status}')>"
+
 # Модель для хранения информации об ошибочных платежах
 class PaymentError(Base):
     __tablename__ = 'payment_errors'
     
     id = Column(Integer, primary_key=True)
-    telegram_user_id = Column(String, nullable=False)
+    telegram_id = Column(BigInteger, nullable=True, index=True, default=_telegram_id_default)
+    telegram_user_id = Column(String, nullable=False, default=_telegram_user_id_default)  # Устаревшая строковая копия
     plan_id = Column(Integer, ForeignKey('subscription_plans.id'), nullable=True)
     provider_payment_charge_id = Column(String, nullable=False)  # ID транзакции у платежного провайдера
     payment_amount = Column(Integer, nullable=True)  # Сумма платежа в копейках
@@ -82,30 +171,152 @@ class PaymentError(Base):
     is_resolved = Column(Boolean, default=False)  # Был ли платеж обработан вручную
     resolution_notes = Column(Text, nullable=True)  # Заметки о решении проблемы
     resolution_time = Column(DateTime, nullable=True)  # Когда проблема была решена
+
+    @property
+    def tg_id(self) -> int:
+        return self.telegram_id if self.telegram_id is not None else int(self.telegram_user_id)
     
     def __repr__(self):
-        return f"<PaymentError(id={self.id}, user_id='{self.telegram_user_id}', charge_id='{self.provider_payment_charge_id}', resolved={self.is_resolved})>"
+        return f"<PaymentError(id={self.id}, user_id={self.tg_id}, charge_id='{self.provider_payment_charge_id}', resolved={self.is_resolved})>"
+
+# Дневные счетчики событий по планам (обновляются инкрементально, см. stats_service)
+class DailyStat(Base):
+    __tablename__ = 'daily_stats'
 
-# Асинхронное подключение к PostgreSQL
+    day = Column(Date, primary_key=True)
+    plan_id = Column(Integer, primary_key=True, default=0)  # 0 — событие без привязки к плану
+    new_count = Column(Integer, nullable=False, default=0)  # Новые подписки
+    extended_count = Column(Integer, nullable=False, default=0)  # Продления
+    expired_count = Column(Integer, nullable=False, default=0)  # Истекшие подписки
+    cancelled_count = Column(Integer, nullable=False, default=0)  # Отмененные пользователем
+    revenue = Column(Integer, nullable=False, default=0)  # Выручка в копейках
+
+    def __repr__(self):
+        return f"<DailyStat(day={self.day}, plan_id={self.plan_id}, new={self.new_count}, revenue={self.revenue/100})>"
+
+# Запланированные уведомления: строки создаются при оформлении, продлении и отмене подписки,
+# а один диспетчер отправляет то, что наступило (см. notifications.py)
+class ScheduledNotification(Base):
+    __tablename__ = 'scheduled_notifications'
+    __table_args__ = (
+        # Частичный индекс: в нем только ожидающие отправки строки, поэтому он остается маленьким
+        Index('ix_scheduled_notifications_pending_due', 'due_at',
+              postgresql_where=text("status = 'pending'"), sqlite_where=text("status = 'pending'")),
+        Index('ix_scheduled_notifications_subscription', 'subscription_id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    subscription_id = Column(Integer, ForeignKey('user_subscriptions.id', ondelete='CASCADE'), nullable=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    kind = Column(String, nullable=False)  # expiring_24h | last_day | expired | registration
+    due_at = Column(DateTime, nullable=False)
+    sent_at = Column(DateTime, nullable=True)
+    status = Column(String, nullable=False, default='pending')  # pending | sent | cancelled | failed
+    attempts = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<ScheduledNotification(id={self.id}, kind='{self.kind}', due_at={self.due_at}, status='{self.status}')>"
+
+# Выполненные разовые переносы данных (см. migrations.run_data_migration)
+class DataMigration(Base):
+    __tablename__ = 'data_migrations'
+
+    name = Column(String, primary_key=True)
+    applied_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<DataMigration(name='{self.name}', applied_at={self.applied_at})>"
+
+# Задание на рассылку (аудитория фиксируется в broadcast_recipients при создании)
+class BroadcastJob(Base):
+    __tablename__ = 'broadcast_jobs'
+
+    id = Column(Integer, primary_key=True)
+    text = Column(Text, nullable=False)
+    audience = Column(String, nullable=False, default='all')  # all | subscribers | no_subscription
+    status = Column(String, nullable=False, default='pending')  # pending | running | done | cancelled
+    created_by = Column(BigInteger, nullable=True)  # Telegram ID админа
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    total = Column(Integer, nullable=False, default=0)
+    sent = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    blocked = Column(Integer, nullable=False, default=0)
+    progress_chat_id = Column(String, nullable=True)  # Сообщение, в котором показываем прогресс
+    progress_message_id = Column(Integer, nullable=True)
+
+    def __repr__(self):
+        return f"<BroadcastJob(id={self.id}, status='{self.status}', sent={self.sent}/{self.total})>"
+
+# Получатель рассылки: статус доставки сохраняется по каждому пользователю
+class BroadcastRecipient(Base):
+    __tablename__ = 'broadcast_recipients'
+    __table_args__ = (Index('ix_broadcast_recipients_job_status', 'job_id', 'status', 'id'),)
+
+    id = Column(Integer, primary_key=True)
+    job_id = Column(Integer, ForeignKey('broadcast_jobs.id', ondelete='CASCADE'), nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    telegram_id = Column(BigInteger, nullable=False)
+    status = Column(String, nullable=False, default='pending')  # pending | sent | failed | blocked
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(Text, nullable=True)
+    sent_at = Column(DateTime, nullable=True)
+
+# Асинхронное подключение к PostgreSQL.
+# Движок создается при первом обращении: импорт модуля не требует DATABASE_URL и не открывает соединений
 DATABASE_URL = os.getenv("DATABASE_URL")
-if not DATABASE_URL:
-    raise ValueError("Не задана переменная окружения DATABASE_URL. Укажите её в .env!")
+# Логирование SQL: запросы идут через logging ('sqlalchemy.engine'), а не через собственный
+# обработчик движка (echo=True), поэтому попадают в общую очередь логов
+SQL_ECHO = os.getenv('SQL_ECHO', 'False').lower() in ('true', '1', 't')
+# Сколько соединений пула открыть при запуске, чтобы первые апдейты не ждали подключения к БД
+DB_POOL_PREWARM = int(os.getenv('DB_POOL_PREWARM', '5'))
+
+_engine = None
+_session_maker = None
 
 def get_async_engine():
-    return create_async_engine(DATABASE_URL, echo=True)
+    global _engine
+    if _engine is None:
+        url = DATABASE_URL or os.getenv("DATABASE_URL")
+        if not url:
+            raise ValueError("Не задана переменная окружения DATABASE_URL. Укажите её в .env!")
+        if SQL_ECHO:
+            logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)
+        _engine = create_async_engine(url)
+    return _engine
 
 def get_async_session_maker(engine=None):
-    if engine is None:
-        engine = get_async_engine()
-    return async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+    global _session_maker
+    if engine is not None:
+        return async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+    if _session_maker is None:
+        _session_maker = async_sessionmaker(get_async_engine(), expire_on_commit=False, class_=AsyncSession)
+    return _session_maker
+
+def _missing_tables(sync_conn):
+    existing = set(inspect(sync_conn).get_table_names())
+    return [table for name, table in Base.metadata.tables.items() if name not in existing]
 
 # Асинхронная инициализация базы данных
 async def async_init_db():
     engine = get_async_engine()
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+        # Один запрос к каталогу вместо проверки каждой таблицы; create_all — только если чего-то нет
+        missing = await conn.run_sync(_missing_tables)
+        if missing:
+            await conn.run_sync(lambda sync_conn: Base.metadata.create_all(sync_conn, tables=missing))
     return engine
 
+async def prewarm_pool(engine, connections=DB_POOL_PREWARM):
+    """Открывает соединения пула заранее (не больше размера пула), возвращает число открытых"""
+    if not hasattr(engine.pool, 'size'):
+        return 0  # NullPool/StaticPool: соединения не переиспользуются или оно одно
+    connections = min(connections, engine.pool.size())
 
+    async def touch():
+        async with engine.connect() as conn:
+            await conn.execute(text('SELECT 1'))
 
-
+    await asyncio.gather(*(touch() for _ in range(connections)))
+    return connections
@@ -0,0 +1,161 @@
+import asyncio
+import json
+import logging
+import os
+
+from aiogram.types import LabeledPrice
+
+logger = logging.getLogger(__name__)
+
+# Оплата по заранее созданным ссылкам createInvoiceLink: выбор тарифа отвечает кнопкой со ссылкой
+# сразу, без sendInvoice и ожидания ответа Telegram. Выключено — прежний sendInvoice на каждый выбор
+INVOICE_LINKS = os.getenv('INVOICE_LINKS', 'False').lower() in ('true', '1', 't')
+
+KINDS = ('plan', 'extend')
+
+
+def invoice_payload(plan_id, is_extension=False, subscription_id=None) -> str:
+    """
+    plan_<тариф> — новая подписка, extend_<тариф>[_<подписка>] — продление.
+    У общей ссылки подписки в payload нет: продлевается активная подписка плательщика.
+    """
+    if not is_extension:
+        return f"plan_{plan_id}"
+    return f"extend_{plan_id}_{subscription_id}" if subscription_id else f"extend_{plan_id}"
+
+
+def parse_invoice_payload(payload):
+    """(вид, plan_id, subscription_id | None) или None для некорректного payload"""
+    kind, _, rest = (payload or '').partition('_')
+    if kind not in KINDS:
+        return None
+    try:
+        ids = [int(part) for part in rest.split('_')]
+    except ValueError:
+        return None
+    if len(ids) == 1 or (kind == 'extend' and len(ids) == 2):
+        return kind, ids[0], ids[1] if len(ids) == 2 else None
+    return None
+
+
+def build_invoice(plan, is_extension, provider_token, payload) -> dict:
+    """Параметры счета, общие для sendInvoice и createInvoiceLink"""
+    # Данные для чека (provider_data)
+    provider_data = {
+        "receipt": {
+            "items": [
+                {
+                    "description": f"{'Продление подписки' if is_extension else 'Подписка'} {plan.name} на {plan.duration_days} дней",
+                    "quantity": 1.0,
+                    "amount": {
+                        "value": plan.price / 100,  # В рублях, а не копейках
+                        "currency": "RUB"
+                    },
+                    "vat_code": 1,  # НДС 20%
+                    "payment_mode": "full_payment",
+                    "payment_subject": "service"  # Услуга
+                }
+            ],
+            "tax_system_code": 1  # Общая система налогообложения
+        }
+    }
+    return dict(
+        title=f"{'Продление подписки' if is_extension else 'Подписка'} {plan.name}",
+        description=f"Оплата {'продления доступа' if is_extension else 'доступа'} к тарифу {plan.name}, продолжительность - {plan.duration_days} дней",
+        payload=payload,
+        provider_token=provider_token,
+        currency="RUB",
+        prices=[LabeledPrice(label=plan.name, amount=plan.price)],
+        need_name=False,
+        need_phone_number=False,
+        need_email=True,
+        send_email_to_provider=True,
+        need_shipping_address=False,
+        is_flexible=False,
+        provider_data=json.dumps(provider_data),
+    )
+
+
+class InvoiceLinkCache:
+    """
+    Ссылки на оплату по тарифу и виду (новая подписка / продление). Счет одинаков для всех
+    пользователей, поэтому ссылка создается один раз и переиспользуется. Ссылка привязана
+    к названию, цене и сроку тарифа: после изменения тарифа в каталоге создается новая.
+    Одновременные запросы одной ссылки ждут один вызов createInvoiceLink.
+    """
+
+    def __init__(self):
+        self._links = {}  # (plan_id, вид) -> (подпись тарифа, ссылка)
+        self._pending = {}  # (plan_id, вид) -> задача создания ссылки
+        self.created = 0
+        self.hits = 0
+        self.errors = 0
+
+    @staticmethod
+    def _key(plan, is_extension):
+        return plan.id, 'extend' if is_extension else 'plan'
+
+    @staticmethod
+    def _signature(plan, provider_token):
+        return plan.name, plan.price, plan.duration_days, provider_token
+
+    def get(self, plan, is_extension, provider_token):
+        """Готовая актуальная ссылка или None"""
+        cached = self._links.get(self._key(plan, is_extension))
+        if cached is not None and cached[0] == self._signature(plan, provider_token):
+            return cached[1]
+        return None
+
+    async def get_or_create(self, bot, plan, is_extension, provider_token) -> str:
+        link = self.get(plan, is_extension, provider_token)
+        if link is not None:
+            self.hits += 1
+            return link
+        key = self._key(plan, is_extension)
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._create(bot, plan, is_extension, provider_token))
+            self._pending[key] = task
+            task.add_done_callback(lambda _: self._pending.pop(key, None))
+        # shield: отмена одного ожидающего не отменяет создание ссылки для остальных
+        return await asyncio.shield(task)
+
+    async def _create(self, bot, plan, is_extension, provider_token) -> str:
+        params = build_invoice(plan, is_extension, provider_token, invoice_payload(plan.id, is_extension))
+        try:
+            link = await bot.create_invoice_link(**params)
+        except Exception:
+            self.errors += 1
+            raise
+        self._links[self._key(plan, is_extension)] = (self._signature(plan, provider_token), link)
+        self.created += 1
+        logger.info(f"Создана ссылка на оплату: тариф {plan.id}, {'продление' if is_extension else 'новая подписка'}")
+        return link
+
+    async def warm(self, bot, plans, provider_token) -> int:
+        """Создает недостающие ссылки для всех тарифов и видов; возвращает число готовых ссылок"""
+        results = await asyncio.gather(
+            *(self.get_or_create(bot, plan, is_extension, provider_token)
+              for plan in plans for is_extension in (False, True)),
+            return_exceptions=True
+        )
+        failed = [result for result in results if isinstance(result, Exception)]
+        if failed:
+            logger.warning(f"Не созданы {len(failed)} ссылок на оплату: {failed[0]}")
+        return len(results) - len(failed)
+
+    def warm_in_background(self, bot, plans, provider_token):
+        """Фоновое создание ссылок, если для каталога тарифов чего-то не хватает"""
+        if any(self.get(plan, is_extension, provider_token) is None
+               for plan in plans for is_extension in (False, True)):
+            return asyncio.create_task(self.warm(bot, plans, provider_token))
+        return None
+
+    def invalidate(self):
+        self._links.clear()
+
+    def stats(self) -> dict:
+        return {'links': len(self._links), 'created': self.created, 'hits': self.hits, 'errors': self.errors}
+
+
+invoice_links = InvoiceLinkCache()
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Как часто (сек) проверять цикл событий
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '0.5'))
+# Задержка (мс), после которой цикл считается зависшим и в лог пишется стек
+LOOP_LAG_THRESHOLD_MS = float(os.getenv('LOOP_LAG_THRESHOLD_MS', '250'))
+# Режим отладки asyncio для стейджинга: медленные колбэки с местом создания задачи
+LOOP_DEBUG = os.getenv('LOOP_DEBUG', 'False').lower() in ('true', '1', 't')
+LOOP_SLOW_CALLBACK_MS = float(os.getenv('LOOP_SLOW_CALLBACK_MS', '100'))
+# Сколько последних замеров хранить для перцентилей
+LAG_WINDOW = 1000
+
+
+def enable_loop_debug(loop=None, slow_callback_ms=LOOP_SLOW_CALLBACK_MS):
+    """
+    Отладка asyncio: колбэки дольше slow_callback_ms логируются логгером 'asyncio' вместе
+    с задачей и местом ее создания. Дорого, только для стейджинга.
+    """
+    loop = loop or asyncio.get_running_loop()
+    loop.set_debug(True)
+    loop.slow_callback_duration = slow_callback_ms / 1000
+    logging.getLogger('asyncio').setLevel(logging.WARNING)
+    logger.warning(f"Включен режим отладки asyncio: медленные колбэки от {slow_callback_ms:.0f} мс")
+
+
+class LoopWatchdog:
+    """
+    Сторожевой поток цикла событий. Раз в interval ставит в цикл «пульс» через
+    call_soon_threadsafe и ждет его выполнения: время до выполнения — задержка цикла.
+    Если пульс не выполнен за threshold, цикл занят синхронным кодом: поток берет
+    текущий кадр потока цикла (sys._current_frames) и текущую задачу и пишет стек в лог,
+    пока зависание еще продолжается.
+    """
+
+    def __init__(self, interval=LOOP_LAG_INTERVAL, threshold_ms=LOOP_LAG_THRESHOLD_MS, window=LAG_WINDOW):
+        self.interval = interval
+        self.threshold = threshold_ms / 1000
+        self.lags = deque(maxlen=window)
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.last_stall = None
+        self._loop = None
+        self._loop_thread_id = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self, loop=None):
+        """Запускает сторожевой поток для текущего цикла событий"""
+        if self._thread is not None:
+            return
+        self._loop = loop or asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='loop-watchdog', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + self.threshold + 1)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            beat = threading.Event()
+            sent = time.perf_counter()
+            try:
+                self._loop.call_soon_threadsafe(beat.set)
+            except RuntimeError:
+                return  # цикл закрыт
+            if not beat.wait(self.threshold):
+                self._report_stall(sent)
+                while not beat.wait(self.interval):
+                    if self._stop.is_set() or self._loop.is_closed():
+                        return
+            self._record(time.perf_counter() - sent)
+
+    def _record(self, lag):
+        self.lags.append(lag)
+        self.max_lag = max(self.max_lag, lag)
+
+    def _report_stall(self, sent):
+        self.stalls += 1
+        frame = sys._current_frames().get(self._loop_thread_id)
+        stack = "".join(traceback.format_stack(frame)) if frame is not None else "стек недоступен\n"
+        try:
+            task = asyncio.current_task(self._loop)
+        except RuntimeError:
+            task = None
+        task_name = task.get_name() if task is not None else "нет (колбэк цикла)"
+        coro = task.get_coro() if task is not None else None
+        self.last_stall = {
+            'at': time.time(),
+            'task': task_name,
+            'coro': getattr(coro, '__qualname__', repr(coro)) if coro is not None else None,
+        }
+        logger.warning(
+            "Цикл событий заблокирован дольше %.0f мс, задача %s (%s). Стек потока цикла:\n%s",
+            (time.perf_counter() - sent) * 1000, task_name, self.last_stall['coro'], stack,
+            extra={'category': 'loop_stall', 'task': task_name}
+        )
+
+    def percentile(self, q: float) -> float:
+        if not self.lags:
+            return 0.0
+        ordered = sorted(self.lags)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def stats(self) -> dict:
+        return {
+            'lag_last_ms': round(self.lags[-1] * 1000, 1) if self.lags else 0.0,
+            'lag_p50_ms': round(self.percentile(0.5) * 1000, 1),
+            'lag_p99_ms': round(self.percentile(0.99) * 1000, 1),
+            'lag_max_ms': round(self.max_lag * 1000, 1),
+            'stalls': self.stalls,
+            'last_stall_task': self.last_stall['task'] if self.last_stall else None,
+        }
+
+
+loop_watchdog = LoopWatchdog()
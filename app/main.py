@@ -1,50 +1,74 @@
+import os
+
+if __name__ == "__main__":
+    # Запуск скриптом: .env читается до импорта модулей, которые берут настройки из окружения.
+    # Импорт app.main (тесты, воркеры) окружение не трогает
+    from dotenv import load_dotenv
+    load_dotenv()
+
 import asyncio
 from aiogram import Bot, Dispatcher, types
 from aiogram import Router, types, F
 from aiogram.filters import Command
-import os
-from dotenv import load_dotenv
-
-# Загружаем переменные окружения в самом начале
-load_dotenv()
-
 from keyboards import get_inline_keyboard
 import logging
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
 from app.subscription_service import subscription_service, CHANNEL_IDS
-from app.database import User, UserSubscription, SubscriptionPlan, PaymentError, async_init_db
+from app.database import User, UserSubscription, SubscriptionPlan, PaymentError, async_init_db, prewarm_pool
 from aiogram.types import LabeledPrice
 from aiogram.types.message import ContentType
-from aiogram.types import ChatJoinRequest
+from aiogram.types import ChatJoinRequest, BufferedInputFile
 import traceback
+import time
 from datetime import datetime, timedelta
-from sqlalchemy import select
+from sqlalchemy import select, func
 from app.subscription_service import SubscriptionManager
 import json
 
 from entry_text import WELCOME_TEXT
 from app.scheduler import setup_scheduler, async_record_payment
+from app.query_stats import QueryStatsMiddleware, install_query_stats
+from app.slow_queries import install_slow_query_log
+from app.concurrency import UpdateConcurrencyMiddleware, UpdateReceivedMiddleware
+from app.rate_limiter import rate_limiter
+from app.bot_session import create_bot_session, format_pool_stats
+from app import profiling
+from app.stats_service import record_stat, get_stats_summary, format_stats
+from app.notifications import backfill_subscription_notifications, backfill_registration_reminders
+from app.migrations import add_telegram_id_columns, backfill_telegram_ids, telegram_id_column, run_data_migration
+from app.membership import record_membership
+from app.channel_workers import channel_workers
+from app.startup import StartupTimer
+from app.checkout import pre_checkout
+from app.invoice_links import invoice_links, INVOICE_LINKS, build_invoice, invoice_payload, parse_invoice_payload
+from app import runtime_profile
+from app.loop_watchdog import loop_watchdog, enable_loop_debug, LOOP_DEBUG
+from app.structured_logging import setup_logging, stop_logging, audit_extra, log_extra
+from app.broadcast_service import broadcast_service, AUDIENCES, format_progress, progress_keyboard
 
 
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-if not TELEGRAM_BOT_TOKEN:
-    raise ValueError('Не задан TELEGRAM_BOT_TOKEN в .env!')
 TELEGRAM_PAYMENT_TOKEN = os.getenv('TELEGRAM_PAYMENT_TOKEN')
-if not TELEGRAM_PAYMENT_TOKEN:
-    raise ValueError('Не задан TELEGRAM_PAYMENT_TOKEN в .env!')
 
 # Проверка тестового режима
 IS_TEST_MODE = os.getenv('PAYMENT_TEST_MODE', 'False').lower() in ('true', '1', 't')
-if IS_TEST_MODE and not TELEGRAM_PAYMENT_TOKEN.startswith('381764678:TEST:'):
-    logging.warning("Используется тестовый платежный токен для Юкассы")
+
+# Аудит платежей: записи не участвуют в выборке и не теряются при переполнении очереди логов
+payment_log = logging.getLogger('payments')
+PAYMENT_AUDIT = audit_extra('payment')
 
 # Создаем класс состояний для хранения выбора пользователя
 class SubscriptionStates(StatesGroup):
     #choosing_type = State()
     confirming_payment = State()
 
+# Состояния админской рассылки
+class BroadcastStates(StatesGroup):
+    waiting_text = State()
+    choosing_audience = State()
+
 
 def get_sanitized_payment_info(payment_info: types.SuccessfulPayment) -> str:
     """
@@ -68,20 +92,59 @@ def get_sanitized_payment_info(payment_info: types.SuccessfulPayment) -> str:
         return f"SuccessfulPayment(total_amount={getattr(payment_info, 'total_amount', 'unknown')}, currency='{getattr(payment_info, 'currency', 'unknown')}', order_info=[REDACTED])"
 
 
-# Хранилище состояний в памяти
-storage = MemoryStorage()
-bot = Bot(token=TELEGRAM_BOT_TOKEN)
-dp = Dispatcher(storage=storage)
-
-# Устанавливаем экземпляр бота в сервис подписок
-subscription_service.set_bot(bot)
+# Бот и диспетчер создаются в main() через create_bot()/create_dispatcher(): импорт модуля
+# не читает токены и не создает HTTP-сессию. Обработчики регистрируются на router
+bot = None
+router = Router()
+
+def create_bot(token=None) -> Bot:
+    """Бот с настроенной HTTP-сессией и общим лимитером запросов"""
+    token = token or TELEGRAM_BOT_TOKEN
+    if not token:
+        raise ValueError('Не задан TELEGRAM_BOT_TOKEN в .env!')
+    # Пул соединений, таймауты, orjson и свой сервер Bot API (TELEGRAM_API_BASE_URL) — в app/bot_session.py
+    new_bot = Bot(token=token, session=create_bot_session())
+    # Все запросы к Bot API проходят через общий лимитер (бакеты, обработка 429, приоритеты)
+    new_bot.session.middleware(rate_limiter)
+    return new_bot
+
+def create_dispatcher() -> Dispatcher:
+    """Диспетчер с хранилищем состояний в памяти, middleware апдейтов и обработчиками router"""
+    dp = Dispatcher(storage=MemoryStorage())
+    # Первым: время получения апдейта для замера задержки ответа (pre_checkout_query)
+    dp.update.outer_middleware(UpdateReceivedMiddleware())
+    # Апдейты одного пользователя — по очереди, общее число обработчиков ограничено
+    dp.update.outer_middleware(UpdateConcurrencyMiddleware(degraded_replies=DEGRADED_REPLIES))
+    # Учет запросов к БД на каждый апдейт (бюджеты и поиск N+1)
+    dp.update.outer_middleware(QueryStatsMiddleware())
+    dp.include_router(router)
+    return dp
+
+HELP_TEXT = '''🤝 Поддержка
 
+Если у вас есть вопрос - напишите мне @mariidori
+'''
+# Быстрые ответы, когда все слоты обработки апдейтов заняты (без обращения к БД)
+DEGRADED_REPLIES = {
+    '/start': "Сейчас у бота очень много запросов. Пожалуйста, отправьте /start еще раз через минуту 🙏",
+    '/help': HELP_TEXT,
+}
 # Загрузка списка администраторов из .env
 ADMIN_USER_IDS = os.getenv('ADMIN_USER_IDS', '').split(',')
 if not ADMIN_USER_IDS[0]:
     logging.warning("Не заданы ID администраторов (ADMIN_USER_IDS) в .env!")
 
-@dp.message(Command('start'))
+def format_invite_links(links) -> str:
+    """Ссылки для входа: одна — как раньше, для пакета тарифов — нумерованным списком"""
+    if len(links) == 1:
+        return f"Ссылка для входа в канал: {links[0]}"
+    return "Ссылки для входа в каналы:\n" + "\n".join(f"{i}. {link}" for i, link in enumerate(links, 1))
+
+def is_admin(msg) -> bool:
+    """Фильтр админских команд"""
+    return str(msg.from_user.id) in ADMIN_USER_IDS
+
+@router.message(Command('start'))
 async def start_command(message: types.Message, state: FSMContext):
     # При старте сбрасываем состояние
     await state.clear()
@@ -110,8 +173,8 @@ async def start_command(message: types.Message, state: FSMContext):
             f"Осталось дней: {days_left}"
         )
 
-        if subscription_info.get('invite_link'):
-            message_text += f"\n\nСсылка для входа в канал: {subscription_info['invite_link']}"
+        if subscription_info.get('invite_links'):
+            message_text += f"\n\n{format_invite_links(subscription_info['invite_links'])}"
             message_text += "\n\n⚠️ Эта ссылка доступна только вам. При переходе по ссылке вам нужно будет отправить запрос на вступление, который будет автоматически одобрен."
 
         await message.answer(message_text, reply_markup=await get_inline_keyboard(keyboard_type='manage_existing_subscription'))
@@ -129,7 +192,7 @@ async def start_command(message: types.Message, state: FSMContext):
         )
         await message.answer(text2, reply_markup=premium_keyboard)
 
-@dp.message(Command('subscription'))
+@router.message(Command('subscription'))
 async def manage_subscription(message: types.Message, state: FSMContext):
     # Проверяем, есть ли активная подписка у пользователя
     subscription_info = await subscription_service.get_subscription_info(message.from_user.id)
@@ -144,8 +207,8 @@ async def manage_subscription(message: types.Message, state: FSMContext):
         )
         
         # Если есть ссылка-приглашение, показываем её
-        if subscription_info.get('invite_link'):
-            message_text += f"\n\nСсылка для входа в канал: {subscription_info['invite_link']}"
+        if subscription_info.get('invite_links'):
+            message_text += f"\n\n{format_invite_links(subscription_info['invite_links'])}"
             message_text += "\n\n⚠️ Эта ссылка доступна только вам. При переходе по ссылке вам нужно будет отправить запрос на вступление, который будет автоматически одобрен."
         
         await message.answer(message_text, reply_markup=await get_inline_keyboard(keyboard_type='manage_existing_subscription'))
@@ -153,7 +216,7 @@ async def manage_subscription(message: types.Message, state: FSMContext):
         # Если подписки нет, предлагаем купить
         await message.answer('Выберите действие:', reply_markup=await get_inline_keyboard(keyboard_type='manage_subscription'))
 
-@dp.message(Command('details'))
+@router.message(Command('details'))
 async def details_command(message: types.Message):
     """
     Показывает дату окончания подписки и прямую ссылку на канал.
@@ -190,33 +253,35 @@ async def details_command(message: types.Message):
         await message.answer("❌ Активная подписка не найдена.")
 
 
-@dp.message(Command('help'))
+@router.message(Command('help'))
 async def help_command(message: types.Message, state: FSMContext):
     first_name = message.from_user.first_name or ''
-    text1 = '''🤝 Поддержка
-
-Если у вас есть вопрос - напишите мне @mariidori
-'''   
-    await message.answer(text1, parse_mode='HTML',
+    await message.answer(HELP_TEXT, parse_mode='HTML',
                          #reply_markup=await get_reply_keyboard(keyboard_type='start')
                         )
 
 
 # Обработчик запросов на вступление в канал
-@dp.chat_join_request()
+@router.chat_join_request()
 async def process_join_request(join_request: ChatJoinRequest):
     """Обрабатывает запросы на вступление в канал"""
     chat_id = join_request.chat.id
     user_id = join_request.from_user.id
     invite_link = join_request.invite_link.invite_link if join_request.invite_link else None
     
-    logging.info(f"Получен запрос на вступление в канал: user_id={user_id}, chat_id={chat_id}, invite_link={invite_link}")
+    logging.info("Получен запрос на вступление в канал: user_id=%s, chat_id=%s, invite_link=%s", user_id, chat_id, invite_link,
+                 extra=log_extra('join_request', user_id=user_id, chat_id=chat_id))
     
     # Базовая проверка - является ли канал одним из наших каналов с подписками
     if str(chat_id) not in CHANNEL_IDS.values():
         logging.warning(f"Получен запрос для неизвестного канала: {chat_id}")
         return
     
+    # Заявки канала обрабатываются в его очереди: медленный канал не задерживает остальные
+    await channel_workers.run(chat_id, _handle_join_request, chat_id, user_id, invite_link)
+
+
+async def _handle_join_request(chat_id, user_id, invite_link):
     # Если нет ссылки-приглашения, отклоняем запрос
     if not invite_link:
         logging.warning(f"Запрос без ссылки-приглашения от пользователя {user_id}")
@@ -224,24 +289,22 @@ async def process_join_request(join_request: ChatJoinRequest):
         return
     
     # Проверяем, что запрос идет от правильного пользователя
-    is_valid = await subscription_service.is_valid_join_request(invite_link, user_id)
+    is_valid = await subscription_service.is_valid_join_request(invite_link, user_id, chat_id=chat_id)
     if is_valid:
         # Одобряем запрос
         try:
             await bot.approve_chat_join_request(chat_id=chat_id, user_id=user_id)
-            logging.info(f"Одобрен запрос на вступление для пользователя {user_id}")
+            logging.info("Одобрен запрос на вступление для пользователя %s", user_id,
+                         extra=log_extra('join_request', user_id=user_id, chat_id=chat_id))
+            async with subscription_service.async_session_maker() as session:
+                await record_membership(session, chat_id, user_id, 'member')
+                await session.commit()
             
             # Отзываем ссылку сразу после одобрения
             try:
-                async with subscription_service.async_session_maker() as session:
-                    link_result = await session.execute(select(UserSubscription).where(UserSubscription.invite_link == invite_link))
-                    sub = link_result.scalar_one_or_none()
-                    if sub and sub.invite_link:
-                        await bot.revoke_chat_invite_link(chat_id=chat_id, invite_link=sub.invite_link)
-                        sub.invite_link = None
-                        session.add(sub)
-                        await session.commit()
-                        logging.info(f"Ссылка {invite_link} отозвана после успешного вступления пользователя {user_id}")
+                await subscription_service.revoke_used_invite(chat_id, invite_link)
+                logging.info("Ссылка %s отозвана после успешного вступления пользователя %s", invite_link, user_id,
+                             extra=log_extra('join_request', user_id=user_id, chat_id=chat_id))
             except Exception as e:
                 logging.error(f"Ошибка при отзыве ссылки после вступления: {str(e)}")
             
@@ -273,13 +336,32 @@ async def process_join_request(join_request: ChatJoinRequest):
             logging.error(f"Ошибка при отклонении запроса на вступление: {str(e)}")
 
 
-@dp.callback_query(F.data == 'buy_subscription')
+# Членство в каналах: вступление, выход, кик, одобрение заявки (бот — администратор канала)
+@router.chat_member()
+async def process_chat_member(update: types.ChatMemberUpdated):
+    """Сохраняет статус пользователя в channel_members, чтобы не спрашивать его у Telegram"""
+    if str(update.chat.id) not in CHANNEL_IDS.values():
+        return
+    member = update.new_chat_member
+    async with subscription_service.async_session_maker() as session:
+        await record_membership(session, update.chat.id, member.user.id, member.status,
+                                at=update.date.replace(tzinfo=None))
+        await session.commit()
+    logging.info("chat_member: пользователь %s в канале %s: %s -> %s",
+                 member.user.id, update.chat.id, update.old_chat_member.status, member.status,
+                 extra=log_extra('chat_member', user_id=member.user.id, chat_id=update.chat.id))
+
+
+@router.callback_query(F.data == 'buy_subscription')
 async def buy_subscription(callback: types.CallbackQuery, state: FSMContext):
     # Получаем актуальные тарифы
     plans = await subscription_service.get_active_plans()
     
     # Сортируем планы по цене
     plans.sort(key=lambda x: x.price)
+    if INVOICE_LINKS:
+        # Ссылки на оплату для новых или измененных тарифов — пока пользователь выбирает
+        invoice_links.warm_in_background(bot, plans, TELEGRAM_PAYMENT_TOKEN)
 
     keyboard_buttons = []
     for plan in plans:
@@ -293,20 +375,22 @@ async def buy_subscription(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.answer('Выберите подходящий тариф:', reply_markup=keyboard)
     await callback.answer()
 
-@dp.callback_query(F.data == 'change_subscription')
+@router.callback_query(F.data == 'change_subscription')
 async def change_subscription(callback: types.CallbackQuery, state: FSMContext):
     # Логика та же, что и при покупке - показываем список тарифов
     await buy_subscription(callback, state)
 
-@dp.callback_query(F.data.startswith('select_plan_'))
+@router.callback_query(F.data.startswith('select_plan_'))
 async def process_plan_selection(callback: types.CallbackQuery, state: FSMContext):
     try:
         plan_id = int(callback.data.split('_')[-1])
 
-        # Получаем план
-        async with subscription_service.async_session_maker() as session:
-            result = await session.execute(select(SubscriptionPlan).where(SubscriptionPlan.id == plan_id))
-            plan = result.scalar_one_or_none()
+        # Получаем план: из каталога тарифов в памяти, старые тарифы — из БД
+        plan = next((p for p in await subscription_service.get_active_plans() if p.id == plan_id), None)
+        if plan is None:
+            async with subscription_service.async_session_maker() as session:
+                result = await session.execute(select(SubscriptionPlan).where(SubscriptionPlan.id == plan_id))
+                plan = result.scalar_one_or_none()
 
         if not plan:
             await callback.message.answer("Ошибка: тариф не найден.")
@@ -317,43 +401,28 @@ async def process_plan_selection(callback: types.CallbackQuery, state: FSMContex
         logging.error(f"Error in process_plan_selection: {e}")
         await callback.message.answer("Произошла ошибка при выборе тарифа.")
 
-async def send_invoice_for_plan(callback, state, plan, edit=False, is_extension=False):
-    # preview_text = (
-    #     f"Вы выбрали {'продление подписки' if is_extension else 'подписку'}: {plan.name}\n"
-    #     f"Описание: {plan.description or '-'}\n"
-    #     f"Длительность: {plan.duration_days} дней\n"
-    #     f"Стоимость: {plan.price/100:.2f} руб.\n\n"
-    #     f"Нажмите кнопку ниже для оплаты:"
-    # )
-    # try:
-    #     if edit:
-    #         await callback.message.edit_text(preview_text)
-    #     else:
-    #         await callback.message.answer(preview_text)
-    # except Exception as e:
-    #     logging.error(f"Ошибка при отправке превью подписки: {str(e)}\nTRACEBACK: {traceback.format_exc()}")
-    #     await callback.message.answer(preview_text)
+async def send_invoice_for_plan(callback, state, plan, edit=False, is_extension=False, subscription_id=None):
+    # Режим INVOICE_LINKS: готовая ссылка на оплату из кэша, без sendInvoice (app/invoice_links.py)
+    if INVOICE_LINKS:
+        try:
+            link = await invoice_links.get_or_create(bot, plan, is_extension, TELEGRAM_PAYMENT_TOKEN)
+            pay_keyboard = types.InlineKeyboardMarkup(
+                inline_keyboard=[
+                    [types.InlineKeyboardButton(text=f"Оплатить {plan.price / 100:.0f}₽", url=link)],
+                    [types.InlineKeyboardButton(text="↩️ Назад к выбору тарифа", callback_data="back_to_plan_selection")]
+                ]
+            )
+            await callback.message.answer(
+                f"{'Продление подписки' if is_extension else 'Подписка'} {plan.name} на {plan.duration_days} дней",
+                reply_markup=pay_keyboard
+            )
+            logging.info(f"[INVOICE] Ссылка на оплату отправлена пользователю {callback.from_user.id}")
+            return
+        except Exception as e:
+            logging.error(f"[INVOICE][ERROR] Нет ссылки на оплату тарифа {plan.id}, отправляем счет: {e}")
+    # Продление: подписка в payload, состояние FSM для оплаты не нужно
+    payload = invoice_payload(plan.id, is_extension, subscription_id)
     try:
-        # Подготавливаем данные для чека (provider_data)
-        provider_data = {
-            "receipt": {
-                "items": [
-                    {
-                        "description": f"{'Продление подписки' if is_extension else 'Подписка'} {plan.name} на {plan.duration_days} дней",
-                        "quantity": 1.0,
-                        "amount": {
-                            "value": plan.price / 100,  # В рублях, а не копейках
-                            "currency": "RUB"
-                        },
-                        "vat_code": 1,  # НДС 20%
-                        "payment_mode": "full_payment",
-                        "payment_subject": "service"  # Услуга
-                    }
-                ],
-                "tax_system_code": 1  # Общая система налогообложения
-            }
-        }
-        provider_data_json = json.dumps(provider_data)
         # Клавиатура только для инвойса
         invoice_keyboard = types.InlineKeyboardMarkup(
             inline_keyboard=[
@@ -361,42 +430,26 @@ async def send_invoice_for_plan(callback, state, plan, edit=False, is_extension=
                 [types.InlineKeyboardButton(text="↩️ Назад к выбору тарифа", callback_data="back_to_plan_selection")]
             ]
         )
-        
-        # Формируем payload в зависимости от типа операции (новая подписка или продление)
-        payload = f"extend_{plan.id}" if is_extension else f"plan_{plan.id}"
-        
         invoice_message = await bot.send_invoice(
             chat_id=callback.from_user.id,
-            title=f"{'Продление подписки' if is_extension else 'Подписка'} {plan.name}",
-            description=f"Оплата {'продления доступа' if is_extension else 'доступа'} к тарифу {plan.name}, продолжительность - {plan.duration_days} дней",
-            payload=payload,
-            provider_token=TELEGRAM_PAYMENT_TOKEN,
-            currency="RUB",
-            prices=[LabeledPrice(label=plan.name, amount=plan.price)],
             start_parameter="subscription_payment",
-            need_name=False,
-            need_phone_number=False,
-            need_email=True,
-            send_email_to_provider=True,
-            need_shipping_address=False,
-            is_flexible=False,
             protect_content=True,
-            provider_data=provider_data_json,
-            reply_markup=invoice_keyboard
+            reply_markup=invoice_keyboard,
+            **build_invoice(plan, is_extension, TELEGRAM_PAYMENT_TOKEN, payload)
         )
         # Сохраняем id сообщений для удаления
         await state.update_data(preview_msg_id=callback.message.message_id, invoice_msg_id=invoice_message.message_id)
         logging.info(f"[INVOICE] Инвойс успешно отправлен пользователю {callback.from_user.id}")
     except Exception as e:
         logging.error(f"[INVOICE][ERROR] Ошибка при создании платежа: {str(e)}\nTRACEBACK: {traceback.format_exc()}")
-        logging.error(f"[INVOICE][ERROR] Параметры платежа при ошибке: chat_id={callback.from_user.id}, title={plan.name}, description=Оплата доступа к тарифу {plan.name}, продолжительность - {plan.duration_days} дней, payload=plan_{plan.id}, provider_token={TELEGRAM_PAYMENT_TOKEN}, currency=RUB, price={plan.price}, need_email=True, send_email_to_provider=True")
+        logging.error(f"[INVOICE][ERROR] Параметры платежа при ошибке: chat_id={callback.from_user.id}, title={plan.name}, description=Оплата доступа к тарифу {plan.name}, продолжительность - {plan.duration_days} дней, payload={payload}, provider_token={TELEGRAM_PAYMENT_TOKEN}, currency=RUB, price={plan.price}, need_email=True, send_email_to_provider=True")
         await callback.message.answer(
             f"Произошла ошибка при создании платежа: {str(e)}",
             # reply_markup=await get_reply_keyboard(keyboard_type='start')
         )
         await state.clear()
 
-# @dp.callback_query(SubscriptionStates.choosing_type, lambda c: c.data.startswith('plan_'))
+# @router.callback_query(SubscriptionStates.choosing_type, lambda c: c.data.startswith('plan_'))
 # async def process_subscription_plan(callback: types.CallbackQuery, state: FSMContext):
 #     plan_id = int(callback.data.replace('plan_', ''))
 #     # Получаем тариф из базы
@@ -410,19 +463,19 @@ async def send_invoice_for_plan(callback, state, plan, edit=False, is_extension=
 #     # Показываем превью и инвойс
 #     await send_invoice_for_plan(callback, state, plan, edit=True)
 
-@dp.callback_query(F.data == 'cancel_payment')
+@router.callback_query(F.data == 'cancel_payment')
 async def cancel_payment(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
     await callback.message.answer('Оплата отменена. Вы можете вернуться в главное меню',
                                   #reply_markup=await get_reply_keyboard(keyboard_type='start')
                                   )
 
-# @dp.callback_query(F.data == 'back_to_start')
+# @router.callback_query(F.data == 'back_to_start')
 # async def back_to_start(callback: types.CallbackQuery, state: FSMContext):
 #     await state.clear()
 #     await callback.message.answer('Вы вернулись в главное меню', reply_markup=await get_reply_keyboard(keyboard_type='start'))
 
-@dp.callback_query(F.data == 'cancel_subscription')
+@router.callback_query(F.data == 'cancel_subscription')
 async def cancel_subscription_request(callback: types.CallbackQuery, state: FSMContext):
     """Запрос на отмену подписки - показывает подтверждение"""
     await callback.message.answer(
@@ -431,7 +484,7 @@ async def cancel_subscription_request(callback: types.CallbackQuery, state: FSMC
     )
     await callback.answer()
 
-@dp.callback_query(F.data == 'extend_subscription')
+@router.callback_query(F.data == 'extend_subscription')
 async def extend_subscription(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
     user = await subscription_service.get_user_by_telegram_id(user_id)
@@ -456,16 +509,10 @@ async def extend_subscription(callback: types.CallbackQuery, state: FSMContext):
             )
         return
     
-    # Сохраняем информацию о текущей подписке в состоянии для использования после оплаты
-    await state.update_data(
-        extend_subscription_id=subscription.id,
-        plan_id=plan.id,
-    )
-    
-    # Отправляем инвойс для оплаты продления
-    await send_invoice_for_plan(callback, state, plan, edit=False, is_extension=True)
+    # Отправляем инвойс для оплаты продления (ID подписки — в payload счета)
+    await send_invoice_for_plan(callback, state, plan, edit=False, is_extension=True, subscription_id=subscription.id)
 
-@dp.callback_query(F.data == 'confirm_cancel_subscription')
+@router.callback_query(F.data == 'confirm_cancel_subscription')
 async def confirm_cancel_subscription(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
     user = await subscription_service.get_user_by_telegram_id(user_id)
@@ -501,7 +548,7 @@ async def confirm_cancel_subscription(callback: types.CallbackQuery, state: FSMC
     logging.info(f"[CANCEL] Передаю подписку {subscription.id} с channel_id={subscription.channel_id} в remove_user_access")
     
     # Отзываем доступ
-    success = await subscription_service.remove_user_access(subscription)
+    success = await subscription_service.remove_user_access(subscription, reason='cancelled')
     
     # Проверяем статус подписки после отмены
     async with subscription_service.async_session_maker() as session:
@@ -522,61 +569,97 @@ async def confirm_cancel_subscription(callback: types.CallbackQuery, state: FSMC
     
     await callback.answer()
 
+async def resolve_extension_subscription(telegram_id, subscription_id=None):
+    """
+    ID активной подписки плательщика для продления: из payload, если она его, иначе его активная
+    подписка с самым поздним окончанием; None — продлевать нечего
+    """
+    user = await subscription_service.get_user_by_telegram_id(telegram_id)
+    async with subscription_service.async_session_maker() as session:
+        query = select(UserSubscription.id).where(UserSubscription.user_id == user.id, UserSubscription.is_active == True)
+        if subscription_id is not None:
+            result = await session.execute(query.where(UserSubscription.id == subscription_id))
+            if result.scalar_one_or_none() is not None:
+                return subscription_id
+        result = await session.execute(query.order_by(UserSubscription.end_date.desc()).limit(1))
+        return result.scalar_one_or_none()
+
 # Обработчик предварительной проверки платежа (обязательно нужен для работы платежей)
-@dp.pre_checkout_query()
-async def process_pre_checkout_query(pre_checkout_query: types.PreCheckoutQuery):
-    logging.info(f"[PRE_CHECKOUT] Получен pre_checkout_query: {pre_checkout_query}")
+@router.pre_checkout_query()
+async def process_pre_checkout_query(pre_checkout_query: types.PreCheckoutQuery, update_received: float | None = None):
+    # Задержка ответа считается от получения апдейта, а не от входа в обработчик
+    started = update_received if update_received is not None else time.perf_counter()
+    payload = pre_checkout_query.invoice_payload
+    logging.info(f"[PRE_CHECKOUT] Получен pre_checkout_query {pre_checkout_query.id}: payload={payload}")
     try:
-        payload = pre_checkout_query.invoice_payload
-        logging.info(f"[PRE_CHECKOUT] Payload: {payload}")
-        
-        if payload.startswith('plan_') or payload.startswith('extend_'):
+        # Тариф, сумма и незавершенная оплата — из памяти, с бюджетом времени (app/checkout.py)
+        error_message = await pre_checkout.check(pre_checkout_query)
+        if error_message is None:
             await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
             logging.info(f"[PRE_CHECKOUT] Pre-checkout подтвержден для запроса {pre_checkout_query.id}")
         else:
-            logging.error(f"[PRE_CHECKOUT][ERROR] Некорректный формат payload: {payload}")
-            await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=False, error_message="Ошибка обработки платежа: некорректный формат данных.")
+            logging.error(f"[PRE_CHECKOUT][ERROR] Отказ для запроса {pre_checkout_query.id}, payload {payload}: {error_message}")
+            await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=False, error_message=error_message)
     except Exception as e:
         logging.error(f"[PRE_CHECKOUT][ERROR] Ошибка при обработке pre_checkout_query: {str(e)}\nTRACEBACK: {traceback.format_exc()}")
         await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=False, error_message="Ошибка обработки платежа. Пожалуйста, попробуйте позже.")
+    finally:
+        pre_checkout.record_answer(time.perf_counter() - started)
 
 
 # Обработчик успешной оплаты
-@dp.message(F.content_type == ContentType.SUCCESSFUL_PAYMENT)
+@router.message(F.content_type == ContentType.SUCCESSFUL_PAYMENT)
 async def process_successful_payment(message: types.Message, state: FSMContext):
-    logging.info(f"[PAYMENT] Получено уведомление об успешном платеже: {get_sanitized_payment_info(message.successful_payment)}")
+    payment_log.info("[PAYMENT] Получено уведомление об успешном платеже: %s", get_sanitized_payment_info(message.successful_payment),
+                     extra=audit_extra('payment', user_id=message.from_user.id))
+    # Оплата завершена: пользователь снова может начать новую
+    pre_checkout.pending.complete(message.from_user.id)
     try:
         payment_info = message.successful_payment
         payload = payment_info.invoice_payload
         provider_payment_charge_id = payment_info.provider_payment_charge_id
         # Не логируем order_info напрямую, так как он содержит персональные данные (email)
-        logging.info(f"[PAYMENT] payload={payload}, charge_id={provider_payment_charge_id}, сумма={payment_info.total_amount}, валюта={payment_info.currency}, order_info=[REDACTED]")
+        payment_log.info("[PAYMENT] payload=%s, charge_id=%s, сумма=%s, валюта=%s, order_info=[REDACTED]",
+                         payload, provider_payment_charge_id, payment_info.total_amount, payment_info.currency,
+                         extra=audit_extra('payment', user_id=message.from_user.id, charge_id=provider_payment_charge_id))
         
         # Обработка различных типов платежей
-        if payload.startswith('plan_'):
+        parsed_payload = parse_invoice_payload(payload)
+        kind = parsed_payload[0] if parsed_payload else None
+        if kind == 'extend':
+            # Подписка из payload счета; у общей ссылки на оплату — активная подписка плательщика
+            extend_subscription_id = await resolve_extension_subscription(message.from_user.id, parsed_payload[2])
+            if extend_subscription_id is None:
+                # Продлевать нечего (подписка истекла или оплата по общей ссылке без подписки),
+                # а деньги уже списаны — оформляем новую подписку на оплаченный тариф
+                payment_log.warning("[PAYMENT][EXTEND] Нет активной подписки у пользователя %s, оформляем новую по тарифу %s",
+                                    message.from_user.id, parsed_payload[1], extra=PAYMENT_AUDIT)
+                kind = 'plan'
+        if kind == 'plan':
             # Создание новой подписки
-            plan_id = int(payload.replace('plan_', ''))
+            plan_id = parsed_payload[1]
             try:
                 # КРИТИЧЕСКАЯ ОПЕРАЦИЯ: создание подписки
-                logging.info(f"[PAYMENT] Начинаем создание подписки для пользователя {message.from_user.id}, план {plan_id}")
+                payment_log.debug("[PAYMENT] Начинаем создание подписки для пользователя %s, план %s", message.from_user.id, plan_id)
                 subscription_id = await subscription_service.create_subscription(
                     message.from_user.id, 
-                    plan_id=plan_id
+                    plan_id=plan_id,
+                    payment_amount=payment_info.total_amount
                 )
-                logging.info(f"[PAYMENT] Подписка успешно создана с ID={subscription_id}")
+                payment_log.debug("[PAYMENT] Подписка успешно создана с ID=%s", subscription_id)
                 
                 # Сохраняем provider_payment_charge_id в подписке в новой сессии
                 async with subscription_service.async_session_maker() as session:
                     result = await session.execute(select(UserSubscription).where(UserSubscription.id == subscription_id))
                     sub = result.scalar_one_or_none()
                     if sub:
-                        logging.info(f"[PAYMENT] Найдена подписка для сохранения charge_id: {sub}")
+                        payment_log.debug("[PAYMENT] Найдена подписка для сохранения charge_id: %s", sub)
                         sub.provider_payment_charge_id = provider_payment_charge_id
                         session.add(sub)
                         await session.commit()
-                        logging.info(f"[PAYMENT] Сохранён provider_payment_charge_id в подписке: {sub}")
+                        payment_log.debug("[PAYMENT] Сохранён provider_payment_charge_id в подписке: %s", sub)
                     else:
-                        logging.error(f"[PAYMENT][ERROR] Не удалось найти подписку для сохранения charge_id")
+                        payment_log.error("[PAYMENT][ERROR] Не удалось найти подписку для сохранения charge_id", extra=PAYMENT_AUDIT)
                 # Получаем информацию о плане для формирования ответа
                 plan = None
                 subscription = None
@@ -595,16 +678,20 @@ async def process_successful_payment(message: types.Message, state: FSMContext):
                 response_text = f"✅ Оплата успешно выполнена!\n\n"
                 response_text += f"Подписка: {plan.name}\n"
                 response_text += f"Срок действия: до {subscription.end_date.strftime('%d.%m.%Y')}\n\n"
-                if hasattr(subscription, 'invite_link') and subscription.invite_link:
-                    response_text += f"Ссылка для входа в канал: {subscription.invite_link}\n"
+                invite_links = await subscription_service.get_invite_links(subscription.id)
+                if invite_links:
+                    response_text += f"{format_invite_links(invite_links)}\n"
                     response_text += "⚠️ Перейдя по ссылке, нажмите 'Запросить вступление'. Ваш запрос будет автоматически одобрен."
                 await message.answer(
                     response_text,
                     #reply_markup=await get_reply_keyboard(keyboard_type='start')
                     )
-                logging.info(f"[PAYMENT] Подписка успешно создана для пользователя {message.from_user.id}, план {plan_id}, charge_id={provider_payment_charge_id}")
+                payment_log.info("[PAYMENT] Подписка успешно создана для пользователя %s, план %s, charge_id=%s",
+                                 message.from_user.id, plan_id, provider_payment_charge_id,
+                                 extra=audit_extra('payment', user_id=message.from_user.id, plan_id=plan_id,
+                                                   subscription_id=subscription_id, charge_id=provider_payment_charge_id))
                 # Логируем содержимое подписки из базы
-                logging.info(f"[PAYMENT] Итоговое состояние подписки в базе: {subscription}")
+                payment_log.debug("[PAYMENT] Итоговое состояние подписки в базе: %s", subscription)
 
                 # Запись в Google Sheets через Scheduler (async wrapper)
                 try:
@@ -617,19 +704,19 @@ async def process_successful_payment(message: types.Message, state: FSMContext):
                         payment_type="Новая",
                         transaction_id=provider_payment_charge_id
                     ))
-                    logging.info(f"[PAYMENT] Задача записи в Google Sheets отправлена в фоновом режиме")
+                    payment_log.debug("[PAYMENT] Задача записи в Google Sheets отправлена в фоновом режиме")
                 except Exception as gs_error:
-                    logging.error(f"[PAYMENT][ERROR] Ошибка при отправке задачи записи в Google Sheets: {gs_error}")
+                    payment_log.error(f"[PAYMENT][ERROR] Ошибка при отправке задачи записи в Google Sheets: {gs_error}", extra=PAYMENT_AUDIT)
 
             except Exception as e:
                 stack_trace = traceback.format_exc()
-                logging.critical(f"[PAYMENT][CRITICAL_ERROR] Ошибка при создании подписки после оплаты: {str(e)}\nTRACEBACK: {stack_trace}")
+                payment_log.critical(f"[PAYMENT][CRITICAL_ERROR] Ошибка при создании подписки после оплаты: {str(e)}\nTRACEBACK: {stack_trace}", extra=PAYMENT_AUDIT)
                 
                 # Сохраняем информацию об ошибке в базу данных
                 try:
                     async with subscription_service.async_session_maker() as session:
                         payment_error = PaymentError(
-                            telegram_user_id=str(message.from_user.id),
+                            telegram_id=message.from_user.id,
                             plan_id=plan_id,
                             provider_payment_charge_id=provider_payment_charge_id,
                             payment_amount=payment_info.total_amount,
@@ -641,7 +728,8 @@ async def process_successful_payment(message: types.Message, state: FSMContext):
                         )
                         session.add(payment_error)
                         await session.commit()
-                        logging.info(f"[PAYMENT][ERROR_SAVED] Информация об ошибке сохранена в базу данных с ID={payment_error.id}")
+                        payment_log.info("[PAYMENT][ERROR_SAVED] Информация об ошибке сохранена в базу данных с ID=%s", payment_error.id,
+                                         extra=audit_extra('payment', user_id=message.from_user.id, payment_error_id=payment_error.id))
 
                         # Уведомление администратора
                         for admin_id in ADMIN_USER_IDS:
@@ -661,7 +749,7 @@ async def process_successful_payment(message: types.Message, state: FSMContext):
                                 logging.error(f"Не удалось отправить уведомление админу {admin_id}: {admin_notify_error}")
 
                 except Exception as db_error:
-                    logging.critical(f"[PAYMENT][DB_ERROR] Не удалось сохранить информацию об ошибке в базу данных: {str(db_error)}")
+                    payment_log.critical(f"[PAYMENT][DB_ERROR] Не удалось сохранить информацию об ошибке в базу данных: {str(db_error)}", extra=PAYMENT_AUDIT)
                 
                 # Экстренное сохранение информации о платеже в логах для ручного восстановления
                 emergency_info = {
@@ -672,26 +760,20 @@ async def process_successful_payment(message: types.Message, state: FSMContext):
                     "payment_info": get_sanitized_payment_info(payment_info),
                     "error": str(e)
                 }
-                logging.critical(f"[PAYMENT][EMERGENCY] Данные платежа для ручного восстановления: {emergency_info}")
+                payment_log.critical(f"[PAYMENT][EMERGENCY] Данные платежа для ручного восстановления: {emergency_info}", extra=PAYMENT_AUDIT)
                 
                 await message.answer(
                     "⚠️ Платеж выполнен, но возникла техническая ошибка при активации подписки. Наши специалисты уже работают над этим и восстановят ваш доступ в ближайшее время. Пожалуйста, сохраните этот чат для подтверждения оплаты.", 
                     #reply_markup=await get_reply_keyboard(keyboard_type='start')
                     )
         
-        elif payload.startswith('extend_'):
+        elif kind == 'extend':
             # Продление существующей подписки
-            plan_id = int(payload.replace('extend_', ''))
+            plan_id = parsed_payload[1]
+            subscription_id = extend_subscription_id
             
             try:
-                # Получаем данные из состояния
-                user_data = await state.get_data()
-                subscription_id = user_data.get('extend_subscription_id')
-                
-                if not subscription_id:
-                    raise ValueError("Не найден ID подписки для продления")
-                
-                logging.info(f"[PAYMENT][EXTEND] Начинаем продление подписки ID={subscription_id}, план {plan_id}")
+                payment_log.debug("[PAYMENT][EXTEND] Начинаем продление подписки ID=%s, план %s", subscription_id, plan_id)
                 
                 # Получаем информацию о плане
                 async with subscription_service.async_session_maker() as session:
@@ -710,26 +792,18 @@ async def process_successful_payment(message: types.Message, state: FSMContext):
                     
                     # Сохраняем информацию о платеже
                     subscription.provider_payment_charge_id = provider_payment_charge_id
+                    await record_stat(session, plan.id, extended_count=1, revenue=payment_info.total_amount)
                     
                     await session.commit()
                 
                 # Генерируем новую ссылку-приглашение
-                invite_link = None
-                user = await subscription_service.get_user_by_telegram_id(message.from_user.id)
-                
-                if plan.channel_id and subscription_service.bot:
+                invite_links = []
+                if subscription_service.bot:
                     try:
-                        invite_link = await subscription_service.create_channel_invite(plan.channel_id, user.telegram_user_id)
-                        async with subscription_service.async_session_maker() as session:
-                            result = await session.execute(select(UserSubscription).where(UserSubscription.id == subscription.id))
-                            sub = result.scalar_one_or_none()
-                            if sub:
-                                sub.invite_link = invite_link
-                                session.add(sub)
-                                await session.commit()
+                        invite_links = await subscription_service.create_subscription_invites(message.from_user.id)
                     except Exception as e:
-                        logging.error(f"[PAYMENT][EXTEND] Ошибка при создании ссылки-приглашения: {str(e)}")
-                        invite_link = None
+                        payment_log.error(f"[PAYMENT][EXTEND] Ошибка при создании ссылки-приглашения: {str(e)}", extra=PAYMENT_AUDIT)
+                        invite_links = []
                 
                 # Формируем ответ
                 end_date = subscription.end_date.strftime('%d.%m.%Y')
@@ -737,15 +811,18 @@ async def process_successful_payment(message: types.Message, state: FSMContext):
                 response_text += f"Подписка продлена: {plan.name}\n"
                 response_text += f"Срок действия: до {end_date}\n\n"
                 
-                if invite_link:
-                    response_text += f"Ваша новая ссылка для входа в канал: {invite_link}\n"
+                if invite_links:
+                    response_text += f"{format_invite_links(invite_links)}\n"
                     response_text += "⚠️ Перейдя по ссылке, нажмите 'Запросить вступление'. Ваш запрос будет автоматически одобрен."
                 
                 await message.answer(
                     response_text,
                     #reply_markup=await get_reply_keyboard(keyboard_type='start')
                     )
-                logging.info(f"[PAYMENT][EXTEND] Подписка успешно продлена для пользователя {message.from_user.id}, ID={subscription.id}, план {plan_id}")
+                payment_log.info("[PAYMENT][EXTEND] Подписка успешно продлена для пользователя %s, ID=%s, план %s",
+                                 message.from_user.id, subscription.id, plan_id,
+                                 extra=audit_extra('payment', user_id=message.from_user.id, plan_id=plan_id,
+                                                   subscription_id=subscription.id, charge_id=provider_payment_charge_id))
             
                 # Запись в Google Sheets через Scheduler (async wrapper)
                 try:
@@ -758,19 +835,19 @@ async def process_successful_payment(message: types.Message, state: FSMContext):
                         payment_type="Продление",
                         transaction_id=provider_payment_charge_id
                     ))
-                    logging.info(f"[PAYMENT][EXTEND] Задача записи в Google Sheets отправлена в фоновом режиме")
+                    payment_log.debug("[PAYMENT][EXTEND] Задача записи в Google Sheets отправлена в фоновом режиме")
                 except Exception as gs_error:
-                    logging.error(f"[PAYMENT][EXTEND][ERROR] Ошибка при отправке задачи записи в Google Sheets: {gs_error}")
+                    payment_log.error(f"[PAYMENT][EXTEND][ERROR] Ошибка при отправке задачи записи в Google Sheets: {gs_error}", extra=PAYMENT_AUDIT)
 
             except Exception as e:
                 stack_trace = traceback.format_exc()
-                logging.critical(f"[PAYMENT][EXTEND][ERROR] Ошибка при продлении подписки: {str(e)}\nTRACEBACK: {stack_trace}")
+                payment_log.critical(f"[PAYMENT][EXTEND][ERROR] Ошибка при продлении подписки: {str(e)}\nTRACEBACK: {stack_trace}", extra=PAYMENT_AUDIT)
                 
                 # Сохраняем информацию об ошибке
                 try:
                     async with subscription_service.async_session_maker() as session:
                         payment_error = PaymentError(
-                            telegram_user_id=str(message.from_user.id),
+                            telegram_id=message.from_user.id,
                             plan_id=plan_id,
                             provider_payment_charge_id=provider_payment_charge_id,
                             payment_amount=payment_info.total_amount,
@@ -782,7 +859,8 @@ async def process_successful_payment(message: types.Message, state: FSMContext):
                         )
                         session.add(payment_error)
                         await session.commit()
-                        logging.info(f"[PAYMENT][EXTEND][ERROR_SAVED] Информация об ошибке продления сохранена в БД с ID={payment_error.id}")
+                        payment_log.info("[PAYMENT][EXTEND][ERROR_SAVED] Информация об ошибке продления сохранена в БД с ID=%s", payment_error.id,
+                                         extra=audit_extra('payment', user_id=message.from_user.id, payment_error_id=payment_error.id))
 
                         # Уведомление администратора
                         for admin_id in ADMIN_USER_IDS:
@@ -802,14 +880,14 @@ async def process_successful_payment(message: types.Message, state: FSMContext):
                                 logging.error(f"Не удалось отправить уведомление админу {admin_id}: {admin_notify_error}")
 
                 except Exception as db_error:
-                    logging.critical(f"[PAYMENT][EXTEND][DB_ERROR] Не удалось сохранить информацию об ошибке в БД: {str(db_error)}")
+                    payment_log.critical(f"[PAYMENT][EXTEND][DB_ERROR] Не удалось сохранить информацию об ошибке в БД: {str(db_error)}", extra=PAYMENT_AUDIT)
                 
                 await message.answer("⚠️ Платеж выполнен, но возникла техническая ошибка при продлении подписки. Наши специалисты уже работают над этим и скоро восстановят ваш доступ.", 
                                    #reply_markup=await get_reply_keyboard(keyboard_type='start')
                                    )
         
         else:
-            logging.error(f"[PAYMENT][ERROR] Некорректный формат payload после оплаты: {payload}")
+            payment_log.error(f"[PAYMENT][ERROR] Некорректный формат payload после оплаты: {payload}", extra=PAYMENT_AUDIT)
             await message.answer("Произошла ошибка при обработке платежа. Пожалуйста, обратитесь в поддержку.", 
                                #reply_markup=await get_reply_keyboard(keyboard_type='start')
                                )
@@ -817,14 +895,14 @@ async def process_successful_payment(message: types.Message, state: FSMContext):
             
     except Exception as e:
         stack_trace = traceback.format_exc()
-        logging.error(f"[PAYMENT][ERROR] Ошибка при обработке успешного платежа: {str(e)}\nTRACEBACK: {stack_trace}")
+        payment_log.error(f"[PAYMENT][ERROR] Ошибка при обработке успешного платежа: {str(e)}\nTRACEBACK: {stack_trace}", extra=PAYMENT_AUDIT)
         
         # Пытаемся сохранить информацию об ошибке в базу данных, даже если не удалось получить детали платежа
         try:
             if 'payment_info' in locals():
                 async with subscription_service.async_session_maker() as session:
                     payment_error = PaymentError(
-                        telegram_user_id=str(message.from_user.id),
+                        telegram_id=message.from_user.id,
                         provider_payment_charge_id=getattr(payment_info, 'provider_payment_charge_id', 'unknown'),
                         payment_amount=getattr(payment_info, 'total_amount', None),
                         payment_currency=getattr(payment_info, 'currency', None),
@@ -835,9 +913,10 @@ async def process_successful_payment(message: types.Message, state: FSMContext):
                     )
                     session.add(payment_error)
                     await session.commit()
-                    logging.info(f"[PAYMENT][ERROR_SAVED] Информация об общей ошибке сохранена в базу данных с ID={payment_error.id}")
+                    payment_log.info("[PAYMENT][ERROR_SAVED] Информация об общей ошибке сохранена в базу данных с ID=%s", payment_error.id,
+                                     extra=audit_extra('payment', user_id=message.from_user.id, payment_error_id=payment_error.id))
         except Exception as db_error:
-            logging.critical(f"[PAYMENT][DB_ERROR] Не удалось сохранить информацию об общей ошибке в базу данных: {str(db_error)}")
+            payment_log.critical(f"[PAYMENT][DB_ERROR] Не удалось сохранить информацию об общей ошибке в базу данных: {str(db_error)}", extra=PAYMENT_AUDIT)
         
         await message.answer("Произошла ошибка при обработке платежа. Пожалуйста, обратитесь в поддержку.", 
                            #reply_markup=await get_reply_keyboard(keyboard_type='start')
@@ -846,7 +925,7 @@ async def process_successful_payment(message: types.Message, state: FSMContext):
         await state.clear()
 
 # Добавляем обработчик для кнопки "Назад к выбору тарифа"
-# @dp.callback_query(F.data == 'back_to_plan_selection')
+# @router.callback_query(F.data == 'back_to_plan_selection')
 # async def back_to_plan_selection(callback: types.CallbackQuery, state: FSMContext):
 #     # Получаем id сообщений для удаления
 #     data = await state.get_data()
@@ -875,32 +954,166 @@ async def process_successful_payment(message: types.Message, state: FSMContext):
 #     await callback.answer()
 
 # Admin commands
-@dp.message(Command('payment_errors'), lambda msg: str(msg.from_user.id) in ADMIN_USER_IDS)
-async def show_payment_errors(message: types.Message, state: FSMContext):
-    """Показать неразрешенные ошибки платежей (только для админов)"""
+PAYMENT_ERRORS_PAGE_SIZE = 10
+# Сколько символов payment_info / stack_trace показываем в карточке ошибки (лимит сообщения — 4096)
+PAYMENT_ERROR_TEXT_LIMIT = 1500
+
+def _short(text, limit):
+    text = ' '.join((text or '').split())
+    return text if len(text) <= limit else text[:limit - 1] + '…'
+
+async def load_payment_error_groups(cursor=None, direction='next', limit=None):
+    """
+    Неразрешенные ошибки, сгруппированные по тексту ошибки. Keyset-пагинация по max(id) группы:
+    direction='next' — группы старше cursor, 'prev' — новее. Возвращает (группы, есть_еще).
+    """
+    limit = limit or PAYMENT_ERRORS_PAGE_SIZE
+    last_id = func.max(PaymentError.id)
+    query = (
+        select(PaymentError.error_message, func.count(PaymentError.id), last_id, func.max(PaymentError.payment_time))
+        .where(PaymentError.is_resolved == False)
+        .group_by(PaymentError.error_message)
+    )
+    if cursor is not None:
+        query = query.having(last_id < cursor if direction == 'next' else last_id > cursor)
+    query = query.order_by(last_id.desc() if direction == 'next' else last_id.asc()).limit(limit + 1)
     async with subscription_service.async_session_maker() as session:
-        result = await session.execute(select(PaymentError).where(PaymentError.is_resolved == False))
-        errors = result.scalars().all()
-    
-    if not errors:
+        rows = (await session.execute(query)).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == 'prev':
+        rows.reverse()
+    return rows, has_more
+
+async def render_payment_error_groups(cursor=None, direction='next'):
+    """Текст и клавиатура страницы групп ошибок (None, None — если ошибок нет)"""
+    groups, has_more = await load_payment_error_groups(cursor, direction)
+    if not groups:
+        if cursor is None:
+            return None, None
+        # Страница опустела (ошибки разрешили) — показываем первую
+        return await render_payment_error_groups()
+
+    async with subscription_service.async_session_maker() as session:
+        total = (await session.execute(
+            select(func.count(PaymentError.id)).where(PaymentError.is_resolved == False)
+        )).scalar_one()
+
+    lines = [f"🚨 Неразрешенные ошибки платежей: {total}", ""]
+    buttons = []
+    for i, (error_message, count, last_id, last_time) in enumerate(groups, 1):
+        lines.append(f"{i}. {count}× {_short(error_message, 120)}\n    последняя: #{last_id}, {last_time.strftime('%d.%m.%Y %H:%M')}")
+        buttons.append([types.InlineKeyboardButton(text=f"{i}. {count}× {_short(error_message, 40)}", callback_data=f"pe_grp:{last_id}")])
+
+    has_prev = has_more if direction == 'prev' else cursor is not None
+    has_next = has_more if direction == 'next' else True
+    nav = []
+    if has_prev:
+        nav.append(types.InlineKeyboardButton(text="◀️ Новее", callback_data=f"pe_page:p:{groups[0][2]}"))
+    if has_next:
+        nav.append(types.InlineKeyboardButton(text="Старее ▶️", callback_data=f"pe_page:n:{groups[-1][2]}"))
+    if nav:
+        buttons.append(nav)
+    return '\n'.join(lines), types.InlineKeyboardMarkup(inline_keyboard=buttons)
+
+async def render_payment_error_group(anchor_id, cursor=None):
+    """Ошибки одной группы (с тем же текстом, что у ошибки anchor_id), только сводные колонки"""
+    async with subscription_service.async_session_maker() as session:
+        error_message = (await session.execute(
+            select(PaymentError.error_message).where(PaymentError.id == anchor_id)
+        )).scalar_one_or_none()
+        if error_message is None:
+            return None, None
+        query = (
+            select(PaymentError.id, telegram_id_column(PaymentError), PaymentError.payment_time,
+                   PaymentError.payment_amount, PaymentError.payment_currency, PaymentError.plan_id)
+            .where(PaymentError.is_resolved == False, PaymentError.error_message == error_message)
+            .order_by(PaymentError.id.desc())
+            .limit(PAYMENT_ERRORS_PAGE_SIZE + 1)
+        )
+        if cursor is not None:
+            query = query.where(PaymentError.id < cursor)
+        rows = (await session.execute(query)).all()
+
+    has_next = len(rows) > PAYMENT_ERRORS_PAGE_SIZE
+    rows = rows[:PAYMENT_ERRORS_PAGE_SIZE]
+    lines = [f"🚨 {_short(error_message, 300)}", ""]
+    buttons = []
+    for error_id, user_id, payment_time, amount, currency, plan_id in rows:
+        lines.append(
+            f"#{error_id} · {payment_time.strftime('%d.%m.%Y %H:%M')} · пользователь {user_id} · "
+            f"{amount / 100 if amount else 'N/A'} {currency or ''} · план {plan_id or 'N/A'}"
+        )
+        buttons.append([types.InlineKeyboardButton(text=f"#{error_id} — подробнее", callback_data=f"pe_err:{error_id}")])
+    nav = [types.InlineKeyboardButton(text="⬅️ К группам", callback_data="pe_page")]
+    if has_next and rows:
+        nav.append(types.InlineKeyboardButton(text="Старее ▶️", callback_data=f"pe_grp:{anchor_id}:{rows[-1][0]}"))
+    buttons.append(nav)
+    return '\n'.join(lines), types.InlineKeyboardMarkup(inline_keyboard=buttons)
+
+@router.message(Command('payment_errors'), is_admin)
+async def show_payment_errors(message: types.Message, state: FSMContext):
+    """Неразрешенные ошибки платежей, сгруппированные по тексту ошибки, с пагинацией (только для админов)"""
+    text, keyboard = await render_payment_error_groups()
+    if not text:
         await message.answer("Нет неразрешенных ошибок платежей.")
         return
-    
-    for error in errors:
-        error_text = (
-            f"🚨 Ошибка платежа #{error.id}:\n"
-            f"Пользователь: {error.telegram_user_id}\n"
-            f"Время платежа: {error.payment_time.strftime('%d.%m.%Y %H:%M:%S')}\n"
-            f"ID транзакции: {error.provider_payment_charge_id}\n"
-            f"Сумма: {error.payment_amount/100 if error.payment_amount else 'N/A'} {error.payment_currency or 'N/A'}\n"
-            f"План: {error.plan_id or 'N/A'}\n"
-            f"Ошибка: {error.error_message}\n\n"
-            f"Для разрешения используйте команду:\n"
-            f"/resolve_payment_error {error.id} <причина решения>"
-        )
-        await message.answer(error_text)
+    await message.answer(text, reply_markup=keyboard)
+
+@router.callback_query(F.data.startswith('pe_page'), is_admin)
+async def payment_errors_page(callback: types.CallbackQuery):
+    """Листание групп ошибок: pe_page (первая страница), pe_page:n:<id>, pe_page:p:<id>"""
+    parts = callback.data.split(':')
+    if len(parts) == 3:
+        text, keyboard = await render_payment_error_groups(int(parts[2]), 'next' if parts[1] == 'n' else 'prev')
+    else:
+        text, keyboard = await render_payment_error_groups()
+    await callback.message.edit_text(text or "Нет неразрешенных ошибок платежей.", reply_markup=keyboard)
+    await callback.answer()
+
+@router.callback_query(F.data.startswith('pe_grp:'), is_admin)
+async def payment_errors_group(callback: types.CallbackQuery):
+    """Ошибки одной группы: pe_grp:<id ошибки из группы>[:<курсор>]"""
+    parts = callback.data.split(':')
+    cursor = int(parts[2]) if len(parts) > 2 else None
+    text, keyboard = await render_payment_error_group(int(parts[1]), cursor)
+    if not text:
+        await callback.answer("Ошибка не найдена", show_alert=True)
+        return
+    await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
+
+@router.callback_query(F.data.startswith('pe_err:'), is_admin)
+async def payment_error_details(callback: types.CallbackQuery):
+    """Полная карточка ошибки с payment_info и стеком — загружается только здесь"""
+    error_id = int(callback.data.split(':')[1])
+    async with subscription_service.async_session_maker() as session:
+        error = (await session.execute(select(PaymentError).where(PaymentError.id == error_id))).scalar_one_or_none()
+    if not error:
+        await callback.answer("Ошибка не найдена", show_alert=True)
+        return
 
-@dp.message(lambda msg: msg.text and msg.text.startswith('/resolve_payment_error'), lambda msg: str(msg.from_user.id) in ADMIN_USER_IDS)
+    stack_trace = error.stack_trace or 'N/A'
+    if len(stack_trace) > PAYMENT_ERROR_TEXT_LIMIT:
+        stack_trace = '…' + stack_trace[-PAYMENT_ERROR_TEXT_LIMIT:]
+    error_text = (
+        f"🚨 Ошибка платежа #{error.id}:\n"
+        f"Пользователь: {error.tg_id}\n"
+        f"Время платежа: {error.payment_time.strftime('%d.%m.%Y %H:%M:%S')}\n"
+        f"ID транзакции: {error.provider_payment_charge_id}\n"
+        f"Сумма: {error.payment_amount/100 if error.payment_amount else 'N/A'} {error.payment_currency or 'N/A'}\n"
+        f"План: {error.plan_id or 'N/A'}\n"
+        f"Payload: {error.invoice_payload or 'N/A'}\n"
+        f"Ошибка: {_short(error.error_message, 500)}\n\n"
+        f"Платеж: {_short(error.payment_info, PAYMENT_ERROR_TEXT_LIMIT // 2) or 'N/A'}\n\n"
+        f"Стек:\n{stack_trace}\n\n"
+        f"Для разрешения используйте команду:\n"
+        f"/resolve_payment_error {error.id} <причина решения>"
+    )
+    await callback.message.answer(error_text)
+    await callback.answer()
+
+@router.message(lambda msg: msg.text and msg.text.startswith('/resolve_payment_error'), is_admin)
 async def resolve_payment_error(message: types.Message, state: FSMContext):
     """Отметить ошибку платежа как разрешенную (только для админов)"""
     try:
@@ -931,45 +1144,236 @@ async def resolve_payment_error(message: types.Message, state: FSMContext):
         # Отправляем уведомление пользователю
         try:
             await bot.send_message(
-                chat_id=error.telegram_user_id,
+                chat_id=error.tg_id,
                 text="✅ Проблема с вашим платежом была разрешена администратором. Если у вас остались вопросы, пожалуйста, свяжитесь с поддержкой."
             )
         except Exception as e:
-            logging.error(f"Не удалось отправить уведомление пользователю {error.telegram_user_id}: {str(e)}")
+            logging.error(f"Не удалось отправить уведомление пользователю {error.tg_id}: {str(e)}")
     
     except ValueError:
         await message.answer("Неверный формат ID. Используйте: /resolve_payment_error ID <причина решения>")
     except Exception as e:
         await message.answer(f"Произошла ошибка: {str(e)}")
 
+@router.message(Command('stats'), is_admin)
+async def stats_command(message: types.Message, state: FSMContext):
+    """Сводная статистика из дневных счетчиков и прогноз истечений (только для админов)"""
+    summary = await get_stats_summary(subscription_service.async_session_maker)
+    await message.answer(format_stats(summary), parse_mode="HTML")
+
+@router.message(Command('api_stats'), is_admin)
+async def api_stats_command(message: types.Message, state: FSMContext):
+    """Пул HTTP-соединений к Bot API, лимитер запросов, задержка цикла событий (только для админов)"""
+    await message.answer(
+        f"<b>HTTP-пул Bot API</b>\n<pre>{format_pool_stats(bot.session.stats())}</pre>\n"
+        f"<b>Лимитер запросов</b>\n<pre>{format_pool_stats(rate_limiter.stats())}</pre>\n"
+        f"<b>Цикл событий</b>\n<pre>{format_pool_stats(loop_watchdog.stats())}</pre>\n"
+        f"<b>Очереди каналов</b>\n<pre>{format_pool_stats(channel_workers.stats()) or 'пусто'}</pre>\n"
+        f"<b>Ссылки на оплату</b>\n<pre>{format_pool_stats(invoice_links.stats())}</pre>\n"
+        f"<b>Pre-checkout</b>\n<pre>{format_pool_stats(pre_checkout.stats())}</pre>",
+        parse_mode="HTML"
+    )
+
+# Рассылка по базе пользователей (только для админов)
+@router.message(Command('broadcast'), is_admin)
+async def broadcast_command(message: types.Message, state: FSMContext):
+    """Начало рассылки: ждем текст сообщения"""
+    await state.set_state(BroadcastStates.waiting_text)
+    await message.answer("Отправьте текст рассылки одним сообщением. Для отмены — /cancel")
+
+@router.message(BroadcastStates.waiting_text, is_admin)
+async def broadcast_text_received(message: types.Message, state: FSMContext):
+    """Текст получен — выбираем аудиторию"""
+    if not message.text or message.text.startswith('/cancel'):
+        await state.clear()
+        await message.answer("Рассылка отменена.")
+        return
+    await state.update_data(broadcast_text=message.text)
+    await state.set_state(BroadcastStates.choosing_audience)
+    buttons = []
+    for audience, title in AUDIENCES.items():
+        count = await broadcast_service.count_audience(audience)
+        buttons.append([types.InlineKeyboardButton(text=f"{title} ({count})", callback_data=f"bc_go:{audience}")])
+    buttons.append([types.InlineKeyboardButton(text="Отмена", callback_data="bc_cancel")])
+    await message.answer("Кому отправить рассылку?", reply_markup=types.InlineKeyboardMarkup(inline_keyboard=buttons))
+
+@router.callback_query(BroadcastStates.choosing_audience, F.data == 'bc_cancel', is_admin)
+async def broadcast_cancel_setup(callback: types.CallbackQuery, state: FSMContext):
+    await state.clear()
+    await callback.message.edit_text("Рассылка отменена.")
+    await callback.answer()
+
+@router.callback_query(BroadcastStates.choosing_audience, F.data.startswith('bc_go:'), is_admin)
+async def broadcast_start(callback: types.CallbackQuery, state: FSMContext):
+    """Фиксируем аудиторию в задании и запускаем доставку в фоне"""
+    audience = callback.data.split(':', 1)[1]
+    data = await state.get_data()
+    await state.clear()
+    job_id = await broadcast_service.create_job(data['broadcast_text'], audience, created_by=callback.from_user.id)
+    job = await broadcast_service.get_job(job_id)
+    # Это сообщение дальше редактируется с прогрессом рассылки
+    progress = await callback.message.edit_text(format_progress(job), reply_markup=progress_keyboard(job))
+    message_id = getattr(progress, 'message_id', None) or callback.message.message_id
+    await broadcast_service.set_progress_message(job_id, callback.message.chat.id, message_id)
+    broadcast_service.start(job_id)
+    await callback.answer(f"Рассылка #{job_id} запущена")
+
+@router.callback_query(F.data.startswith('bc_stop:'), is_admin)
+async def broadcast_stop(callback: types.CallbackQuery):
+    job_id = int(callback.data.split(':')[1])
+    if await broadcast_service.cancel(job_id):
+        await callback.answer(f"Рассылка #{job_id} будет остановлена")
+    else:
+        await callback.answer("Рассылка уже завершена")
+    await broadcast_service.update_progress(job_id)
+
+# Профилирование живого процесса (только для админов)
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+_profiling_tasks = set()
+
+def start_profiling_task(coro):
+    task = asyncio.create_task(coro)
+    _profiling_tasks.add(task)
+    task.add_done_callback(_profiling_tasks.discard)
+    return task
+
+async def send_cpu_profile(chat_ids, seconds):
+    """Снимает CPU-профиль и отправляет отчет и collapsed stacks в чаты (профилировщик занят через try_start)"""
+    try:
+        sampler = await profiling.profile_cpu(seconds)
+    finally:
+        profiling.finish()
+    report = BufferedInputFile(sampler.report().encode(), filename=profiling.profile_filename('cpu_profile'))
+    stacks = BufferedInputFile(sampler.collapsed().encode(), filename=profiling.profile_filename('cpu_profile', 'collapsed'))
+    for chat_id in chat_ids:
+        try:
+            await bot.send_document(chat_id=chat_id, document=report, caption=f"CPU-профиль за {seconds} сек")
+            await bot.send_document(chat_id=chat_id, document=stacks, caption="Collapsed stacks для flamegraph/speedscope")
+        except Exception as e:
+            logging.error(f"[PROFILE] Не удалось отправить CPU-профиль в чат {chat_id}: {e}")
+
+async def send_memory_profile(chat_ids, seconds):
+    """Снимки tracemalloc за seconds секунд и отчет о росте памяти (профилировщик занят через try_start)"""
+    try:
+        report_text = await profiling.profile_memory(seconds)
+    finally:
+        profiling.finish()
+    report = BufferedInputFile(report_text.encode(), filename=profiling.profile_filename('memory_profile'))
+    for chat_id in chat_ids:
+        try:
+            await bot.send_document(chat_id=chat_id, document=report, caption=f"Профиль памяти за {seconds} сек")
+        except Exception as e:
+            logging.error(f"[PROFILE] Не удалось отправить профиль памяти в чат {chat_id}: {e}")
+
+async def _start_profile_command(message: types.Message, kind: str):
+    if not profiling.PROFILING_ENABLED:
+        await message.answer("Профилирование отключено (PROFILING_ENABLED=False).")
+        return
+    try:
+        seconds = profiling.parse_seconds(message.text)
+    except ValueError:
+        await message.answer(f"Неверный формат. Используйте: /profile_{kind} <секунды>")
+        return
+    # Проверка и захват профилировщика без await между ними — два профиля одновременно не запустятся
+    if not profiling.try_start():
+        await message.answer("Профилирование уже выполняется, дождитесь результата.")
+        return
+    if kind == 'cpu':
+        start_profiling_task(send_cpu_profile([message.chat.id], seconds))
+    else:
+        start_profiling_task(send_memory_profile([message.chat.id], seconds))
+    await message.answer(f"⏱ Профилирование ({kind}) запущено на {seconds} сек. Отчет придет файлом.")
+
+@router.message(Command('profile_cpu'), is_admin)
+async def profile_cpu_command(message: types.Message, state: FSMContext):
+    """Сэмплирующий CPU-профиль обработки апдейтов и задач планировщика (только для админов)"""
+    await _start_profile_command(message, 'cpu')
+
+@router.message(Command('profile_mem'), is_admin)
+async def profile_mem_command(message: types.Message, state: FSMContext):
+    """Снимки tracemalloc и рост памяти за N секунд (только для админов)"""
+    await _start_profile_command(message, 'mem')
+
 async def main():
     """Запуск бота"""
-    logging.basicConfig(level=logging.INFO)
+    global bot
+    timer = StartupTimer()
+    setup_logging()  # Очередь логов, JSON, выборка по категориям (app/structured_logging.py)
     logging.info("Starting bot")
+    logging.info(f"Профиль исполнения: {runtime_profile.describe()}")
+    if not TELEGRAM_PAYMENT_TOKEN:
+        raise ValueError('Не задан TELEGRAM_PAYMENT_TOKEN в .env!')
+    if not CHANNEL_IDS.get('premium_subscription'):
+        raise ValueError("Не задана переменная окружения PREMIUM_CHANNEL_ID. Укажите её в .env!")
+    if IS_TEST_MODE and not TELEGRAM_PAYMENT_TOKEN.startswith('381764678:TEST:'):
+        logging.warning("Используется тестовый платежный токен для Юкассы")
     logging.info(f"Платежный токен: {TELEGRAM_PAYMENT_TOKEN[:10]}... (Тестовый режим: {IS_TEST_MODE})")
     logging.info(f"Каналы: Премиум: {CHANNEL_IDS['premium_subscription']}")
 
-    await async_init_db()  # Сначала создаём таблицы!
-    await subscription_service._init_subscription_plans()  # Потом инициализируем тарифы
+    with timer.stage('бот и диспетчер'):
+        bot = create_bot()
+        subscription_service.set_bot(bot)
+        broadcast_service.set_bot(bot)
+        dp = create_dispatcher()
+
+    install_query_stats()
+    install_slow_query_log()  # Журнал запросов дольше SLOW_QUERY_MS
+    with timer.stage('схема БД'):
+        engine = await async_init_db()  # Сначала создаём таблицы!
+        await add_telegram_id_columns(engine)  # BIGINT telegram_id в существующей базе (expand-шаг)
+    with timer.stage('пул соединений БД'):
+        await prewarm_pool(engine)
+    with timer.stage('тарифы'):
+        await subscription_service._init_subscription_plans()  # Потом инициализируем тарифы
 
     # Настройка планировщика
     scheduler = setup_scheduler()
 
     # Хуки запуска и остановки
     async def on_startup(*args, **kwargs):
+        # Замер задержки цикла событий и стек при зависании (app/loop_watchdog.py)
+        if LOOP_DEBUG:
+            enable_loop_debug()
+        loop_watchdog.start()
         logging.info("Запуск планировщика...")
-        scheduler.start()
+        with timer.stage('планировщик и рассылки'):
+            scheduler.start()
+            await broadcast_service.resume_pending()
+        # Разовая фоновая задача: заполнение telegram_id у старых строк, пока чтение двойное
+        scheduler.add_job(backfill_telegram_ids, args=[subscription_service.async_session_maker],
+                          id='backfill_telegram_ids', replace_existing=True)
+        # Разовые фоновые задачи: очередь уведомлений для подписок и пользователей, появившихся до нее.
+        # После первого успешного прохода отметка в data_migrations, полный проход больше не повторяется
+        for name, migrate in (('subscription_notifications', backfill_subscription_notifications),
+                              ('registration_reminders', backfill_registration_reminders)):
+            scheduler.add_job(run_data_migration, args=[subscription_service.async_session_maker, name, migrate],
+                              id=f'backfill_{name}', replace_existing=True)
+        if profiling.PROFILING_ENABLED and profiling.PROFILE_ON_START and profiling.try_start():
+            admins = [admin_id for admin_id in ADMIN_USER_IDS if admin_id]
+            logging.info(f"Профилирование первых {profiling.PROFILE_ON_START} сек после запуска")
+            start_profiling_task(send_cpu_profile(admins, profiling.PROFILE_ON_START))
+        if INVOICE_LINKS:
+            # Ссылки на оплату всех тарифов создаются в фоне, не задерживая запуск
+            invoice_links.warm_in_background(bot, await subscription_service.get_active_plans(), TELEGRAM_PAYMENT_TOKEN)
+        timer.log()
 
     async def on_shutdown(*args, **kwargs):
         logging.info("Остановка планировщика...")
         scheduler.shutdown(wait=True)
+        loop_watchdog.stop()
+        logging.info(f"HTTP-пул Bot API: {bot.session.stats()}")
+        logging.info(f"Задержка цикла событий: {loop_watchdog.stats()}")
 
     dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
 
     # Запускаем поллинг
     logging.info("Запуск поллинга...")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        stop_logging()  # Дописываем записи из очереди, в том числе аудит платежей
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    # RUNTIME_PROFILE=fast — uvloop и orjson, если установлены (app/runtime_profile.py)
+    runtime_profile.run(main())
\ No newline at end of file
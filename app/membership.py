@@ -0,0 +1,71 @@
+from app.database import ChannelMember
+from datetime import datetime
+from sqlalchemy import select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+
+# Размер пачки пар (канал, пользователь) в одном IN
+MEMBERSHIP_LOOKUP_CHUNK = 500
+
+# Статусы chat_member, при которых пользователь находится в канале
+MEMBER_STATUSES = ('creator', 'administrator', 'member', 'restricted')
+# Статусы, подтверждающие, что пользователя в канале нет
+LEFT_STATUSES = ('left', 'kicked')
+
+
+def is_member(status) -> bool:
+    return status in MEMBER_STATUSES
+
+
+async def record_membership(session, channel_id, telegram_id, status, at=None):
+    """
+    Сохраняет статус пользователя в канале в транзакции вызывающего кода.
+    Апдейты могут прийти не по порядку: более старое событие не перезаписывает новое.
+    """
+    channel_id = str(channel_id)
+    telegram_id = int(telegram_id)
+    at = at or datetime.utcnow()
+    dialect = session.get_bind().dialect.name
+
+    if dialect in ('postgresql', 'sqlite'):
+        insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        stmt = insert(ChannelMember).values(channel_id=channel_id, telegram_id=telegram_id, status=status, updated_at=at)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['channel_id', 'telegram_id'],
+            set_={'status': stmt.excluded.status, 'updated_at': stmt.excluded.updated_at},
+            where=ChannelMember.updated_at <= stmt.excluded.updated_at
+        )
+        await session.execute(stmt)
+        return
+
+    # Прочие СУБД: UPDATE, а если строки еще нет — INSERT
+    existing = await session.get(ChannelMember, (channel_id, telegram_id))
+    if existing is None:
+        session.add(ChannelMember(channel_id=channel_id, telegram_id=telegram_id, status=status, updated_at=at))
+        await session.flush()
+    elif existing.updated_at <= at:
+        existing.status = status
+        existing.updated_at = at
+
+
+async def get_membership(session, channel_id, telegram_id):
+    """Статус пользователя в канале или None, если о нем ничего не известно"""
+    result = await session.execute(
+        select(ChannelMember.status).where(
+            ChannelMember.channel_id == str(channel_id),
+            ChannelMember.telegram_id == int(telegram_id)
+        )
+    )
+    return result.scalar_one_or_none()
+
+
+async def get_memberships(session, pairs):
+    """Статусы для набора (channel_id, telegram_id) пачками: {(channel_id, telegram_id): status}"""
+    pairs = list({(str(channel_id), int(telegram_id)) for channel_id, telegram_id in pairs})
+    statuses = {}
+    for start in range(0, len(pairs), MEMBERSHIP_LOOKUP_CHUNK):
+        result = await session.execute(
+            select(ChannelMember.channel_id, ChannelMember.telegram_id, ChannelMember.status)
+            .where(tuple_(ChannelMember.channel_id, ChannelMember.telegram_id).in_(pairs[start:start + MEMBERSHIP_LOOKUP_CHUNK]))
+        )
+        statuses.update({(row.channel_id, row.telegram_id): row.status for row in result.all()})
+    return statuses
@@ -0,0 +1,138 @@
+from app.database import User, PaymentError, DataMigration
+from sqlalchemy import select, update, inspect, text, or_, and_, func, cast, BigInteger
+from sqlalchemy.exc import IntegrityError
+import logging
+
+# Переход telegram_user_id (String) -> telegram_id (BigInteger) без остановки бота:
+# 1. expand: ALTER TABLE ... ADD COLUMN telegram_id BIGINT (nullable) и уникальный индекс;
+# 2. все записи пишут обе колонки, чтение идет по telegram_id с запасным вариантом по строке;
+# 3. backfill пачками заполняет telegram_id у старых строк, после него чтение только по telegram_id;
+# 4. contract (отдельным релизом): удалить telegram_user_id.
+TELEGRAM_ID_BACKFILL_BATCH = 1000
+
+# Таблица -> (модель, индекс по telegram_id, уникальный ли)
+TELEGRAM_ID_TABLES = {
+    'users': (User, 'ix_users_telegram_id', True),
+    'payment_errors': (PaymentError, 'ix_payment_errors_telegram_id', False),
+}
+
+# True, когда в процессе закончился backfill: запасное чтение по строковой колонке больше не нужно
+telegram_id_backfilled = False
+
+
+def telegram_id_filter(model, telegram_id):
+    """
+    Условие поиска по Telegram ID на время двойного чтения: по telegram_id,
+    а у еще не заполненных строк — по старой строковой колонке.
+    """
+    telegram_id = int(telegram_id)
+    if telegram_id_backfilled:
+        return model.telegram_id == telegram_id
+    return or_(
+        model.telegram_id == telegram_id,
+        and_(model.telegram_id.is_(None), model.telegram_user_id == str(telegram_id))
+    )
+
+
+def telegram_id_column(model):
+    """
+    Telegram ID числом для выборки на время двойного чтения: telegram_id, а у еще
+    не заполненных строк — строковая колонка, приведенная к BIGINT.
+    """
+    if telegram_id_backfilled:
+        return model.telegram_id
+    return func.coalesce(model.telegram_id, cast(model.telegram_user_id, BigInteger))
+
+
+def _missing_columns(sync_conn):
+    inspector = inspect(sync_conn)
+    missing = []
+    for table in TELEGRAM_ID_TABLES:
+        if 'telegram_id' not in {column['name'] for column in inspector.get_columns(table)}:
+            missing.append(table)
+    return missing
+
+
+async def add_telegram_id_columns(engine):
+    """
+    Expand-шаг: добавляет nullable BIGINT колонки и индексы в существующую базу.
+    На новой базе их уже создал create_all, тогда ничего не делает. На Postgres индекс
+    строится CONCURRENTLY (без блокировки записи), поэтому вне транзакции.
+    """
+    async with engine.connect() as conn:
+        missing = await conn.run_sync(_missing_columns)
+    if not missing:
+        return []
+
+    postgres = engine.dialect.name == 'postgresql'
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level='AUTOCOMMIT')
+        for table in missing:
+            _, index_name, unique = TELEGRAM_ID_TABLES[table]
+            await conn.execute(text(f'ALTER TABLE {table} ADD COLUMN telegram_id BIGINT'))
+            await conn.execute(text(
+                f"CREATE {'UNIQUE ' if unique else ''}INDEX {'CONCURRENTLY ' if postgres else ''}"
+                f"IF NOT EXISTS {index_name} ON {table} (telegram_id)"
+            ))
+            logging.info(f"[MIGRATION] Добавлена колонка {table}.telegram_id")
+    return missing
+
+
+async def backfill_telegram_ids(session_maker, batch_size=TELEGRAM_ID_BACKFILL_BATCH):
+    """
+    Заполняет telegram_id из telegram_user_id пачками по первичному ключу, каждая пачка —
+    отдельная короткая транзакция. Строки с нечисловым значением пропускаются с предупреждением.
+    Повторный запуск ничего не делает. По завершении включает чтение только по telegram_id.
+    """
+    global telegram_id_backfilled
+    total = 0
+    for model, _, _ in TELEGRAM_ID_TABLES.values():
+        last_id = 0
+        while True:
+            async with session_maker() as session:
+                result = await session.execute(
+                    select(model.id, model.telegram_user_id)
+                    .where(model.id > last_id, model.telegram_id.is_(None))
+                    .order_by(model.id)
+                    .limit(batch_size)
+                )
+                rows = result.all()
+                if not rows:
+                    break
+                values = []
+                for row in rows:
+                    try:
+                        values.append({'id': row.id, 'telegram_id': int(row.telegram_user_id)})
+                    except (TypeError, ValueError):
+                        logging.warning(f"[MIGRATION] {model.__tablename__}.id={row.id}: нечисловой Telegram ID {row.telegram_user_id!r}")
+                if values:
+                    await session.execute(update(model), values)
+                    await session.commit()
+                total += len(values)
+                last_id = rows[-1].id
+
+    telegram_id_backfilled = True
+    if total:
+        logging.info(f"[MIGRATION] telegram_id заполнен для строк: {total}")
+    return total
+
+
+async def run_data_migration(session_maker, name, migrate):
+    """
+    Разовый перенос данных migrate(session_maker): после успешного выполнения в data_migrations
+    остается отметка, и следующие запуски бота его пропускают. Перенос должен быть идемпотентным:
+    если он упал или два экземпляра стартовали одновременно, повторный проход ничего не ломает.
+    Возвращает результат migrate или None, если перенос уже выполнен.
+    """
+    async with session_maker() as session:
+        if await session.get(DataMigration, name) is not None:
+            return None
+    result = await migrate(session_maker)
+    async with session_maker() as session:
+        session.add(DataMigration(name=name))
+        try:
+            await session.commit()
+        except IntegrityError:
+            await session.rollback()  # Отметку уже поставил другой экземпляр
+    logging.info(f"[MIGRATION] Выполнен перенос данных {name}")
+    return result
@@ -0,0 +1,202 @@
+from app.database import ScheduledNotification, User, UserSubscription
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, delete, insert, exists
+import logging
+
+# Уведомление об истечении отправляем с небольшой задержкой, чтобы
+# check_expired_subscriptions успел отозвать доступ
+EXPIRED_NOTIFICATION_DELAY = timedelta(minutes=10)
+# Сколько уведомлений диспетчер обрабатывает за один запуск
+NOTIFICATION_BATCH_SIZE = 500
+# После стольких неудачных попыток уведомление помечается failed
+NOTIFICATION_MAX_ATTEMPTS = 5
+# Напоминание об оплате после регистрации и сколько таких напоминаний отправлять за один запуск задачи
+REGISTRATION_REMINDER_DELAY = timedelta(hours=3)
+REGISTRATION_REMINDERS_PER_RUN = 200
+
+SUBSCRIPTION_KINDS = ('expiring_24h', 'last_day', 'expired')
+REGISTRATION_KINDS = ('registration',)
+
+# Старые флаги в user_subscriptions: продолжаем их ставить, чтобы данные оставались согласованными
+LEGACY_FLAGS = {
+    'expiring_24h': 'reminder_sent',
+    'last_day': 'last_day_reminder_sent',
+    'expired': 'expired_reminder_sent',
+}
+
+NOTIFICATION_TEXTS = {
+    'registration': (
+        "{first_name}! Мы ждём Вас в нашем канале с эксклюзивными товарами "
+        "за кешбэк 100 %. Осталось только оплатить подписку — сделаем это прямо сейчас?\n\n"
+        "Начните зарабатывать и экономить уже сегодня💥"
+    ),
+    'expiring_24h': (
+        "Внимание: завтра Ваша подписка истекает. "
+        "Чтобы не прерывать доступ к кешбэку 100 %, "
+        "оформите оплату на следующий месяц уже сегодня."
+    ),
+    'last_day': (
+        "Не дайте подписке закончиться! Сегодня последний день — "
+        "продлите доступ к каналу и продолжайте получать кешбэк 100 %."
+    ),
+    'expired': (
+        "{first_name}, привет! Сообщаем, что доступ к каналу закрыт — подписка истекла.\n\n"
+        "Не хотите пропустить новые предложения с кешбэком 100 %? "
+        "Продлите доступ прямо сейчас."
+    ),
+}
+
+
+def subscription_due_times(end_date):
+    """Когда отправлять уведомления подписки с заданной датой окончания (UTC)"""
+    return {
+        'expiring_24h': end_date - timedelta(hours=24),
+        'last_day': end_date.replace(hour=0, minute=0, second=0, microsecond=0),
+        'expired': end_date + EXPIRED_NOTIFICATION_DELAY,
+    }
+
+
+async def schedule_subscription_notifications(session, subscription_id, user_id, end_date, kinds=SUBSCRIPTION_KINDS):
+    """
+    Планирует уведомления подписки под ее дату окончания в транзакции вызывающего кода.
+    Ожидающие уведомления этой подписки заменяются, уже отправленные остаются в истории.
+    """
+    await session.execute(
+        delete(ScheduledNotification).where(
+            ScheduledNotification.subscription_id == subscription_id,
+            ScheduledNotification.status == 'pending'
+        )
+    )
+    due_times = subscription_due_times(end_date)
+    rows = [
+        {'subscription_id': subscription_id, 'user_id': user_id, 'kind': kind, 'due_at': due_times[kind],
+         'status': 'pending', 'attempts': 0}
+        for kind in kinds
+    ]
+    if rows:
+        await session.execute(insert(ScheduledNotification), rows)
+
+
+async def cancel_subscription_notifications(session, subscription_ids):
+    """Отменяет ожидающие уведомления подписок (отмена, замена новой подпиской)"""
+    if not subscription_ids:
+        return
+    await session.execute(
+        update(ScheduledNotification)
+        .where(
+            ScheduledNotification.subscription_id.in_(list(subscription_ids)),
+            ScheduledNotification.status == 'pending'
+        )
+        .values(status='cancelled')
+    )
+
+
+async def schedule_registration_reminder(session, user_id, created_at=None):
+    """Ставит в очередь напоминание об оплате для только что зарегистрированного пользователя"""
+    await session.execute(insert(ScheduledNotification), [{
+        'subscription_id': None, 'user_id': user_id, 'kind': 'registration',
+        'due_at': (created_at or datetime.utcnow()) + REGISTRATION_REMINDER_DELAY,
+        'status': 'pending', 'attempts': 0,
+    }])
+
+
+async def cancel_registration_reminder(session, user_id):
+    """Пользователь оплатил подписку — напоминание о регистрации больше не нужно"""
+    await session.execute(
+        update(ScheduledNotification)
+        .where(
+            ScheduledNotification.user_id == user_id,
+            ScheduledNotification.kind == 'registration',
+            ScheduledNotification.status == 'pending'
+        )
+        .values(status='cancelled')
+    )
+
+
+async def backfill_registration_reminders(session_maker, chunk_size=1000):
+    """
+    Очередь напоминаний для пользователей, зарегистрированных до ее появления:
+    без отправленного напоминания, без действующей подписки и без строки в очереди.
+    """
+    now = datetime.utcnow()
+    queued = exists().where(ScheduledNotification.user_id == User.id, ScheduledNotification.kind == 'registration')
+    subscribed = User.subscriptions.any(UserSubscription.is_active == True)
+    last_id = 0
+    total = 0
+    while True:
+        async with session_maker() as session:
+            result = await session.execute(
+                select(User.id, User.created_at)
+                .where(
+                    User.id > last_id,
+                    User.first_start_reminder_sent == False,
+                    User.is_active == True,
+                    ~subscribed,
+                    ~queued
+                )
+                .order_by(User.id)
+                .limit(chunk_size)
+            )
+            users = result.all()
+            if not users:
+                break
+            await session.execute(insert(ScheduledNotification), [
+                {'subscription_id': None, 'user_id': user.id, 'kind': 'registration',
+                 'due_at': (user.created_at or now) + REGISTRATION_REMINDER_DELAY, 'status': 'pending', 'attempts': 0}
+                for user in users
+            ])
+            await session.commit()
+            total += len(users)
+            last_id = users[-1].id
+
+    if total:
+        logging.info(f"[NOTIFICATIONS] В очередь поставлены напоминания о регистрации: {total}")
+    return total
+
+
+async def backfill_subscription_notifications(session_maker, chunk_size=1000):
+    """
+    Заполняет расписание для подписок, созданных до появления scheduled_notifications.
+    Берет только подписки без единой строки расписания и учитывает старые флаги *_reminder_sent,
+    поэтому повторный запуск ничего не делает.
+    """
+    now = datetime.utcnow()
+    has_schedule = exists().where(ScheduledNotification.subscription_id == UserSubscription.id)
+    last_id = 0
+    total = 0
+    while True:
+        async with session_maker() as session:
+            result = await session.execute(
+                select(UserSubscription.id, UserSubscription.user_id, UserSubscription.end_date,
+                       UserSubscription.is_active, UserSubscription.reminder_sent,
+                       UserSubscription.last_day_reminder_sent, UserSubscription.expired_reminder_sent)
+                .where(UserSubscription.id > last_id, ~has_schedule)
+                .order_by(UserSubscription.id)
+                .limit(chunk_size)
+            )
+            subscriptions = result.all()
+            if not subscriptions:
+                break
+
+            rows = []
+            for sub in subscriptions:
+                due_times = subscription_due_times(sub.end_date)
+                pending = {
+                    'expiring_24h': sub.is_active and not sub.reminder_sent and sub.end_date > now,
+                    'last_day': sub.is_active and not sub.last_day_reminder_sent and sub.end_date > now,
+                    'expired': not sub.expired_reminder_sent,
+                }
+                rows += [
+                    {'subscription_id': sub.id, 'user_id': sub.user_id, 'kind': kind, 'due_at': due_times[kind],
+                     'status': 'pending', 'attempts': 0}
+                    for kind, needed in pending.items() if needed
+                ]
+            if rows:
+                await session.execute(insert(ScheduledNotification), rows)
+                await session.commit()
+            total += len(rows)
+            last_id = subscriptions[-1].id
+
+    if total:
+        logging.info(f"[NOTIFICATIONS] Заполнено расписание уведомлений для старых подписок: {total}")
+    return total
@@ -0,0 +1,209 @@
+import asyncio
+import gc
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+
+# Выключатель профилирования (админ-команды и профиль при старте), по умолчанию выключено
+PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', 'False').lower() in ('true', '1', 't')
+# Если задано — CPU-профиль снимается первые N секунд после запуска и отправляется админам
+PROFILE_ON_START = int(os.getenv('PROFILE_ON_START', '0') or 0)
+PROFILE_MAX_SECONDS = 300
+SAMPLE_INTERVAL = 0.005
+
+_running = False
+
+
+def is_running() -> bool:
+    return _running
+
+
+def try_start() -> bool:
+    """Занимает профилировщик (один профиль за раз); False — профиль уже снимается. Освобождает finish()"""
+    global _running
+    if _running:
+        return False
+    _running = True
+    return True
+
+
+def finish():
+    global _running
+    _running = False
+
+
+def _frame_key(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_qualname}"
+
+
+def _is_idle(frame) -> bool:
+    """Цикл событий ждет ввода-вывода в selectors — это простой, а не работа"""
+    return frame.f_code.co_filename.endswith('selectors.py')
+
+
+class StackSampler:
+    """
+    Сэмплирующий профилировщик потока цикла событий. Накладные расходы не зависят
+    от количества вызовов функций, поэтому его можно включать на живом боте.
+
+    В главном потоке на Unix сэмплы снимаются по таймеру процессорного времени
+    (SIGPROF): обработчик сигнала видит реально исполняемый кадр. Иначе — из
+    отдельного потока через sys._current_frames(); такой режим видит поток только
+    в моменты отпускания GIL и поэтому менее точен.
+    """
+
+    def __init__(self, thread_id: int | None = None, interval: float = SAMPLE_INTERVAL):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.idle = 0
+        self.mode = 'signal' if self._signal_available() else 'thread'
+        self._stop = threading.Event()
+        self._thread = None
+        self._previous_handler = None
+        self.started_at = None
+        self.duration = 0.0
+
+    def _signal_available(self) -> bool:
+        return hasattr(signal, 'setitimer') and self.thread_id == threading.main_thread().ident \
+            and threading.get_ident() == self.thread_id
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        if self.mode == 'signal':
+            self._previous_handler = signal.signal(signal.SIGPROF, self._on_signal)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        else:
+            self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self.mode == 'signal':
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, self._previous_handler or signal.SIG_DFL)
+        else:
+            self._stop.set()
+            if self._thread:
+                self._thread.join()
+        self.duration = time.perf_counter() - self.started_at
+
+    def _on_signal(self, signum, frame):
+        if frame is not None:
+            self._record(frame)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self._record(frame)
+
+    def _record(self, frame):
+        self.samples += 1
+        if _is_idle(frame):
+            self.idle += 1
+            return
+        stack = []
+        while frame is not None:
+            stack.append(_frame_key(frame))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def collapsed(self) -> str:
+        """Формат collapsed stacks (flamegraph.pl, speedscope)"""
+        return '\n'.join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+    def top_functions(self, limit: int = 30) -> tuple[list, list]:
+        """(self, cumulative): функции по числу сэмплов"""
+        own, cumulative = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            for key in set(frames):
+                cumulative[key] += count
+        return own.most_common(limit), cumulative.most_common(limit)
+
+    def report(self) -> str:
+        busy = self.samples - self.idle
+        own, cumulative = self.top_functions()
+        lines = [
+            f"CPU профиль: {self.duration:.1f} сек, интервал {self.interval * 1000:.0f} мс, режим: {self.mode}",
+            f"Сэмплов: {self.samples}, цикл занят: {busy} ({busy / max(self.samples, 1):.0%}), простой: {self.idle}",
+            "",
+            "Топ функций (собственное время):",
+        ]
+        lines += [f"  {count / max(busy, 1):6.1%}  {count:6d}  {key}" for key, count in own]
+        lines += ["", "Топ функций (включая вызванные):"]
+        lines += [f"  {count / max(busy, 1):6.1%}  {count:6d}  {key}" for key, count in cumulative]
+        return '\n'.join(lines)
+
+
+async def profile_cpu(seconds: float, interval: float = SAMPLE_INTERVAL) -> StackSampler:
+    """Сэмплирует поток текущего цикла событий (апдейты и задачи планировщика) seconds секунд"""
+    sampler = StackSampler(threading.get_ident(), interval)
+    sampler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        sampler.stop()
+    return sampler
+
+
+def _count_objects() -> Counter:
+    return Counter(type(obj).__name__ for obj in gc.get_objects())
+
+
+async def profile_memory(seconds: float, steps: int = 3, top: int = 25, frames: int = 10) -> str:
+    """
+    Снимки tracemalloc в начале и через равные интервалы, отчет о росте памяти.
+    Дополнительно — прирост количества объектов по типам (ORM-объекты, состояния FSM и т.п.).
+    """
+    started_here = not tracemalloc.is_tracing()
+    if started_here:
+        tracemalloc.start(frames)
+    filters = [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ]
+    objects_before = _count_objects()
+    snapshots = [tracemalloc.take_snapshot().filter_traces(filters)]
+    try:
+        for _ in range(steps):
+            await asyncio.sleep(seconds / steps)
+            snapshots.append(tracemalloc.take_snapshot().filter_traces(filters))
+    finally:
+        if started_here:
+            tracemalloc.stop()
+    objects_after = _count_objects()
+
+    lines = [f"Профиль памяти: {seconds:.1f} сек, снимков: {len(snapshots)}", "", "Объем отслеживаемой памяти:"]
+    for i, snapshot in enumerate(snapshots):
+        total = sum(stat.size for stat in snapshot.statistics('filename'))
+        lines.append(f"  t{i}: {total / 1024:.1f} КиБ")
+
+    lines += ["", f"Рост по строкам кода (t{len(snapshots) - 1} - t0):"]
+    for stat in snapshots[-1].compare_to(snapshots[0], 'lineno')[:top]:
+        lines.append(f"  {stat.size_diff / 1024:+10.1f} КиБ {stat.count_diff:+8d} блоков  {stat.traceback}")
+
+    growth = objects_after.copy()
+    growth.subtract(objects_before)
+    lines += ["", "Прирост объектов по типам:"]
+    lines += [f"  {diff:+8d}  {name}" for name, diff in growth.most_common(top) if diff > 0]
+    return '\n'.join(lines)
+
+
+def profile_filename(kind: str, ext: str = 'txt') -> str:
+    return f"{kind}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.{ext}"
+
+
+def parse_seconds(text: str | None, default: int = 30) -> int:
+    """Аргумент команды: /profile_cpu 60 → 60, ограничен PROFILE_MAX_SECONDS"""
+    parts = (text or '').split()
+    seconds = int(parts[1]) if len(parts) > 1 else default
+    return max(1, min(seconds, PROFILE_MAX_SECONDS))
@@ -0,0 +1,155 @@
+import functools
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiogram import BaseMiddleware
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+# Сколько одинаковых по форме запросов в одной единице работы считаем подозрением на N+1
+N_PLUS_ONE_THRESHOLD = 3
+
+_current_unit: ContextVar["QueryStats | None"] = ContextVar("query_stats_unit", default=None)
+_installed = False
+
+# Списки плейсхолдеров IN (?, ?, ?) / ($1, $2) / (%(p_1)s, ...) сводим к одному
+_PLACEHOLDER_LIST = re.compile(r"\(\s*(?:\?|\$\d+|%\(\w+\)s|:\w+)(?:\s*,\s*(?:\?|\$\d+|%\(\w+\)s|:\w+))*\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def statement_shape(statement: str) -> str:
+    """Форма запроса: без лишних пробелов и с IN-списками, сведёнными к одному параметру"""
+    return _PLACEHOLDER_LIST.sub("(?)", _WHITESPACE.sub(" ", statement).strip())
+
+
+class QueryStats:
+    """Статистика обращений к БД в рамках одной единицы работы (апдейт, задача планировщика)"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.statements = 0
+        self.sessions = 0
+        self.db_time = 0.0
+        self.shapes = Counter()
+
+    def record(self, statement: str, duration: float):
+        self.statements += 1
+        self.db_time += duration
+        self.shapes[statement_shape(statement)] += 1
+
+    def suspected_n_plus_one(self, threshold: int = N_PLUS_ONE_THRESHOLD) -> list[tuple[str, int]]:
+        """Повторяющиеся формы запросов — вероятные N+1"""
+        return [(shape, count) for shape, count in self.shapes.most_common() if count >= threshold]
+
+    def summary(self) -> str:
+        return (f"{self.name}: {self.statements} запросов, {self.sessions} сессий, "
+                f"{self.db_time * 1000:.1f} мс в БД")
+
+    def assert_budget(self, statements: int | None = None, sessions: int | None = None):
+        """Проверка бюджета для тестов: /start ≤ 2 запросов и т.п."""
+        problems = []
+        if statements is not None and self.statements > statements:
+            problems.append(f"запросов {self.statements} > {statements}")
+        if sessions is not None and self.sessions > sessions:
+            problems.append(f"сессий {self.sessions} > {sessions}")
+        if problems:
+            shapes = "\n".join(f"  {count} × {shape}" for shape, count in self.shapes.most_common())
+            raise AssertionError(f"Превышен бюджет {self.name}: {', '.join(problems)}\n{shapes}")
+
+    def __repr__(self):
+        return f"<QueryStats({self.summary()})>"
+
+
+def current_stats() -> QueryStats | None:
+    return _current_unit.get()
+
+
+def report(stats: QueryStats):
+    """Лог по итогам единицы работы"""
+    suspects = stats.suspected_n_plus_one()
+    if suspects:
+        shape, count = suspects[0]
+        logger.warning("Возможный N+1 в %s: %d одинаковых запросов: %s", stats.summary(), count, shape[:300])
+    else:
+        logger.debug(stats.summary())
+
+
+@contextmanager
+def track_queries(name: str = "unit", log: bool = False):
+    """Считает запросы, сессии и время в БД внутри блока (включая вложенные корутины)"""
+    stats = QueryStats(name)
+    token = _current_unit.set(stats)
+    try:
+        yield stats
+    finally:
+        _current_unit.reset(token)
+        if log:
+            report(stats)
+
+
+def track_job(func):
+    """Декоратор для задач планировщика: одна задача — одна единица работы"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with track_queries(f"job:{func.__name__}", log=True):
+            return await func(*args, **kwargs)
+    return wrapper
+
+
+class QueryStatsMiddleware(BaseMiddleware):
+    """Внешний middleware апдейтов: один апдейт — одна единица работы"""
+
+    async def __call__(self, handler, event, data):
+        with track_queries(f"update:{getattr(event, 'event_type', type(event).__name__)}", log=True):
+            return await handler(event, data)
+
+
+# ─── Хуки SQLAlchemy ──────────────────────────────────────────────────────────
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current_unit.get() is not None:
+        conn.info.setdefault("query_stats_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current_unit.get()
+    if stats is None:
+        return
+    starts = conn.info.get("query_stats_start")
+    started = starts.pop() if starts else time.perf_counter()
+    stats.record(statement, time.perf_counter() - started)
+
+
+def _handle_error(exception_context):
+    # Запрос завершился ошибкой: after_cursor_execute не будет, снимаем его отметку времени,
+    # иначе следующий запрос на этом соединении из пула возьмет чужое время начала
+    conn = exception_context.connection
+    starts = conn.info.get("query_stats_start") if conn is not None else None
+    if starts and _current_unit.get() is not None:
+        starts.pop()
+
+
+def _after_begin(session, transaction, connection):
+    stats = _current_unit.get()
+    if stats is not None and session.info.get("query_stats_unit") is not stats:
+        session.info["query_stats_unit"] = stats
+        stats.sessions += 1
+
+
+def install_query_stats():
+    """Подключает хуки ко всем движкам и сессиям (повторный вызов ничего не делает)"""
+    global _installed
+    if _installed:
+        return
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(Engine, "handle_error", _handle_error)
+    event.listen(Session, "after_begin", _after_begin)
+    _installed = True
@@ -0,0 +1,178 @@
+import asyncio
+import functools
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота и около 1 в секунду в один чат
+GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '25'))
+CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', '1'))
+CHAT_BURST = 3
+# Фоновые запросы не опустошают общий бакет: эта доля всегда остается запросам пользователей
+BACKGROUND_RESERVE = 0.3
+# Сколько раз повторять запрос после 429, прежде чем отдать ошибку вызывающему коду
+MAX_RETRY_AFTER_RETRIES = 3
+MAX_CHAT_BUCKETS = 10000
+
+PRIORITY_USER = 'user'
+PRIORITY_BACKGROUND = 'background'
+
+_priority: ContextVar[str] = ContextVar('telegram_priority', default=PRIORITY_USER)
+
+# Методы, на которые действует лимит Telegram на один чат
+_CHAT_SCOPED_PREFIXES = ('send', 'edit', 'copy', 'forward')
+
+
+def current_priority() -> str:
+    return _priority.get()
+
+
+@contextmanager
+def background_priority():
+    """Запросы к API внутри блока считаются фоновыми (напоминания, зачистка, рассылки)"""
+    token = _priority.set(PRIORITY_BACKGROUND)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def background_job(func):
+    """Декоратор для задач планировщика: все их запросы к API — фоновые"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with background_priority():
+            return await func(*args, **kwargs)
+    return wrapper
+
+
+def retry_delay(error: Exception, default: float) -> float:
+    """Пауза перед повтором: retry_after из ответа 429, иначе обычная пауза вызывающего кода"""
+    if isinstance(error, TelegramRetryAfter):
+        return error.retry_after
+    return default
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def try_acquire(self, reserve: float = 0.0) -> float:
+        """Берет токен и возвращает 0, либо возвращает, сколько секунд подождать"""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1 + reserve:
+            self.tokens -= 1
+            return 0.0
+        return (1 + reserve - self.tokens) / self.rate
+
+    async def acquire(self, reserve: float = 0.0) -> float:
+        """Ждет токен, возвращает время ожидания"""
+        waited = 0.0
+        while (delay := self.try_acquire(reserve)) > 0:
+            waited += delay
+            await asyncio.sleep(delay)
+        return waited
+
+    def pause(self, seconds: float):
+        """После 429 бакет закрыт на retry_after секунд и стартует пустым"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+        # Пополнение считается от конца паузы, иначе за время паузы бакет снова наполнится
+        self.updated = self.paused_until
+
+    @property
+    def idle(self) -> bool:
+        return time.monotonic() >= self.paused_until and \
+            self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """
+    Middleware сессии бота: через него проходит каждый запрос к Bot API.
+    - общий бакет на бота и бакеты на чат для отправки/редактирования сообщений;
+    - TelegramRetryAfter обрабатывается здесь: затронутый бакет (чат или общий)
+      ставится на паузу, запрос повторяется;
+    - фоновые запросы (background_priority) не могут выбрать общий бакет ниже
+      BACKGROUND_RESERVE, поэтому всплеск напоминаний не задерживает ответы пользователям.
+    """
+
+    def __init__(self, global_rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE,
+                 chat_burst: float = CHAT_BURST, max_retries: int = MAX_RETRY_AFTER_RETRIES):
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chat_buckets: OrderedDict = OrderedDict()
+        self.requests = 0
+        self.retry_after = 0
+        self.waited = 0.0
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            if len(self._chat_buckets) > MAX_CHAT_BUCKETS:
+                # Вытесняем давно не используемые, но не те, что на паузе после 429
+                for key in list(self._chat_buckets)[:len(self._chat_buckets) - MAX_CHAT_BUCKETS]:
+                    if self._chat_buckets[key].idle:
+                        del self._chat_buckets[key]
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    @staticmethod
+    def _chat_id(method):
+        name = getattr(method, '__api_method__', '')
+        if name.startswith(_CHAT_SCOPED_PREFIXES):
+            return getattr(method, 'chat_id', None)
+        return None
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = self._chat_id(method)
+        reserve = self.global_bucket.capacity * BACKGROUND_RESERVE if current_priority() == PRIORITY_BACKGROUND else 0.0
+        self.requests += 1
+        for attempt in range(self.max_retries + 1):
+            if chat_id is not None:
+                self.waited += await self._chat_bucket(chat_id).acquire()
+            self.waited += await self.global_bucket.acquire(reserve)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.retry_after += 1
+                scope = self._chat_bucket(chat_id) if chat_id is not None else self.global_bucket
+                scope.pause(e.retry_after)
+                logger.warning(
+                    f"429 на {getattr(method, '__api_method__', method)} "
+                    f"({'чат ' + str(chat_id) if chat_id is not None else 'весь бот'}): пауза {e.retry_after} сек, "
+                    f"попытка {attempt + 1}"
+                )
+                if attempt == self.max_retries:
+                    raise
+
+    def stats(self) -> dict:
+        return {
+            'requests': self.requests,
+            'retry_after': self.retry_after,
+            'waited_s': round(self.waited, 3),
+            'global_tokens': round(self.global_bucket.tokens, 2),
+            'chat_buckets': len(self._chat_buckets),
+        }
+
+
+rate_limiter = RateLimitMiddleware()
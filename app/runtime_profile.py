@@ -0,0 +1,65 @@
+import asyncio
+import json
+import logging
+import os
+
+try:
+    import uvloop
+except ImportError:  # uvloop не обязателен (и не собирается под Windows): без него стандартный цикл asyncio
+    uvloop = None
+
+try:
+    import orjson
+except ImportError:  # orjson не обязателен: без него работает стандартный json
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# Профиль исполнения: default — стандартный asyncio и json,
+# fast — uvloop и orjson для (де)сериализации Bot API, если пакеты установлены
+RUNTIME_PROFILE = os.getenv('RUNTIME_PROFILE', 'default').lower()
+PROFILES = ('default', 'fast')
+
+
+def is_fast(profile: str = RUNTIME_PROFILE) -> bool:
+    if profile not in PROFILES:
+        raise ValueError(f"Неизвестный профиль исполнения: {profile} (допустимо: {', '.join(PROFILES)})")
+    return profile == 'fast'
+
+
+def _orjson_dumps(value) -> str:
+    return orjson.dumps(value).decode()
+
+
+def json_codec(fast: bool):
+    """(имя, loads, dumps): orjson при fast и установленном пакете, иначе стандартный json"""
+    if fast and orjson is not None:
+        return 'orjson', orjson.loads, _orjson_dumps
+    return 'json', json.loads, json.dumps
+
+
+def loop_factory(profile: str = RUNTIME_PROFILE):
+    """Фабрика цикла событий для asyncio.Runner: uvloop в профиле fast, None — стандартный цикл"""
+    if is_fast(profile) and uvloop is not None:
+        return uvloop.new_event_loop
+    return None
+
+
+def describe(profile: str = RUNTIME_PROFILE) -> dict:
+    """Что реально используется в профиле с учетом установленных пакетов"""
+    fast = is_fast(profile)
+    return {
+        'profile': profile,
+        'loop': 'uvloop' if loop_factory(profile) is not None else 'asyncio',
+        'json': json_codec(fast)[0],
+    }
+
+
+def run(main, profile: str = RUNTIME_PROFILE):
+    """asyncio.run(main) в цикле событий выбранного профиля"""
+    if is_fast(profile):
+        missing = [name for name, module in (('uvloop', uvloop), ('orjson', orjson)) if module is None]
+        if missing:
+            logger.warning(f"Профиль fast: не установлены {', '.join(missing)}, используется стандартная реализация")
+    with asyncio.Runner(loop_factory=loop_factory(profile)) as runner:
+        return runner.run(main)
@@ -4,6 +4,10 @@ from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 from app.subscription_service import subscription_service
 from app.google_sheets_service import google_sheets_service
+from app.query_stats import track_job
+from app.rate_limiter import background_job
+from app.archive import archive_expired_subscriptions
+from app.slow_queries import slow_query_log, SLOW_QUERY_REPORT_INTERVAL
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
@@ -11,6 +15,8 @@ logger = logging.getLogger(__name__)
 # Инициализация планировщика с явным указанием таймзоны UTC
 scheduler = AsyncIOScheduler(timezone='UTC')
 
+@track_job
+@background_job
 async def send_registration_reminders_task():
     """Рассылка через 3 часа после регистрации без оформления подписки"""
     try:
@@ -18,27 +24,17 @@ async def send_registration_reminders_task():
     except Exception as e:
         logger.error(f"Ошибка в задаче send_registration_reminders: {e}")
 
-async def send_subscription_reminders_task():
-    """Рассылка за сутки до окончания подписки"""
+@track_job
+@background_job
+async def send_due_notifications_task():
+    """Отправка наступивших запланированных уведомлений (за сутки, в последний день, после истечения)"""
     try:
-        await subscription_service.send_subscription_reminders()
+        await subscription_service.send_due_notifications()
     except Exception as e:
-        logger.error(f"Ошибка в задаче send_subscription_reminders: {e}")
-
-async def send_last_day_reminders_task():
-    """Рассылка в последний день действия подписки"""
-    try:
-        await subscription_service.send_last_day_reminders()
-    except Exception as e:
-        logger.error(f"Ошибка в задаче send_last_day_reminders: {e}")
-
-async def send_expired_reminders_task():
-    """Рассылка в день истечения подписки"""
-    try:
-        await subscription_service.send_expired_reminders()
-    except Exception as e:
-        logger.error(f"Ошибка в задаче send_expired_reminders: {e}")
+        logger.error(f"Ошибка в задаче send_due_notifications: {e}")
 
+@track_job
+@background_job
 async def check_expired_subscriptions_task():
     """Проверка и деактивация истекших подписок"""
     try:
@@ -46,6 +42,8 @@ async def check_expired_subscriptions_task():
     except Exception as e:
         logger.error(f"Ошибка в задаче check_expired_subscriptions: {e}")
 
+@track_job
+@background_job
 async def force_cleanup_expired_task():
     """Принудительная зачистка всех, у кого истекла дата"""
     try:
@@ -53,6 +51,18 @@ async def force_cleanup_expired_task():
     except Exception as e:
         logger.error(f"Ошибка в задаче force_cleanup_expired: {e}")
 
+@track_job
+async def archive_expired_subscriptions_task():
+    """Перенос давно истекших подписок в архивную таблицу"""
+    try:
+        await archive_expired_subscriptions(subscription_service.async_session_maker)
+    except Exception as e:
+        logger.error(f"Ошибка в задаче archive_expired_subscriptions: {e}")
+
+async def slow_query_report_task():
+    """Сводка медленных запросов за интервал"""
+    slow_query_log.report()
+
 async def async_record_payment(user_id, username, amount, duration_days, plan_name, payment_type, transaction_id):
     """
     Асинхронная обертка для записи платежа в Google Sheets.
@@ -82,43 +92,43 @@ def setup_scheduler():
         replace_existing=True
     )
 
-    # Каждый час
+    # Каждые 5 минут: заменяет почасовые сканирования по флагам *_reminder_sent
     scheduler.add_job(
-        send_subscription_reminders_task,
-        IntervalTrigger(hours=1),
-        id='send_subscription_reminders',
+        send_due_notifications_task,
+        IntervalTrigger(minutes=5),
+        id='send_due_notifications',
         replace_existing=True
     )
 
-    # Каждый час
+    # Каждые 5 минут
     scheduler.add_job(
-        send_last_day_reminders_task,
-        IntervalTrigger(hours=1),
-        id='send_last_day_reminders',
+        check_expired_subscriptions_task,
+        IntervalTrigger(minutes=5),
+        id='check_expired_subscriptions',
         replace_existing=True
     )
 
-    # Каждый час
+    # Запуск раз в час
     scheduler.add_job(
-        send_expired_reminders_task,
+        force_cleanup_expired_task,
         IntervalTrigger(hours=1),
-        id='send_expired_reminders',
+        id='force_cleanup_expired',
         replace_existing=True
     )
 
-    # Каждые 5 минут
+    # Раз в сутки, пачками с короткими транзакциями
     scheduler.add_job(
-        check_expired_subscriptions_task,
-        IntervalTrigger(minutes=5),
-        id='check_expired_subscriptions',
+        archive_expired_subscriptions_task,
+        IntervalTrigger(days=1),
+        id='archive_expired_subscriptions',
         replace_existing=True
     )
 
-    # Запуск раз в час
+    # Сводка медленных запросов (app/slow_queries.py)
     scheduler.add_job(
-        force_cleanup_expired_task,
-        IntervalTrigger(hours=1),
-        id='force_cleanup_expired',
+        slow_query_report_task,
+        IntervalTrigger(seconds=SLOW_QUERY_REPORT_INTERVAL),
+        id='slow_query_report',
         replace_existing=True
     )
 
@@ -0,0 +1,205 @@
+import logging
+import os
+import re
+import sys
+import time
+
+from greenlet import getcurrent
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app.query_stats import statement_shape
+
+logger = logging.getLogger(__name__)
+
+# Запросы дольше порога (мс) попадают в журнал медленных запросов; 0 — выключено
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '200'))
+# EXPLAIN (ANALYZE, BUFFERS) для первого медленного SELECT каждой формы (только Postgres)
+SLOW_QUERY_EXPLAIN = os.getenv('SLOW_QUERY_EXPLAIN', 'False').lower() in ('true', '1', 't')
+# Как часто (сек) писать сводку медленных форм за интервал
+SLOW_QUERY_REPORT_INTERVAL = int(os.getenv('SLOW_QUERY_REPORT_INTERVAL', '300'))
+
+# SELECT, который нельзя выполнить повторно ради плана: SELECT ... INTO создает таблицу,
+# FOR UPDATE/SHARE берет блокировки строк, nextval/setval меняют последовательности
+_WRITE_OR_LOCK = re.compile(r"\b(INTO|FOR\s+(NO\s+KEY\s+)?UPDATE|FOR\s+(KEY\s+)?SHARE|NEXTVAL|SETVAL)\b", re.IGNORECASE)
+
+_APP_DIR = os.path.dirname(os.path.abspath(__file__))
+_THIS_FILE = os.path.abspath(__file__)
+_installed = False
+
+
+def redact_parameters(parameters, executemany=False):
+    """Параметры без значений: типы вместо данных (Telegram ID, email, ссылки не попадают в лог)"""
+    def redact(value):
+        if value is None or isinstance(value, bool):
+            return value
+        return f"<{type(value).__name__}>"
+
+    def redact_row(row):
+        if isinstance(row, dict):
+            return {key: redact(value) for key, value in row.items()}
+        if isinstance(row, (list, tuple)):
+            return [redact(value) for value in row]
+        return redact(row)
+
+    if executemany and isinstance(parameters, (list, tuple)):
+        return {'rows': len(parameters), 'first': redact_row(parameters[0]) if parameters else None}
+    return redact_row(parameters)
+
+
+def _app_function(frame):
+    """Имя функции приложения (Класс.метод), если кадр из кода app/ (кроме этого модуля)"""
+    filename = os.path.abspath(frame.f_code.co_filename)
+    if filename.startswith(_APP_DIR) and filename != _THIS_FILE:
+        return getattr(frame.f_code, 'co_qualname', frame.f_code.co_name)
+    return None
+
+
+def find_caller():
+    """
+    Функция приложения, выполнившая запрос. При синхронном вызове она в стеке текущего потока.
+    AsyncSession выполняет запрос в дочернем greenlet: тогда ищем в стеке родительского greenlet,
+    остановленного в greenlet_spawn, — через него проходит цепочка ожидающих корутин.
+    """
+    current = getcurrent()
+    frame = sys._getframe(1)
+    while True:
+        while frame is not None:
+            name = _app_function(frame)
+            if name:
+                return name
+            frame = frame.f_back
+        current = current.parent
+        if current is None:
+            return None
+        frame = current.gr_frame
+
+
+class SlowShape:
+    __slots__ = ('count', 'total', 'max', 'callers', 'plan')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.callers = set()
+        self.plan = None
+
+
+class SlowQueryLog:
+    """
+    Журнал медленных запросов: каждый запрос дольше порога пишется в лог с формой, параметрами
+    без значений и функцией приложения; формы копятся за интервал и сводятся в report().
+    """
+
+    def __init__(self, threshold_ms=SLOW_QUERY_MS, explain=SLOW_QUERY_EXPLAIN):
+        self.threshold = threshold_ms / 1000
+        self.explain = explain
+        self.shapes: dict[str, SlowShape] = {}
+        self.explained: set[str] = set()
+        self.interval_started = time.monotonic()
+
+    def record(self, conn, statement, parameters, duration, executemany=False):
+        shape = statement_shape(statement)
+        caller = find_caller()
+        entry = self.shapes.get(shape)
+        if entry is None:
+            entry = self.shapes[shape] = SlowShape()
+        entry.count += 1
+        entry.total += duration
+        entry.max = max(entry.max, duration)
+        if caller:
+            entry.callers.add(caller)
+
+        plan = None
+        if self.explain and shape not in self.explained and self._explainable(conn, statement, executemany):
+            self.explained.add(shape)
+            plan = self._explain(conn, statement, parameters)
+            entry.plan = plan
+        logger.warning(
+            "Медленный запрос %.1f мс в %s: %s | параметры: %s%s",
+            duration * 1000, caller or '?', shape[:500], redact_parameters(parameters, executemany),
+            f"\n{plan}" if plan else "",
+            extra={'category': 'slow_query', 'duration_ms': round(duration * 1000, 1), 'caller': caller}
+        )
+
+    @staticmethod
+    def _explainable(conn, statement, executemany):
+        # EXPLAIN ANALYZE выполняет запрос еще раз, поэтому только чистое чтение: обычный SELECT
+        # без блокировок. WITH не берем — в CTE может быть INSERT/UPDATE/DELETE
+        if conn.dialect.name != 'postgresql' or executemany or not statement.strip():
+            return False
+        if statement.split(None, 1)[0].upper() != 'SELECT':
+            return False
+        return _WRITE_OR_LOCK.search(statement) is None
+
+    @staticmethod
+    def _explain(conn, statement, parameters):
+        # Отдельный курсор того же соединения: результат исходного запроса еще не прочитан
+        try:
+            cursor = conn.connection.cursor()
+            try:
+                cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS) {statement}", parameters)
+                return "\n".join(row[0] for row in cursor.fetchall())
+            finally:
+                cursor.close()
+        except Exception as e:
+            logger.debug("EXPLAIN не выполнен: %s", e)
+            return None
+
+    def report(self, reset=True):
+        """Сводка медленных форм за интервал по суммарному времени; пишет в лог и возвращает текст"""
+        elapsed = time.monotonic() - self.interval_started
+        if not self.shapes:
+            text = ""
+        else:
+            lines = [f"Медленные запросы за {elapsed:.0f} сек (порог {self.threshold * 1000:.0f} мс):"]
+            for shape, entry in sorted(self.shapes.items(), key=lambda item: item[1].total, reverse=True):
+                callers = ", ".join(sorted(entry.callers)) or "?"
+                lines.append(
+                    f"  {entry.count} × всего {entry.total * 1000:.0f} мс, макс {entry.max * 1000:.0f} мс, "
+                    f"{callers}: {shape[:300]}"
+                )
+            text = "\n".join(lines)
+            logger.warning(text, extra={'category': 'slow_query_report'})
+        if reset:
+            self.shapes = {}
+            self.interval_started = time.monotonic()
+        return text
+
+
+slow_query_log = SlowQueryLog()
+
+
+# ─── Хуки SQLAlchemy ──────────────────────────────────────────────────────────
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("slow_query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get("slow_query_start")
+    if not starts:
+        return
+    duration = time.perf_counter() - starts.pop()
+    if duration >= slow_query_log.threshold:
+        slow_query_log.record(conn, statement, parameters, duration, executemany)
+
+
+def _handle_error(exception_context):
+    # Запрос завершился ошибкой: after_cursor_execute не будет, снимаем его отметку времени
+    conn = exception_context.connection
+    starts = conn.info.get("slow_query_start") if conn is not None else None
+    if starts:
+        starts.pop()
+
+
+def install_slow_query_log():
+    """Подключает замер всех запросов ко всем движкам (при SLOW_QUERY_MS=0 ничего не делает)"""
+    global _installed
+    if _installed or slow_query_log.threshold <= 0:
+        return
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(Engine, "handle_error", _handle_error)
+    _installed = True
@@ -0,0 +1,33 @@
+import logging
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimer:
+    """Длительность этапов запуска: итоговый отчет пишется в лог одной строкой на этап"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: list[tuple[str, float]] = []
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((name, time.perf_counter() - started))
+
+    def total(self) -> float:
+        return time.perf_counter() - self.started
+
+    def report(self) -> str:
+        width = max((len(name) for name, _ in self.stages), default=0)
+        lines = [f"{name:<{width}}  {seconds * 1000:8.1f} мс" for name, seconds in self.stages]
+        lines.append(f"{'итого':<{width}}  {self.total() * 1000:8.1f} мс")
+        return "\n".join(lines)
+
+    def log(self):
+        logger.info("Время запуска по этапам:\n" + self.report())
@@ -0,0 +1,161 @@
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from sqlalchemy import select, func, update
+from sqlalchemy.dialects import postgresql, sqlite
+from app.database import DailyStat, SubscriptionPlan, UserSubscription
+
+STAT_FIELDS = ('new_count', 'extended_count', 'expired_count', 'cancelled_count', 'revenue')
+
+# Сколько секунд отдаем /stats и прогноз истечений из кэша
+STATS_CACHE_TTL = 60
+FORECAST_CACHE_TTL = 300
+FORECAST_DAYS = 7
+
+_cache = {}
+
+
+def _cached(key, ttl):
+    entry = _cache.get(key)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    return None
+
+
+def _store(key, ttl, value):
+    _cache[key] = (time.monotonic() + ttl, value)
+    return value
+
+
+def clear_cache():
+    _cache.clear()
+
+
+async def record_stat(session, plan_id=None, day=None, **increments):
+    """
+    Инкремент дневных счетчиков в текущей транзакции вызывающего кода.
+    record_stat(session, plan.id, new_count=1, revenue=18000)
+    """
+    unknown = set(increments) - set(STAT_FIELDS)
+    if unknown:
+        raise ValueError(f"Неизвестные счетчики статистики: {unknown}")
+    increments = {k: v for k, v in increments.items() if v}
+    if not increments:
+        return
+
+    day = day or datetime.utcnow().date()
+    plan_id = plan_id or 0
+    dialect = session.get_bind().dialect.name
+
+    if dialect in ('postgresql', 'sqlite'):
+        insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        stmt = insert(DailyStat).values(day=day, plan_id=plan_id, **increments)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['day', 'plan_id'],
+            set_={k: getattr(DailyStat, k) + stmt.excluded[k] for k in increments}
+        )
+        await session.execute(stmt)
+        return
+
+    # Прочие СУБД: UPDATE, а если строки еще нет — INSERT
+    result = await session.execute(
+        update(DailyStat)
+        .where(DailyStat.day == day, DailyStat.plan_id == plan_id)
+        .values({k: getattr(DailyStat, k) + v for k, v in increments.items()})
+    )
+    if result.rowcount == 0:
+        session.add(DailyStat(day=day, plan_id=plan_id, **{k: 0 for k in STAT_FIELDS}, **increments))
+        await session.flush()
+
+
+async def get_expiry_forecast(session_maker, days=FORECAST_DAYS):
+    """Количество активных подписок, истекающих в каждый из ближайших days дней (один GROUP BY)"""
+    cached = _cached(('forecast', days), FORECAST_CACHE_TTL)
+    if cached is not None:
+        return cached
+
+    now = datetime.utcnow()
+    end_day = func.date(UserSubscription.end_date)
+    async with session_maker() as session:
+        result = await session.execute(
+            select(end_day, func.count())
+            .where(
+                UserSubscription.is_active == True,
+                UserSubscription.end_date > now,
+                UserSubscription.end_date <= now + timedelta(days=days)
+            )
+            .group_by(end_day)
+            .order_by(end_day)
+        )
+        forecast = [(str(day), count) for day, count in result.all()]
+    return _store(('forecast', days), FORECAST_CACHE_TTL, forecast)
+
+
+def _plan_label(plan_id, name, ambiguous):
+    if plan_id is None or name is None:
+        return 'Без плана' if plan_id is None else f'Тариф #{plan_id}'
+    return f'{name} (#{plan_id})' if ambiguous else name
+
+
+async def get_stats_summary(session_maker):
+    """Данные для /stats: счетчики из daily_stats за 1/7/30 дней, активные подписчики, прогноз"""
+    cached = _cached('summary', STATS_CACHE_TTL)
+    if cached is not None:
+        return cached
+
+    today = datetime.utcnow().date()
+    summary = {'periods': {}, 'revenue_by_plan': []}
+    async with session_maker() as session:
+        for label, days in (('today', 1), ('week', 7), ('month', 30)):
+            result = await session.execute(
+                select(*[func.coalesce(func.sum(getattr(DailyStat, k)), 0) for k in STAT_FIELDS])
+                .where(DailyStat.day > today - timedelta(days=days))
+            )
+            summary['periods'][label] = dict(zip(STAT_FIELDS, result.one()))
+
+        # Группировка по plan_id: тарифы с одинаковым названием (переименованные, пересозданные)
+        # не сливаются, название — только подпись
+        result = await session.execute(
+            select(DailyStat.plan_id, SubscriptionPlan.name, func.sum(DailyStat.revenue))
+            .select_from(DailyStat)
+            .outerjoin(SubscriptionPlan, SubscriptionPlan.id == DailyStat.plan_id)
+            .where(DailyStat.day > today - timedelta(days=30), DailyStat.revenue > 0)
+            .group_by(DailyStat.plan_id, SubscriptionPlan.name)
+            .order_by(func.sum(DailyStat.revenue).desc())
+        )
+        rows = result.all()
+        names = Counter(name for _, name, _ in rows)
+        summary['revenue_by_plan'] = [
+            (_plan_label(plan_id, name, names[name] > 1), revenue) for plan_id, name, revenue in rows
+        ]
+
+        result = await session.execute(
+            select(func.count(func.distinct(UserSubscription.user_id))).where(
+                UserSubscription.is_active == True,
+                UserSubscription.end_date > datetime.utcnow()
+            )
+        )
+        summary['active_subscribers'] = result.scalar_one()
+
+    summary['forecast'] = await get_expiry_forecast(session_maker)
+    return _store('summary', STATS_CACHE_TTL, summary)
+
+
+def format_stats(summary) -> str:
+    titles = {'today': 'Сегодня', 'week': '7 дней', 'month': '30 дней'}
+    lines = ["📊 <b>Статистика</b>", "", f"Активных подписчиков: {summary['active_subscribers']}", ""]
+    for label, counters in summary['periods'].items():
+        lines.append(
+            f"<b>{titles[label]}:</b> новых {counters['new_count']}, продлений {counters['extended_count']}, "
+            f"истекло {counters['expired_count']}, отменено {counters['cancelled_count']}, "
+            f"выручка {counters['revenue'] / 100:.0f}₽"
+        )
+    if summary['revenue_by_plan']:
+        lines += ["", "<b>Выручка по планам (30 дней):</b>"]
+        lines += [f"  {name}: {revenue / 100:.0f}₽" for name, revenue in summary['revenue_by_plan']]
+    lines += ["", f"<b>Истекают в ближайшие {FORECAST_DAYS} дней:</b>"]
+    if summary['forecast']:
+        lines += [f"  {day}: {count}" for day, count in summary['forecast']]
+    else:
+        lines.append("  нет")
+    return '\n'.join(lines)
@@ -0,0 +1,169 @@
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+
+# Формат вывода: json (по строке JSON на запись) или text (как logging.basicConfig)
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+# Сколько записей ждет записи в очереди; при переполнении отбрасываются только необязательные
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+# Доля сохраняемых записей по категориям: LOG_SAMPLING="reminder_sent=0.05,join_request=0.2"
+DEFAULT_SAMPLING = {
+    'reminder_sent': 0.05,
+    'join_request': 0.2,
+    'access_removed': 0.2,
+    'chat_member': 0.2,
+}
+
+# Атрибуты LogRecord, которые не попадают в поля JSON
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'category', 'audit'}
+
+
+def parse_sampling(value: str) -> dict:
+    rates = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        name, _, rate = item.partition('=')
+        rates[name.strip()] = float(rate)
+    return rates
+
+
+def log_extra(category: str, **fields) -> dict:
+    """extra для записи категории category (подлежит выборке) с полями для JSON"""
+    return {'category': category, **fields}
+
+
+def audit_extra(category: str, **fields) -> dict:
+    """extra для аудиторской записи: не участвует в выборке и не отбрасывается при переполнении очереди"""
+    return {'category': category, 'audit': True, **fields}
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Выборка записей по категориям. Предупреждения, ошибки и аудиторские записи проходят всегда,
+    записи без категории — тоже. Отброшенная запись не форматируется.
+    """
+
+    def __init__(self, rates=None, rand=random.random):
+        super().__init__()
+        self.rates = DEFAULT_SAMPLING if rates is None else rates
+        self.rand = rand
+        self.dropped = {}
+
+    def filter(self, record):
+        category = getattr(record, 'category', None)
+        if category is None or getattr(record, 'audit', False) or record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(category, 1.0)
+        if rate >= 1.0 or self.rand() < rate:
+            return True
+        self.dropped[category] = self.dropped.get(category, 0) + 1
+        return False
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна строка JSON на запись: время, уровень, логгер, сообщение, категория и поля из extra"""
+
+    def format(self, record):
+        data = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        if getattr(record, 'category', None):
+            data['category'] = record.category
+        if getattr(record, 'audit', False):
+            data['audit'] = True
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                data[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        if record.stack_info:
+            data['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """
+    Кладет записи в очередь, форматирование и запись в поток — в отдельном потоке QueueListener.
+    Сообщение подставляется здесь же (аргументы могут быть объектами ORM, которые нельзя трогать
+    из другого потока), но только для записей, прошедших уровень и выборку.
+    При переполнении очереди обычные записи отбрасываются, аудиторские ждут места.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if getattr(record, 'audit', False):
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener = None
+_handler = None
+
+
+def setup_logging(level=LOG_LEVEL, fmt=LOG_FORMAT, sampling=None, stream=None):
+    """
+    Настраивает корневой логгер: очередь + поток записи, JSON или текст, выборка по категориям.
+    Повторный вызов заменяет предыдущую настройку. Возвращает QueueListener.
+    """
+    global _listener, _handler
+    stop_logging()
+    output = logging.StreamHandler(stream or sys.stderr)
+    if fmt == 'json':
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    handler = AsyncQueueHandler(log_queue)
+    rates = dict(DEFAULT_SAMPLING)
+    rates.update(parse_sampling(os.getenv('LOG_SAMPLING', '')) if sampling is None else sampling)
+    handler.addFilter(SamplingFilter(rates))
+
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+    _handler = handler
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def stop_logging():
+    """Дописывает все записи из очереди и останавливает поток записи"""
+    global _listener, _handler
+    if _handler is not None:
+        logging.getLogger().removeHandler(_handler)
+        _handler = None
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
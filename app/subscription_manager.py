@@ -1,7 +1,11 @@
 from app.database import User, SubscriptionPlan, UserSubscription
 from datetime import datetime, timedelta
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy import select, update
+from sqlalchemy import select, update, and_
+from collections import Counter
+from app.stats_service import record_stat
+from app.notifications import (schedule_subscription_notifications, cancel_subscription_notifications,
+                               cancel_registration_reminder)
 
 class SubscriptionManager:
     def __init__(self, session):
@@ -68,10 +72,11 @@ class SubscriptionManager:
                 subscription.reminder_sent = reminder_sent
             
             self.session.add(subscription)
+            await self.session.flush()
+            await schedule_subscription_notifications(self.session, subscription.id, user_id, end_date)
+            await cancel_registration_reminder(self.session, user_id)
             if commit:
                 await self.session.commit()
-            else:
-                await self.session.flush()
             return subscription
         except SQLAlchemyError as e:
             if commit:
@@ -87,7 +92,10 @@ class SubscriptionManager:
             if not subscription:
                 raise ValueError("Подписка не найдена")
             
+            if subscription.is_active:
+                await record_stat(self.session, subscription.plan_id, cancelled_count=1)
             subscription.is_active = False
+            await cancel_subscription_notifications(self.session, [subscription.id])
             await self.session.commit()
             return subscription
         except SQLAlchemyError as e:
@@ -112,6 +120,7 @@ class SubscriptionManager:
             if reminder_sent is not None:
                 subscription.reminder_sent = reminder_sent
             
+            await schedule_subscription_notifications(self.session, subscription.id, subscription.user_id, subscription.end_date)
             await self.session.commit()
             return subscription
         except SQLAlchemyError as e:
@@ -131,6 +140,7 @@ class SubscriptionManager:
                 raise ValueError("У пользователя нет активной подписки")
             
             current_subscription.is_active = False
+            await cancel_subscription_notifications(self.session, [current_subscription.id])
             
             return await self.subscribe_user(user_id, new_plan_id)
         except SQLAlchemyError as e:
@@ -147,24 +157,41 @@ class SubscriptionManager:
         result = await self.session.execute(query)
         return result.scalars().all()
     
-    async def check_subscription_expiration(self):
-        """Проверить и обновить статус подписок, срок действия которых истек"""
-        now = datetime.utcnow()
-        
+    async def expire_due_subscriptions(self, now=None, chunk_size=None):
+        """
+        Деактивировать истекшие подписки одним UPDATE ... RETURNING id, user_id, plan_id
+        без загрузки ORM-объектов. chunk_size — обновлять порциями (каждая в своей транзакции),
+        чтобы не держать долгие блокировки на большой таблице. Возвращает легкие строки
+        (id, user_id, plan_id) — по ним вызывающий код может отзывать доступ.
+        """
+        now = now or datetime.utcnow()
+        due = and_(UserSubscription.is_active == True, UserSubscription.end_date < now)
+        expired = []
         try:
-            result = await self.session.execute(select(UserSubscription).where(
-                UserSubscription.is_active == True,
-                UserSubscription.end_date < now
-            ))
-            expired_subscriptions = result.scalars().all()
-            
-            for subscription in expired_subscriptions:
-                subscription.is_active = False
-            
-            if expired_subscriptions:
+            while True:
+                stmt = update(UserSubscription)
+                if chunk_size:
+                    chunk = select(UserSubscription.id).where(due).order_by(UserSubscription.id).limit(chunk_size)
+                    stmt = stmt.where(UserSubscription.id.in_(chunk.scalar_subquery()))
+                else:
+                    stmt = stmt.where(due)
+                stmt = (
+                    stmt.values(is_active=False)
+                    .returning(UserSubscription.id, UserSubscription.user_id, UserSubscription.plan_id)
+                    .execution_options(synchronize_session=False)
+                )
+                rows = (await self.session.execute(stmt)).all()
+                for plan_id, count in Counter(row.plan_id for row in rows).items():
+                    await record_stat(self.session, plan_id, expired_count=count)
                 await self.session.commit()
-                
-            return expired_subscriptions
+                expired.extend(rows)
+                if not chunk_size or len(rows) < chunk_size:
+                    return expired
         except SQLAlchemyError as e:
             await self.session.rollback()
-            raise e 
\ No newline at end of file
+            raise e
+
+    async def check_subscription_expiration(self):
+        """Проверить и обновить статус подписок, срок действия которых истек"""
+        return await self.expire_due_subscriptions()
+
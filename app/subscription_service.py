@@ -1,20 +1,26 @@
-from app.database import async_init_db, get_async_session_maker, User, SubscriptionPlan, UserSubscription
+from app.database import (async_init_db, get_async_session_maker, User, SubscriptionPlan, UserSubscription, ScheduledNotification,
+                          PlanChannel, SubscriptionInvite)
 from app.subscription_manager import SubscriptionManager
+from app.stats_service import record_stat
+from app.rate_limiter import retry_delay
+from app.migrations import telegram_id_filter
+from app.membership import record_membership, get_memberships, is_member
+from app.channel_workers import channel_workers
+from app.structured_logging import log_extra
+from app.notifications import (cancel_subscription_notifications, schedule_registration_reminder,
+                               NOTIFICATION_TEXTS, LEGACY_FLAGS, SUBSCRIPTION_KINDS, REGISTRATION_KINDS,
+                               NOTIFICATION_BATCH_SIZE, NOTIFICATION_MAX_ATTEMPTS, REGISTRATION_REMINDERS_PER_RUN)
 from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
 from datetime import datetime, timedelta
 import os
-from dotenv import load_dotenv
 import logging
 import asyncio
-from sqlalchemy import select, and_
+from sqlalchemy import select, insert, update, and_, tuple_
 from sqlalchemy.orm import joinedload
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 import random
 import traceback
 
-# Загружаем переменные окружения
-load_dotenv()
-
 PAYMENT_TEST_MODE = os.getenv('PAYMENT_TEST_MODE', 'False').lower() in ('true', '1', 't')
 
 # Словарь соответствия callback_data и реальных значений
@@ -28,13 +34,18 @@ DURATION_MAP = {
 if PAYMENT_TEST_MODE:
     DURATION_MAP['5_min'] = 5 / (24 * 60)  # 5 минут в днях
 
-# ID каналов для разных типов подписок из .env
+# ID каналов для разных типов подписок из .env (наличие PREMIUM_CHANNEL_ID проверяет main() при запуске)
 PREMIUM_CHANNEL_ID = os.getenv('PREMIUM_CHANNEL_ID')
-if not PREMIUM_CHANNEL_ID:
-    raise ValueError("Не задана переменная окружения PREMIUM_CHANNEL_ID. Укажите её в .env!")
 CHANNEL_IDS = {
     'premium_subscription': PREMIUM_CHANNEL_ID
 }
+# Каналы отдельных продуктов: EXTRA_CHANNEL_IDS="basic:-1001111111111,bonus:-1003333333333"
+for _item in filter(None, (part.strip() for part in os.getenv('EXTRA_CHANNEL_IDS', '').split(','))):
+    _key, _, _channel_id = _item.partition(':')
+    CHANNEL_IDS[_key.strip()] = _channel_id.strip()
+
+# Каналы тарифа по ключам CHANNEL_IDS; пакет — несколько ключей в 'channels'
+DEFAULT_PLAN_CHANNELS = ['premium_subscription']
 
 NEW_PLANS = [
     {'name': 'Подписка на 7 дней', 'days': 7, 'price': 6000},
@@ -44,104 +55,157 @@ NEW_PLANS = [
     {'name': 'Подписка на 1 год', 'days': 365, 'price': 140000},
 ]
 
+async def plan_channel_ids(session, plan):
+    """Каналы тарифа по порядку; у тарифов без plan_channels — SubscriptionPlan.channel_id"""
+    result = await session.execute(
+        select(PlanChannel.channel_id).where(PlanChannel.plan_id == plan.id).order_by(PlanChannel.position)
+    )
+    channel_ids = list(result.scalars().all())
+    return channel_ids or ([plan.channel_id] if plan.channel_id else [])
+
+
+async def plans_channel_ids(session, plans):
+    """plan_channel_ids для набора тарифов одним запросом: {plan_id: [channel_id, ...]}"""
+    plans = {plan.id: plan for plan in plans}
+    channel_ids = {plan_id: [] for plan_id in plans}
+    if plans:
+        result = await session.execute(
+            select(PlanChannel.plan_id, PlanChannel.channel_id)
+            .where(PlanChannel.plan_id.in_(list(plans)))
+            .order_by(PlanChannel.plan_id, PlanChannel.position)
+        )
+        for plan_id, channel_id in result.all():
+            channel_ids[plan_id].append(channel_id)
+    return {
+        plan_id: channels or ([plans[plan_id].channel_id] if plans[plan_id].channel_id else [])
+        for plan_id, channels in channel_ids.items()
+    }
+
+
 class SubscriptionService:
     def __init__(self, async_session_maker=None):
         self.engine = None
-        self.async_session_maker = async_session_maker or get_async_session_maker()
+        # Без явного session maker движок создается при первом запросе к БД, а не при импорте
+        self._async_session_maker = async_session_maker
         self.bot = None
+        # Каталог актуальных тарифов: заполняется при запуске, тарифы меняются только с деплоем
+        self._plan_catalog = None
         # self.manager = SubscriptionManager(self.session)  # manager будет переписан отдельно
         # Инициализация тарифных планов будет async
         # asyncio.create_task(self._init_subscription_plans())
     
+    @property
+    def async_session_maker(self):
+        if self._async_session_maker is None:
+            self._async_session_maker = get_async_session_maker()
+        return self._async_session_maker
+
+    @async_session_maker.setter
+    def async_session_maker(self, value):
+        self._async_session_maker = value
+
     def set_bot(self, bot):
         """Установка экземпляра бота для работы с API Telegram"""
         self.bot = bot
     
     async def _init_subscription_plans(self):
-        """Инициализация тарифных планов и миграция старых подписок"""
+        """
+        Инициализация тарифных планов и миграция старых подписок.
+        Число запросов не зависит от числа тарифов: один SELECT тарифов, одна пачка INSERT недостающих,
+        синхронизация plan_channels и один UPDATE для миграции подписок.
+        """
         async with self.async_session_maker() as session:
             # 1. Создаем новые планы, если их нет
-            new_plans_map = {} # map name -> plan object
-            
-            for plan_data in NEW_PLANS:
-                result = await session.execute(select(SubscriptionPlan).where(
-                    SubscriptionPlan.name == plan_data['name'],
-                    SubscriptionPlan.price == plan_data['price'],
-                    SubscriptionPlan.duration_days == plan_data['days']
-                ))
-                plan = result.scalar_one_or_none()
-                
-                if not plan:
-                    plan = SubscriptionPlan(
-                        name=plan_data['name'],
-                        description=f"Доступ к каналу на {plan_data['days']} дней",
-                        price=plan_data['price'],
-                        duration_days=plan_data['days'],
-                        channel_id=CHANNEL_IDS['premium_subscription'] # Все новые планы для премиум канала
-                    )
-                    session.add(plan)
-                    await session.flush() # Получаем ID
-                    logging.info(f"Создан новый план: {plan.name}")
-
-                new_plans_map[plan.name] = plan
-            
-            # 2. Миграция: находим старые планы и переводим активные подписки на 'Подписка на 1 месяц'
-            # Целевой план для миграции
-            target_plan = new_plans_map.get('Подписка на 1 месяц')
+            plan_keys = [(plan_data['name'], plan_data['price'], plan_data['days']) for plan_data in NEW_PLANS]
+            plans_query = select(SubscriptionPlan).where(
+                tuple_(SubscriptionPlan.name, SubscriptionPlan.price, SubscriptionPlan.duration_days).in_(plan_keys)
+            )
+            existing = {(plan.name, plan.price, plan.duration_days): plan for plan in (await session.execute(plans_query)).scalars().all()}
+
+            plans_channels = {}
+            missing = []
+            for plan_data, key in zip(NEW_PLANS, plan_keys):
+                channel_ids = [CHANNEL_IDS[channel] for channel in plan_data.get('channels', DEFAULT_PLAN_CHANNELS) if CHANNEL_IDS.get(channel)]
+                plans_channels[key] = channel_ids
+                if key not in existing:
+                    missing.append({
+                        'name': plan_data['name'],
+                        'description': f"Доступ к каналу на {plan_data['days']} дней",
+                        'price': plan_data['price'],
+                        'duration_days': plan_data['days'],
+                        'channel_id': channel_ids[0] if channel_ids else None  # Основной канал тарифа
+                    })
+            if missing:
+                # Один INSERT (executemany) на все новые тарифы, затем перечитываем их с ID
+                await session.execute(insert(SubscriptionPlan), missing)
+                existing = {(plan.name, plan.price, plan.duration_days): plan for plan in (await session.execute(plans_query)).scalars().all()}
+                logging.info(f"Созданы новые планы: {', '.join(plan['name'] for plan in missing)}")
+
+            new_plans = [existing[key] for key in plan_keys]
+            await self._sync_plan_channels(session, {existing[key].id: channels for key, channels in plans_channels.items()})
+
+            # 2. Миграция: активные подписки на старые планы переводим на 'Подписка на 1 месяц'
+            target_plan = next((plan for plan in new_plans if plan.name == 'Подписка на 1 месяц'), None)
             if not target_plan:
                 logging.error("Не удалось найти целевой план 'Подписка на 1 месяц' для миграции!")
             else:
-                # Получаем все планы, которые НЕ являются новыми планами
-                new_plan_ids = [p.id for p in new_plans_map.values()]
-                result = await session.execute(select(SubscriptionPlan).where(SubscriptionPlan.id.not_in(new_plan_ids)))
-                old_plans = result.scalars().all()
-
-                old_plan_ids = [p.id for p in old_plans]
-
-                if old_plan_ids:
-                    # Находим все активные подписки на старые планы
-                    result = await session.execute(select(UserSubscription).where(
-                        UserSubscription.plan_id.in_(old_plan_ids),
-                        UserSubscription.is_active == True
-                    ))
-                    subscriptions_to_migrate = result.scalars().all()
-
-                    if subscriptions_to_migrate:
-                        logging.info(f"Найдено {len(subscriptions_to_migrate)} подписок для миграции на новый тариф.")
-                        for sub in subscriptions_to_migrate:
-                            sub.plan_id = target_plan.id
-                            session.add(sub)
+                result = await session.execute(
+                    update(UserSubscription)
+                    .where(UserSubscription.plan_id.not_in([plan.id for plan in new_plans]),
+                           UserSubscription.is_active == True)
+                    .values(plan_id=target_plan.id)
+                    .execution_options(synchronize_session=False)
+                )
+                if result.rowcount:
+                    logging.info(f"Переведено на новый тариф подписок: {result.rowcount}")
 
-                        logging.info("Миграция подписок завершена.")
-            
             await session.commit()
+        self._plan_catalog = new_plans
+
+    async def _sync_plan_channels(self, session, channels_by_plan):
+        """Приводит plan_channels тарифов к спискам каналов из конфигурации: {plan_id: [channel_id, ...]}"""
+        result = await session.execute(select(PlanChannel).where(PlanChannel.plan_id.in_(list(channels_by_plan))))
+        existing = {(row.plan_id, row.channel_id): row for row in result.scalars().all()}
+        for plan_id, channel_ids in channels_by_plan.items():
+            for position, channel_id in enumerate(channel_ids):
+                row = existing.pop((plan_id, channel_id), None)
+                if row is None:
+                    session.add(PlanChannel(plan_id=plan_id, channel_id=channel_id, position=position))
+                elif row.position != position:
+                    row.position = position
+        for row in existing.values():
+            await session.delete(row)
 
     async def get_active_plans(self):
-        """Возвращает список актуальных тарифных планов"""
-        async with self.async_session_maker() as session:
-             # Возвращаем планы, соответствующие списку NEW_PLANS
-            plans = []
-            for plan_def in NEW_PLANS:
+        """Возвращает список актуальных тарифных планов (из каталога в памяти после первого обращения)"""
+        if self._plan_catalog is None:
+            async with self.async_session_maker() as session:
+                # Планы, соответствующие списку NEW_PLANS, одним запросом и в порядке NEW_PLANS
+                plan_keys = [(plan_def['name'], plan_def['price'], plan_def['days']) for plan_def in NEW_PLANS]
                 result = await session.execute(select(SubscriptionPlan).where(
-                    SubscriptionPlan.name == plan_def['name'],
-                    SubscriptionPlan.price == plan_def['price'],
-                    SubscriptionPlan.duration_days == plan_def['days']
+                    tuple_(SubscriptionPlan.name, SubscriptionPlan.price, SubscriptionPlan.duration_days).in_(plan_keys)
                 ))
-                plan = result.scalar_one_or_none()
-                if plan:
-                    plans.append(plan)
-            return plans
+                plans = {(plan.name, plan.price, plan.duration_days): plan for plan in result.scalars().all()}
+            self._plan_catalog = [plans[key] for key in plan_keys if key in plans]
+        return list(self._plan_catalog)
+
+    def invalidate_plan_catalog(self):
+        """Сбрасывает каталог тарифов (после ручного изменения subscription_plans)"""
+        self._plan_catalog = None
 
     async def get_user_by_telegram_id(self, telegram_user_id):
         """Получение пользователя по Telegram ID или создание нового"""
         async with self.async_session_maker() as session:
-            result = await session.execute(select(User).where(User.telegram_user_id == str(telegram_user_id)))
+            result = await session.execute(select(User).where(telegram_id_filter(User, telegram_user_id)))
             user = result.scalar_one_or_none()
             
             if not user:
                 # Создаем нового пользователя
-                user = User(telegram_user_id=str(telegram_user_id), is_active=True)
+                user = User(telegram_id=int(telegram_user_id), is_active=True)
                 session.add(user)
+                await session.flush()
+                # Напоминание об оплате, если пользователь не оформит подписку
+                await schedule_registration_reminder(session, user.id, user.created_at)
                 await session.commit()
             
             return user
@@ -189,7 +253,7 @@ class SubscriptionService:
         for attempt in range(max_retries):
             try:
                 async with self.async_session_maker() as session:
-                    result = await session.execute(select(User).where(User.telegram_user_id == str(user_id)))
+                    result = await session.execute(select(User).where(telegram_id_filter(User, user_id)))
                     user = result.scalar_one_or_none()
                     if not user:
                         raise ValueError(f"Пользователь с Telegram ID {user_id} не найден")
@@ -198,24 +262,99 @@ class SubscriptionService:
                     subscription = sub_result.scalar_one_or_none()
                     if not subscription:
                         raise ValueError(f"Активная подписка для пользователя {user_id} не найдена")
-                    invite_link_obj = await self.bot.create_chat_invite_link(
-                        chat_id=channel_id,
-                        name=f"Subscription_{user.telegram_user_id}",
-                        creates_join_request=True,
-                        expire_date=datetime.now() + timedelta(days=7)
+                    # Читающая транзакция не держится открытой на время запроса к Telegram
+                    await session.commit()
+                    invite_link = await channel_workers.run(channel_id, self._create_invite_link, channel_id, user.tg_id)
+                    # Прежние ссылки подписки в этот канал больше не нужны
+                    await session.execute(
+                        update(SubscriptionInvite)
+                        .where(SubscriptionInvite.subscription_id == subscription.id,
+                               SubscriptionInvite.channel_id == str(channel_id),
+                               SubscriptionInvite.revoked_at.is_(None))
+                        .values(revoked_at=datetime.utcnow())
                     )
+                    session.add(SubscriptionInvite(subscription_id=subscription.id, channel_id=str(channel_id), invite_link=invite_link))
                     # Сохраняем ссылку в подписке
-                    subscription.invite_link = invite_link_obj.invite_link
+                    subscription.invite_link = invite_link
                     session.add(subscription)
                     await session.commit()
-                    return invite_link_obj.invite_link
+                    return invite_link
             except Exception as e:
                 logging.error(f"Ошибка при создании ссылки-приглашения (попытка {attempt+1}): {str(e)}")
                 if attempt < max_retries - 1:
-                    await asyncio.sleep(2 ** attempt + random.uniform(0, 1))
+                    await asyncio.sleep(retry_delay(e, 2 ** attempt + random.uniform(0, 1)))
                 else:
                     raise ValueError(f"Не удалось создать ссылку-приглашение после {max_retries} попыток: {str(e)}")
     
+    async def _create_invite_link(self, channel_id, telegram_id):
+        """Ссылка с заявкой на вступление для одного пользователя, живет 7 дней"""
+        invite_link_obj = await self.bot.create_chat_invite_link(
+            chat_id=channel_id,
+            name=f"Subscription_{telegram_id}",
+            creates_join_request=True,
+            expire_date=datetime.now() + timedelta(days=7)
+        )
+        return invite_link_obj.invite_link
+
+    async def create_invites(self, channel_ids, telegram_id):
+        """Ссылки во все каналы тарифа параллельно, каждая — в очереди своего канала: {channel_id: invite_link}"""
+        links = await channel_workers.run_all(channel_ids, self._create_invite_link, telegram_id)
+        return dict(zip(channel_ids, links))
+
+    async def create_subscription_invites(self, telegram_user_id):
+        """
+        Новые ссылки во все каналы активной подписки (после продления).
+        Прежние неиспользованные ссылки помечаются отозванными. Возвращает список ссылок по порядку каналов.
+        """
+        if not self.bot:
+            raise ValueError("Бот не установлен в сервисе подписок")
+        async with self.async_session_maker() as session:
+            result = await session.execute(
+                select(UserSubscription).options(joinedload(UserSubscription.plan))
+                .join(User, User.id == UserSubscription.user_id)
+                .where(telegram_id_filter(User, telegram_user_id), UserSubscription.is_active == True)
+            )
+            subscription = result.scalars().first()
+            if not subscription:
+                raise ValueError(f"Активная подписка для пользователя {telegram_user_id} не найдена")
+            channel_ids = await plan_channel_ids(session, subscription.plan)
+        # Ссылки создаются вне транзакции, результат сохраняется короткой транзакцией
+        links = await self.create_invites(channel_ids, int(telegram_user_id))
+        await self._save_invites(subscription.id, channel_ids, links)
+        return [links[channel_id] for channel_id in channel_ids]
+
+    async def _save_invites(self, subscription_id, channel_ids, links):
+        """Новые ссылки подписки вместо прежних неиспользованных"""
+        async with self.async_session_maker() as session:
+            async with session.begin():
+                await session.execute(
+                    update(SubscriptionInvite)
+                    .where(SubscriptionInvite.subscription_id == subscription_id, SubscriptionInvite.revoked_at.is_(None))
+                    .values(revoked_at=datetime.utcnow())
+                )
+                session.add_all([
+                    SubscriptionInvite(subscription_id=subscription_id, channel_id=str(channel_id), invite_link=links[channel_id])
+                    for channel_id in channel_ids
+                ])
+                await session.execute(
+                    update(UserSubscription).where(UserSubscription.id == subscription_id)
+                    .values(invite_link=links[channel_ids[0]] if channel_ids else None)
+                )
+
+    async def get_invite_links(self, subscription_id):
+        """Неиспользованные ссылки подписки по порядку создания (для старых подписок — UserSubscription.invite_link)"""
+        async with self.async_session_maker() as session:
+            result = await session.execute(
+                select(SubscriptionInvite.invite_link)
+                .where(SubscriptionInvite.subscription_id == subscription_id, SubscriptionInvite.revoked_at.is_(None))
+                .order_by(SubscriptionInvite.id)
+            )
+            links = list(result.scalars().all())
+            if not links:
+                legacy = await session.execute(select(UserSubscription.invite_link).where(UserSubscription.id == subscription_id))
+                links = [link for link in legacy.scalars().all() if link]
+        return links
+
     async def approve_join_request(self, chat_id, user_id):
         """Одобряет запрос пользователя на вступление в канал"""
         if not self.bot:
@@ -224,45 +363,85 @@ class SubscriptionService:
         try:
             # Одобряем запрос на вступление
             async with self.async_session_maker() as session:
-                result = await session.execute(select(User).where(User.telegram_user_id == str(user_id)))
+                result = await session.execute(select(User).where(telegram_id_filter(User, user_id)))
                 user = result.scalar_one_or_none()
                 if not user:
                     raise ValueError(f"Пользователь с ID {user_id} не найден")
                 
                 await self.bot.approve_chat_join_request(
                     chat_id=chat_id,
-                    user_id=user.telegram_user_id
+                    user_id=user.tg_id
                 )
             return True
         except Exception as e:
             return False
     
-    async def is_valid_join_request(self, invite_link, user_id):
+    async def is_valid_join_request(self, invite_link, user_id, chat_id=None):
         """Проверяет, валиден ли запрос на вступление от данного пользователя через базу"""
+        now = datetime.utcnow()
         async with self.async_session_maker() as session:
-            result = await session.execute(
-                select(UserSubscription).where(
-                    UserSubscription.invite_link == invite_link,
+            # Ссылки подписок (по одной на канал тарифа)
+            stmt = (
+                select(User.telegram_id, User.telegram_user_id)
+                .join(UserSubscription, UserSubscription.user_id == User.id)
+                .join(SubscriptionInvite, SubscriptionInvite.subscription_id == UserSubscription.id)
+                .where(
+                    SubscriptionInvite.invite_link == invite_link,
+                    SubscriptionInvite.revoked_at.is_(None),
                     UserSubscription.is_active == True,
-                    UserSubscription.end_date > datetime.utcnow()
+                    UserSubscription.end_date > now
                 )
             )
-            sub = result.scalar_one_or_none()
-            if not sub:
+            if chat_id is not None:
+                stmt = stmt.where(SubscriptionInvite.channel_id == str(chat_id))
+            owner = (await session.execute(stmt)).first()
+            if owner is None:
+                # Ссылки, созданные до subscription_invites
+                result = await session.execute(
+                    select(User.telegram_id, User.telegram_user_id)
+                    .join(UserSubscription, UserSubscription.user_id == User.id)
+                    .where(
+                        UserSubscription.invite_link == invite_link,
+                        UserSubscription.is_active == True,
+                        UserSubscription.end_date > now
+                    )
+                )
+                owner = result.first()
+            if owner is None:
                 return False
-            user_result = await session.execute(select(User).where(User.id == sub.user_id))
-            user = user_result.scalar_one_or_none()
-            return user and str(user.telegram_user_id) == str(user_id)
-    
-    async def create_subscription(self, telegram_user_id, subscription_type=None, duration=None, plan_id=None):
-        """Создание подписки для пользователя с полной транзакционностью"""
+            telegram_id = owner.telegram_id if owner.telegram_id is not None else int(owner.telegram_user_id)
+            return telegram_id == int(user_id)
+
+    async def revoke_used_invite(self, chat_id, invite_link):
+        """
+        Отзывает ссылку после вступления по ней. Вызывается из обработчика заявки, который уже
+        выполняется в очереди канала, поэтому запрос к API идет напрямую.
+        """
+        await self.bot.revoke_chat_invite_link(chat_id=chat_id, invite_link=invite_link)
+        async with self.async_session_maker() as session:
+            await session.execute(
+                update(SubscriptionInvite)
+                .where(SubscriptionInvite.invite_link == invite_link, SubscriptionInvite.revoked_at.is_(None))
+                .values(revoked_at=datetime.utcnow())
+            )
+            await session.execute(
+                update(UserSubscription).where(UserSubscription.invite_link == invite_link).values(invite_link=None)
+            )
+            await session.commit()
+
+    async def create_subscription(self, telegram_user_id, subscription_type=None, duration=None, plan_id=None, payment_amount=None):
+        """
+        Создание подписки для пользователя (payment_amount — в копейках, для статистики).
+        Подписка сохраняется одной транзакцией, ссылки в каналы создаются после ее фиксации
+        и записываются отдельной короткой транзакцией.
+        """
         async with self.async_session_maker() as session:
             async with session.begin():
                 # Получаем или создаем пользователя
-                result = await session.execute(select(User).where(User.telegram_user_id == str(telegram_user_id)))
+                result = await session.execute(select(User).where(telegram_id_filter(User, telegram_user_id)))
                 user = result.scalar_one_or_none()
                 if not user:
-                    user = User(telegram_user_id=str(telegram_user_id), is_active=True)
+                    user = User(telegram_id=int(telegram_user_id), is_active=True)
                     session.add(user)
                     await session.flush()
                 # Получаем план подписки
@@ -283,34 +462,36 @@ class SubscriptionService:
                 for subscription in active_subscriptions:
                     subscription.is_active = False
                     session.add(subscription)
+                await cancel_subscription_notifications(session, [s.id for s in active_subscriptions])
                 
                 # Создаем новую подписку
                 subscription = await SubscriptionManager(session).subscribe_user(user.id, plan.id, reminder_sent=False, commit=False)
+                await record_stat(session, plan.id, new_count=1,
+                                  revenue=plan.price if payment_amount is None else payment_amount)
                 
-                # Генерируем ссылку и сохраняем её
-                if plan.channel_id and self.bot:
-                    try:
-                        invite_link_obj = await self.bot.create_chat_invite_link(
-                            chat_id=plan.channel_id,
-                            name=f"Subscription_{user.telegram_user_id}",
-                            creates_join_request=True,
-                            expire_date=datetime.now() + timedelta(days=7)
-                        )
-                        subscription.invite_link = invite_link_obj.invite_link
-                    except Exception as e:
-                        logging.error(f"Ошибка при создании ссылки-приглашения: {str(e)}")
-                        raise
+                channel_ids = await plan_channel_ids(session, plan)
                 session.add(subscription)
                 await session.flush()
                 subscription_id = subscription.id
-            return subscription_id
+                telegram_id = user.tg_id
+
+        # Генерируем ссылки во все каналы тарифа и сохраняем их
+        if channel_ids and self.bot:
+            try:
+                links = await self.create_invites(channel_ids, telegram_id)
+            except Exception as e:
+                # Подписка уже сохранена: ссылки можно выдать повторно через create_subscription_invites
+                logging.error(f"Ошибка при создании ссылки-приглашения для подписки {subscription_id}: {str(e)}")
+                raise
+            await self._save_invites(subscription_id, channel_ids, links)
+        return subscription_id
     
     async def get_subscription_info(self, telegram_user_id):
         """Получение информации о текущей подписке пользователя"""
         user = await self.get_user_by_telegram_id(telegram_user_id)
-        # Проверяем и обновляем истекшие подписки
+        # Проверяем и обновляем истекшие подписки (один UPDATE без загрузки объектов)
         async with self.async_session_maker() as session:
-            await SubscriptionManager(session).check_subscription_expiration()
+            await SubscriptionManager(session).expire_due_subscriptions()
         # Получаем только активную подписку
         async with self.async_session_maker() as session:
             result = await session.execute(select(UserSubscription).where(UserSubscription.user_id == user.id, UserSubscription.is_active == True))
@@ -330,11 +511,12 @@ class SubscriptionService:
             'days_left': max(0, days_left),
             'is_active': subscription.is_active,
             'channel_id': plan.channel_id if plan else None,
-            'invite_link': subscription.invite_link
+            'invite_link': subscription.invite_link,
+            'invite_links': await self.get_invite_links(subscription.id)
         }
     
-    async def remove_user_access(self, subscription, max_retries=3):
-        """Отзыв доступа пользователя к каналу"""
+    async def remove_user_access(self, subscription, max_retries=3, reason='expired'):
+        """Отзыв доступа пользователя к каналу (reason: 'expired' | 'cancelled' — для статистики)"""
         if not self.bot:
             logging.error("Бот не инициализирован в SubscriptionService")
             return False
@@ -370,52 +552,105 @@ class SubscriptionService:
                     )
                 )
                 if active_check.scalars().first():
-                    logging.info(f"ЗАЩИТА: Юзер {user.telegram_user_id} имеет другую активную подписку. Кик отменен.")
+                    logging.info(f"ЗАЩИТА: Юзер {user.tg_id} имеет другую активную подписку. Кик отменен.")
+                    if db_subscription.is_active:
+                        await record_stat(session, db_subscription.plan_id, **{f'{reason}_count': 1})
                     db_subscription.is_active = False
                     db_subscription.invite_link = None
+                    await cancel_subscription_notifications(session, [db_subscription.id])
                     session.add(db_subscription)
                     return True
                 # ======================================================================================
 
-                removed = False
-                for attempt in range(max_retries):
-                    try:
-                        await self.bot.ban_chat_member(chat_id=db_subscription.plan.channel_id, user_id=user.telegram_user_id)
-                        await self.bot.unban_chat_member(chat_id=db_subscription.plan.channel_id, user_id=user.telegram_user_id, only_if_banned=True)
-                        removed = True
-                        break
-                    except Exception as e:
-                        if "USER_NOT_PARTICIPANT" in str(e) or "user not found" in str(e).lower() or "chat not found" in str(e).lower():
-                            logging.info(f"REMOVE: Пользователя {user.telegram_user_id} уже нет в канале {db_subscription.plan.channel_id} или канал недоступен.")
-                            removed = True # Считаем успехом, чтобы снять флаг активности
-                            break
-                        logging.error(f"Ошибка при бане пользователя (попытка {attempt + 1}): {e}")
-                        if attempt < max_retries - 1:
-                            await asyncio.sleep(2 + attempt + random.uniform(0, 1))
-
-                # Логика отзыва ссылки
-                if db_subscription.invite_link:
-                    for attempt in range(max_retries):
-                        try:
-                            await self.bot.revoke_chat_invite_link(chat_id=db_subscription.plan.channel_id, invite_link=db_subscription.invite_link)
-                            break
-                        except Exception as e:
-                            if "INVITE_HASH_EXPIRED" in str(e) or "not found" in str(e).lower():
-                                logging.info(f"REMOVE: Ссылка {db_subscription.invite_link} уже неактивна.")
-                                break
-                            logging.error(f"Ошибка при отзыве ссылки (попытка {attempt + 1}): {e}")
-                            if attempt < max_retries - 1:
-                                await asyncio.sleep(2 + attempt + random.uniform(0, 1))
-
+                channel_ids = await plan_channel_ids(session, db_subscription.plan)
+                statuses = await get_memberships(session, [(channel_id, user.tg_id) for channel_id in channel_ids])
+                invites = await session.execute(
+                    select(SubscriptionInvite.channel_id, SubscriptionInvite.invite_link).where(
+                        SubscriptionInvite.subscription_id == db_subscription.id,
+                        SubscriptionInvite.revoked_at.is_(None)
+                    )
+                )
+                links = {}
+                for channel_id, invite_link in invites.all():
+                    links.setdefault(channel_id, []).append(invite_link)
+                # Ссылка, созданная до subscription_invites, относится к основному каналу
+                if db_subscription.invite_link and channel_ids and db_subscription.invite_link not in links.get(str(channel_ids[0]), []):
+                    links.setdefault(str(channel_ids[0]), []).append(db_subscription.invite_link)
+
+                telegram_id = user.tg_id
+
+                # Сначала фиксируем в БД, что доступа больше нет: транзакция не держится открытой
+                # на время вызовов Telegram, а заявки по отзываемым ссылкам уже не пройдут проверку
+                await session.execute(
+                    update(SubscriptionInvite)
+                    .where(SubscriptionInvite.subscription_id == db_subscription.id, SubscriptionInvite.revoked_at.is_(None))
+                    .values(revoked_at=datetime.utcnow())
+                )
                 # Важно: меняем статус у объекта, загруженного в ЭТОЙ сессии
+                if db_subscription.is_active:
+                    await record_stat(session, db_subscription.plan_id, **{f'{reason}_count': 1})
                 db_subscription.is_active = False
                 db_subscription.invite_link = None
+                if reason == 'cancelled':
+                    await cancel_subscription_notifications(session, [db_subscription.id])
                 session.add(db_subscription)
                 # commit произойдет автоматически при выходе из context manager session.begin()
-                
+
+        # Отзыв доступа во всех каналах тарифа параллельно, каждый канал — в своей очереди
+        kicked = await channel_workers.run_all(
+            channel_ids, self._revoke_channel_access, telegram_id, statuses, links, max_retries
+        )
+        left = [channel_id for channel_id, was_kicked in zip(channel_ids, kicked) if was_kicked]
+        if left:
+            async with self.async_session_maker() as session:
+                async with session.begin():
+                    for channel_id in left:
+                        await record_membership(session, channel_id, telegram_id, 'left')
         return True
 
 
+    async def _revoke_channel_access(self, channel_id, telegram_id, statuses, links, max_retries=3):
+        """
+        Бан с разбаном и отзыв ссылок в одном канале; выполняется в очереди канала без обращений к БД.
+        Возвращает True, если пользователь был удален из канала.
+        """
+        kicked = False
+        # Кикаем только тех, кто в канале или о ком ничего не известно
+        status = statuses.get((str(channel_id), int(telegram_id)))
+        removed = status is not None and not is_member(status)
+        if removed:
+            logging.info("REMOVE: Пользователь %s уже не в канале %s (%s), бан не нужен.", telegram_id, channel_id, status,
+                         extra=log_extra('access_removed', user_id=telegram_id, chat_id=channel_id))
+        for attempt in range(0 if removed else max_retries):
+            try:
+                await self.bot.ban_chat_member(chat_id=channel_id, user_id=telegram_id)
+                await self.bot.unban_chat_member(chat_id=channel_id, user_id=telegram_id, only_if_banned=True)
+                kicked = True
+                break
+            except Exception as e:
+                if "USER_NOT_PARTICIPANT" in str(e) or "user not found" in str(e).lower() or "chat not found" in str(e).lower():
+                    logging.info("REMOVE: Пользователя %s уже нет в канале %s или канал недоступен.", telegram_id, channel_id,
+                                 extra=log_extra('access_removed', user_id=telegram_id, chat_id=channel_id))
+                    break
+                logging.error(f"Ошибка при бане пользователя (попытка {attempt + 1}): {e}")
+                if attempt < max_retries - 1:
+                    await asyncio.sleep(retry_delay(e, 2 + attempt + random.uniform(0, 1)))
+
+        # Логика отзыва ссылок
+        for invite_link in links.get(str(channel_id), []):
+            for attempt in range(max_retries):
+                try:
+                    await self.bot.revoke_chat_invite_link(chat_id=channel_id, invite_link=invite_link)
+                    break
+                except Exception as e:
+                    if "INVITE_HASH_EXPIRED" in str(e) or "not found" in str(e).lower():
+                        logging.info("REMOVE: Ссылка %s уже неактивна.", invite_link, extra=log_extra('access_removed', chat_id=channel_id))
+                        break
+                    logging.error(f"Ошибка при отзыве ссылки (попытка {attempt + 1}): {e}")
+                    if attempt < max_retries - 1:
+                        await asyncio.sleep(retry_delay(e, 2 + attempt + random.uniform(0, 1)))
+        return kicked
+
     async def get_expiring_subscriptions(self, hours=24):
         """
         Находит подписки, истекающие через указанное количество часов (по умолчанию 24).
@@ -457,223 +692,101 @@ class SubscriptionService:
         )
 
     async def send_registration_reminders(self):
-        """Рассылка через 3 часа после регистрации без оформления подписки"""
-        if not self.bot:
-            logging.error("Бот не инициализирован в SubscriptionService")
-            return
-
-        now = datetime.utcnow()
-        three_hours_ago = now - timedelta(hours=3)
-
-        async with self.async_session_maker() as session:
-            result = await session.execute(
-                select(User).where(
-                    and_(
-                        User.created_at <= three_hours_ago,
-                        User.first_start_reminder_sent == False,
-                        ~User.subscriptions.any(UserSubscription.is_active == True)
-                    )
-                )
-            )
-            users = result.scalars().all()
-
-            for user in users:
-                try:
-                    first_name = user.first_name or "Друг"
-                    text = (
-                        f"{first_name}! Мы ждём Вас в нашем канале с эксклюзивными товарами "
-                        f"за кешбэк 100 %. Осталось только оплатить подписку — сделаем это прямо сейчас?\n\n"
-                        f"Начните зарабатывать и экономить уже сегодня💥"
-                    )
-                    await self.bot.send_message(
-                        chat_id=user.telegram_user_id,
-                        text=text,
-                        reply_markup=self._get_payment_keyboard()
-                    )
-                    user.first_start_reminder_sent = True
-                    session.add(user)
-                    logging.info(f"Отправлено напоминание о регистрации пользователю {user.telegram_user_id}")
-
-                except (TelegramForbiddenError, TelegramBadRequest) as e:
-                    # Бот заблокирован или аккаунт удалён — больше не пытаемся
-                    user.first_start_reminder_sent = True
-                    user.is_active = False
-                    session.add(user)
-                    logging.info(f"Пользователь {user.telegram_user_id} недоступен ({e}), помечаем флаг")
-
-                except Exception as e:
-                    logging.error(f"Ошибка при отправке напоминания о регистрации пользователю {user.telegram_user_id}: {e}")
-                    # Флаг НЕ ставим — попробуем в следующий раз
-
-            await session.commit()
+        """
+        Напоминание через 3 часа после регистрации без оформления подписки.
+        Пользователи ставятся в очередь при регистрации, оплата снимает их с очереди,
+        поэтому задача обрабатывает не больше REGISTRATION_REMINDERS_PER_RUN наступивших записей.
+        """
+        return await self.send_due_notifications(kinds=REGISTRATION_KINDS, limit=REGISTRATION_REMINDERS_PER_RUN)
+
+    def _notification_relevant(self, notification, subscription, user, active_user_ids, now):
+        """Актуально ли уведомление на момент отправки"""
+        if notification.kind == 'registration':
+            return user.is_active and not user.first_start_reminder_sent and notification.user_id not in active_user_ids
+        if notification.kind in ('expiring_24h', 'last_day'):
+            return subscription is not None and subscription.is_active and subscription.end_date > now
+        if notification.kind == 'expired':
+            # Защита от спама: человек уже оплатил новую подписку или продлил эту
+            return subscription is not None and subscription.end_date <= now \
+                and notification.user_id not in active_user_ids
+        return True
 
-    async def send_subscription_reminders(self):
-        """Рассылка за сутки до окончания подписки"""
+    async def send_due_notifications(self, now=None, limit=None, kinds=SUBSCRIPTION_KINDS):
+        """
+        Диспетчер запланированных уведомлений (за сутки, в последний день, после истечения).
+        Читает только наступившие строки scheduled_notifications по частичному индексу,
+        поэтому стоимость зависит от числа наступивших уведомлений, а не от размера таблиц.
+        """
         if not self.bot:
             logging.error("Бот не инициализирован в SubscriptionService")
-            return
-
-        now = datetime.utcnow()
-        tomorrow = now + timedelta(hours=24)
+            return 0
 
+        now = now or datetime.utcnow()
+        sent = 0
         async with self.async_session_maker() as session:
             result = await session.execute(
-                select(UserSubscription).options(joinedload(UserSubscription.user)).where(
-                    and_(
-                        UserSubscription.is_active == True,
-                        UserSubscription.end_date <= tomorrow,
-                        UserSubscription.end_date > now,
-                        UserSubscription.reminder_sent == False
-                    )
+                select(ScheduledNotification, UserSubscription, User)
+                .join(User, User.id == ScheduledNotification.user_id)
+                .outerjoin(UserSubscription, UserSubscription.id == ScheduledNotification.subscription_id)
+                .where(
+                    ScheduledNotification.status == 'pending',
+                    ScheduledNotification.due_at <= now,
+                    ScheduledNotification.kind.in_(kinds)
                 )
+                .order_by(ScheduledNotification.due_at)
+                .limit(limit or NOTIFICATION_BATCH_SIZE)
             )
-            subscriptions = result.scalars().all()
-
-            for sub in subscriptions:
-                user = sub.user
-                if not user:
-                    continue
-                try:
-                    text = (
-                        "Внимание: завтра Ваша подписка истекает. "
-                        "Чтобы не прерывать доступ к кешбэку 100 %, "
-                        "оформите оплату на следующий месяц уже сегодня."
-                    )
-                    await self.bot.send_message(
-                        chat_id=user.telegram_user_id,
-                        text=text,
-                        reply_markup=self._get_payment_keyboard()
-                    )
-                    sub.reminder_sent = True
-                    session.add(sub)
-                    logging.info(f"Отправлено напоминание за сутки пользователю {user.telegram_user_id}")
+            due = result.all()
+            if not due:
+                return 0
 
-                except (TelegramForbiddenError, TelegramBadRequest) as e:
-                    sub.reminder_sent = True  # Не можем доставить — снимаем с очереди
-                    session.add(sub)
-                    logging.info(f"Пользователь {user.telegram_user_id} недоступен ({e}), пропускаем")
-
-                except Exception as e:
-                    logging.error(f"Ошибка при отправке напоминания за сутки пользователю {user.telegram_user_id}: {e}")
-
-            await session.commit()
-
-    async def send_last_day_reminders(self):
-        """Рассылка в последний день действия подписки"""
-        if not self.bot:
-            logging.error("Бот не инициализирован в SubscriptionService")
-            return
-
-        now = datetime.utcnow()
-        end_of_today = now.replace(hour=23, minute=59, second=59)
-
-        async with self.async_session_maker() as session:
+            # Пользователи с действующей подпиской — одним запросом на всю пачку
             result = await session.execute(
-                select(UserSubscription).options(joinedload(UserSubscription.user)).where(
-                    and_(
-                        UserSubscription.is_active == True,
-                        UserSubscription.end_date <= end_of_today,
-                        UserSubscription.end_date > now,
-                        UserSubscription.last_day_reminder_sent == False
-                    )
-                )
-            )
-            subscriptions = result.scalars().all()
-
-            for sub in subscriptions:
-                user = sub.user
-                if not user:
-                    continue
-                try:
-                    text = (
-                        "Не дайте подписке закончиться! Сегодня последний день — "
-                        "продлите доступ к каналу и продолжайте получать кешбэк 100 %."
-                    )
-                    await self.bot.send_message(
-                        chat_id=user.telegram_user_id,
-                        text=text,
-                        reply_markup=self._get_payment_keyboard()
-                    )
-                    sub.last_day_reminder_sent = True
-                    session.add(sub)
-                    logging.info(f"Отправлено напоминание в последний день пользователю {user.telegram_user_id}")
-
-                except (TelegramForbiddenError, TelegramBadRequest) as e:
-                    sub.last_day_reminder_sent = True
-                    session.add(sub)
-                    logging.info(f"Пользователь {user.telegram_user_id} недоступен ({e}), пропускаем")
-
-                except Exception as e:
-                    logging.error(f"Ошибка при отправке напоминания в последний день пользователю {user.telegram_user_id}: {e}")
-
-            await session.commit()
-
-    async def send_expired_reminders(self):
-        """Рассылка после истечения подписки"""
-        if not self.bot:
-            logging.error("Бот не инициализирован в SubscriptionService")
-            return
-
-        now = datetime.utcnow()
-
-        async with self.async_session_maker() as session:
-            result = await session.execute(
-                select(UserSubscription).options(joinedload(UserSubscription.user)).where(
-                    and_(
-                        UserSubscription.is_active == False,
-                        UserSubscription.end_date <= now,
-                        UserSubscription.expired_reminder_sent == False
-                    )
+                select(UserSubscription.user_id).where(
+                    UserSubscription.user_id.in_({user.id for _, _, user in due}),
+                    UserSubscription.is_active == True,
+                    UserSubscription.end_date > now
                 )
             )
-            subscriptions = result.scalars().all()
+            active_user_ids = set(result.scalars().all())
 
-            for sub in subscriptions:
-                user = sub.user
-                if not user:
-                    continue
-                
-                # === ИСПРАВЛЕНИЕ №2: Защита от спама (если человек уже оплатил новую подписку) ===
-                active_check = await session.execute(
-                    select(UserSubscription).where(
-                        UserSubscription.user_id == user.id,
-                        UserSubscription.is_active == True,
-                        UserSubscription.end_date > now
-                    )
-                )
-                if active_check.scalars().first():
-                    # Тихо помечаем, что уведомление об истечении "отправлено", чтобы больше сюда не возвращаться
-                    sub.expired_reminder_sent = True
-                    session.add(sub)
-                    continue
-                # =================================================================================
-
-                try:
-                    first_name = user.first_name or "Друг"
-                    text = (
-                        f"{first_name}, привет! Сообщаем, что доступ к каналу закрыт — подписка истекла.\n\n"
-                        f"Не хотите пропустить новые предложения с кешбэком 100 %? "
-                        f"Продлите доступ прямо сейчас."
-                    )
-                    await self.bot.send_message(
-                        chat_id=user.telegram_user_id,
-                        text=text,
-                        reply_markup=self._get_payment_keyboard()
-                    )
-                    sub.expired_reminder_sent = True
-                    session.add(sub)
-                    logging.info(f"Отправлено уведомление об истечении пользователю {user.telegram_user_id}")
+            for notification, sub, user in due:
+                if not self._notification_relevant(notification, sub, user, active_user_ids, now):
+                    notification.status = 'cancelled'
+                else:
+                    notification.attempts += 1
+                    try:
+                        await self.bot.send_message(
+                            chat_id=user.tg_id,
+                            text=NOTIFICATION_TEXTS[notification.kind].format(first_name=user.first_name or "Друг"),
+                            reply_markup=self._get_payment_keyboard()
+                        )
+                        notification.status = 'sent'
+                        notification.sent_at = datetime.utcnow()
+                        sent += 1
+                        logging.info("Отправлено уведомление %s пользователю %s", notification.kind, user.tg_id,
+                                     extra=log_extra('reminder_sent', kind=notification.kind, user_id=user.tg_id))
+
+                    except (TelegramForbiddenError, TelegramBadRequest) as e:
+                        # Не можем доставить — снимаем с очереди
+                        notification.status = 'failed'
+                        if notification.kind == 'registration':
+                            # Бот заблокирован или аккаунт удалён — больше не пытаемся
+                            user.is_active = False
+                        logging.info(f"Пользователь {user.tg_id} недоступен ({e}), пропускаем")
 
-                except (TelegramForbiddenError, TelegramBadRequest) as e:
-                    # Не можем доставить — ставим флаг, иначе будет спам в логах каждый час
-                    sub.expired_reminder_sent = True
-                    session.add(sub)
-                    logging.info(f"Пользователь {user.telegram_user_id} недоступен ({e}), пропускаем")
+                    except Exception as e:
+                        logging.error(f"Ошибка при отправке уведомления {notification.kind} пользователю {user.tg_id}: {e}")
+                        if notification.attempts >= NOTIFICATION_MAX_ATTEMPTS:
+                            notification.status = 'failed'
 
-                except Exception as e:
-                    logging.error(f"Ошибка при отправке уведомления об истечении: {e}")
+                if notification.status != 'pending' and sub is not None and notification.kind in LEGACY_FLAGS:
+                    setattr(sub, LEGACY_FLAGS[notification.kind], True)
+                if notification.status != 'pending' and notification.kind == 'registration':
+                    user.first_start_reminder_sent = True
 
             await session.commit()
+        return sent
 
     async def check_expired_subscriptions(self):
         """Проверка и деактивация истекших подписок"""
@@ -690,13 +803,14 @@ class SubscriptionService:
             )
             expired = result.scalars().all()
 
-            for sub in expired:
-                try:
-                    # Используем existing method remove_user_access
-                    await self.remove_user_access(sub)
-                    logging.info(f"Отозван доступ для подписки {sub.id}")
-                except Exception as e:
-                    logging.error(f"Ошибка при отзыве доступа для подписки {sub.id}: {e}")
+        # Сессия закрыта до отзыва доступа: remove_user_access ходит в Telegram
+        for sub in expired:
+            try:
+                # Используем existing method remove_user_access
+                await self.remove_user_access(sub)
+                logging.info("Отозван доступ для подписки %s", sub.id, extra=log_extra('access_removed', subscription_id=sub.id))
+            except Exception as e:
+                logging.error(f"Ошибка при отзыве доступа для подписки {sub.id}: {e}")
 
     async def force_cleanup_expired(self):
         """Принудительная зачистка всех, у кого истекла дата"""
@@ -720,6 +834,13 @@ class SubscriptionService:
                 )
             )
             expired_subs = result.scalars().all()
+            channels_by_plan = await plans_channel_ids(session, {sub.plan for sub in expired_subs if sub.plan})
+            # Членство по апдейтам chat_member: известным статусам get_chat_member не нужен
+            memberships = await get_memberships(session, [
+                (channel_id, sub.user.tg_id)
+                for sub in expired_subs if sub.user and sub.plan
+                for channel_id in channels_by_plan[sub.plan.id]
+            ])
 
             for sub in expired_subs:
                 try:
@@ -727,8 +848,7 @@ class SubscriptionService:
                     plan = sub.plan
 
                     if user and plan:
-                        channel_id = plan.channel_id
-                        user_tg_id = user.telegram_user_id
+                        user_tg_id = user.tg_id
 
                         # === ИСПРАВЛЕНИЕ №3: Защита "Бульдозера" ===
                         active_check = await session.execute(
@@ -741,38 +861,48 @@ class SubscriptionService:
                         if active_check.scalars().first():
                             # У пользователя есть новая активная подписка. Гасим статус старой без кика.
                             if sub.is_active:
+                                await record_stat(session, sub.plan_id, expired_count=1)
                                 sub.is_active = False
                                 session.add(sub)
                                 await session.commit()
                             continue
                         # ============================================
 
-                        try:
-                            member = await self.bot.get_chat_member(chat_id=channel_id, user_id=user_tg_id)
-                            if member.status not in ('left', 'kicked'):
-                                logging.warning(f"CLEANUP: Найден нелегал! User {user_tg_id} всё ещё в канале. Удаляем...")
-                                await self.bot.ban_chat_member(chat_id=channel_id, user_id=user_tg_id)
-                                await self.bot.unban_chat_member(chat_id=channel_id, user_id=user_tg_id, only_if_banned=True)
-
-                                # Если вдруг он был True в базе - исправим
-                                if sub.is_active:
-                                    sub.is_active = False
-                                    session.add(sub)
+                        # Закрываем читающую транзакцию: дальше запросы к Telegram
+                        await session.commit()
+
+                        # Подписка гасится, только когда пользователя нет ни в одном канале тарифа
+                        verified = True
+                        for channel_id in channels_by_plan[plan.id]:
+                            try:
+                                status = memberships.get((str(channel_id), user_tg_id))
+                                if status is None:
+                                    # Пользователь вступил до появления channel_members — спрашиваем Telegram один раз
+                                    member = await self.bot.get_chat_member(chat_id=channel_id, user_id=user_tg_id)
+                                    status = member.status
+                                    await record_membership(session, channel_id, user_tg_id, status)
                                     await session.commit()
-                            else:
-                                # Пользователя и так нет в канале, всё ок.
-                                # Если статус был True, ставим False
-                                 if sub.is_active:
-                                    sub.is_active = False
-                                    session.add(sub)
+                                if is_member(status):
+                                    logging.warning(f"CLEANUP: Найден нелегал! User {user_tg_id} всё ещё в канале {channel_id}. Удаляем...")
+                                    await self.bot.ban_chat_member(chat_id=channel_id, user_id=user_tg_id)
+                                    await self.bot.unban_chat_member(chat_id=channel_id, user_id=user_tg_id, only_if_banned=True)
+                                    await record_membership(session, channel_id, user_tg_id, 'left')
                                     await session.commit()
-
-                        except Exception as e:
-                            if "user not found" in str(e).lower() or "participant" in str(e).lower():
-                                 # Его там нет - отлично
-                                 pass
-                            else:
-                                logging.error(f"CLEANUP Error for user {user_tg_id}: {e}")
+                            except Exception as e:
+                                if "user not found" in str(e).lower() or "participant" in str(e).lower():
+                                     # Его там нет - отлично; отметка нужна архиву (archivable_condition)
+                                     await record_membership(session, channel_id, user_tg_id, 'left')
+                                     await session.commit()
+                                else:
+                                    verified = False
+                                    logging.error(f"CLEANUP Error for user {user_tg_id} in {channel_id}: {e}")
+
+                        # Если статус был True, ставим False
+                        if verified and sub.is_active:
+                            await record_stat(session, sub.plan_id, expired_count=1)
+                            sub.is_active = False
+                            session.add(sub)
+                            await session.commit()
 
                 except Exception as outer_e:
                     logging.error(f"CLEANUP Critical error on sub {sub.id}: {outer_e}")
@@ -0,0 +1,172 @@
+# benchmarks/bench_runtime.py
+# Бенчмарк профилей исполнения (app/runtime_profile.py): апдейты в секунду и p99
+# задержки обработчика на потоке фейковых апдейтов с профилем fast и без него.
+#
+# Запуск (из корня проекта):
+#   python -m benchmarks.bench_runtime --updates 20000 --latency const:2 --out runtime.json
+#   python -m benchmarks.bench_runtime --profiles default,fast --repeat 3
+#   python -m benchmarks.bench_runtime --rate 500 --updates 10000   # p99 при постоянной нагрузке
+#
+# Бот получает апдейты через getUpdates у benchmarks/fake_bot_api.py, диспетчер aiogram
+# разбирает их и вызывает обработчик, который отвечает sendMessage — то есть на каждый
+# апдейт приходится разбор JSON, роутинг, сериализация запроса и HTTP-круг к серверу.
+# Каждый профиль — в своем цикле событий (uvloop или asyncio) с новым ботом и сервером;
+# сервер работает в том же цикле, поэтому ускорение цикла сказывается на обеих сторонах.
+# Без --rate все апдейты кладутся сразу (пропускная способность, p99 включает ожидание
+# в очереди), с --rate — равномерным потоком (задержка при заданной нагрузке).
+# Если uvloop или orjson не установлены, профиль fast честно откатывается на стандартные
+# реализации, а в результате видно, что именно использовалось (поля loop и json).
+
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import time
+from datetime import datetime
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Message
+
+from app import runtime_profile
+from app.bot_session import create_bot_session
+from benchmarks.bench_scheduler import git_commit
+from benchmarks.fake_bot_api import FakeBotAPI, start_server
+
+TOKEN = "123456789:AABBCCDDEEFFaabbccddeeff1234567890"
+
+
+def make_update(i: int) -> dict:
+    """Апдейт с текстовым сообщением от одного из 1000 пользователей"""
+    user_id = 100000 + i % 1000
+    return {
+        "message": {
+            "message_id": i + 1,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": "User", "username": f"user{user_id}"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "User", "username": f"user{user_id}",
+                     "language_code": "ru"},
+            "text": f"Сообщение номер {i}: когда продление подписки?",
+            "entities": [{"type": "bold", "offset": 0, "length": 9}],
+        }
+    }
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def push_updates(api: FakeBotAPI, updates: int, rate: float):
+    """Апдейты в очередь getUpdates: все сразу или rate штук в секунду"""
+    if not rate:
+        for i in range(updates):
+            api.push_update(make_update(i))
+        return
+    started = time.perf_counter()
+    for i in range(updates):
+        delay = started + i / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        api.push_update(make_update(i))
+
+
+async def bench_profile(profile: str, updates: int, latency: str, rate: float = 0.0) -> dict:
+    api = FakeBotAPI(latency=latency)
+    runner, base_url = await start_server(api)
+    bot = Bot(token=TOKEN, session=create_bot_session(base_url=base_url, fast_json=runtime_profile.is_fast(profile)))
+    dp = Dispatcher()
+    handled = []
+    done = asyncio.Event()
+
+    async def measure(handler, event, data):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            handled.append(time.perf_counter() - started)
+            if len(handled) >= updates:
+                done.set()
+
+    dp.update.outer_middleware(measure)
+
+    @dp.message()
+    async def reply(message: Message):
+        await message.answer(f"Принято: {message.text}")
+
+    started = time.perf_counter()
+    pusher = asyncio.create_task(push_updates(api, updates, rate))
+    polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False,
+                                                   polling_timeout=1))
+    try:
+        await done.wait()
+        elapsed = time.perf_counter() - started
+    finally:
+        pusher.cancel()
+        await dp.stop_polling()
+        await polling
+        await bot.session.close()
+        await runner.cleanup()
+
+    return {
+        **runtime_profile.describe(profile),
+        "updates": updates,
+        "rate": rate,
+        "seconds": round(elapsed, 3),
+        "updates_per_s": round(updates / elapsed, 1),
+        "p50_ms": round(percentile(handled, 0.5) * 1000, 2),
+        "p99_ms": round(percentile(handled, 0.99) * 1000, 2),
+        "send_message_calls": api.calls["sendMessage"],
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк профилей исполнения (uvloop + orjson)")
+    parser.add_argument("--profiles", default=",".join(runtime_profile.PROFILES), help="Профили через запятую")
+    parser.add_argument("--updates", type=int, default=5000, help="Апдейтов в одном прогоне")
+    parser.add_argument("--latency", default="none", help="Задержка фейкового Bot API: const:2 | uniform:1,5 (мс)")
+    parser.add_argument("--rate", type=float, default=0.0, help="Апдейтов в секунду; 0 — все сразу")
+    parser.add_argument("--repeat", type=int, default=1, help="Прогонов на профиль (в отчет — каждый)")
+    parser.add_argument("--log-level", default="ERROR", help="Уровень логов во время прогона")
+    parser.add_argument("--out", default=None, help="Файл для JSON (по умолчанию stdout)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Синхронная точка входа: каждому профилю нужен свой цикл событий"""
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level)
+    profiles = [p for p in args.profiles.split(",") if p]
+    for profile in profiles:
+        runtime_profile.is_fast(profile)  # проверка имени до прогонов
+
+    results = []
+    for _ in range(args.repeat):
+        for profile in profiles:
+            results.append(runtime_profile.run(bench_profile(profile, args.updates, args.latency, args.rate), profile))
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.utcnow().isoformat(),
+            "python": platform.python_version(),
+            "updates": args.updates,
+            "latency": args.latency,
+            "uvloop_installed": runtime_profile.uvloop is not None,
+            "orjson_installed": runtime_profile.orjson is not None,
+        },
+        "results": results,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+# benchmarks/fake_bot_api.py
+# Локальный фейковый сервер Telegram Bot API для нагрузочного тестирования.
+#
+# Реализует методы, которые использует бот, с настраиваемой задержкой,
+# инъекцией 429 (retry_after) и учётом вызовов. Бот подключается к нему через
+# TELEGRAM_API_BASE_URL, так что проверяются реальные пути кода вместе с
+# HTTP-сериализацией и пулом соединений aiohttp.
+#
+# Запуск (из корня проекта):
+#   python -m benchmarks.fake_bot_api --port 8081 --latency uniform:20,80 --retry-after-ratio 0.01
+#   TELEGRAM_API_BASE_URL=http://127.0.0.1:8081 python app/main.py
+#
+# Служебные эндпоинты:
+#   GET  /_stats   — счётчики вызовов и задержек в JSON
+#   POST /_reset   — сброс счётчиков
+#   POST /_updates — положить апдейт (JSON) в очередь для getUpdates
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter, defaultdict, deque
+
+from aiohttp import web
+
+BOT_USER = {"id": 1000000000, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+
+
+class LatencyModel:
+    """
+    Распределение задержки ответа, задаётся строкой (значения в миллисекундах):
+    const:5 | uniform:5,20 | lognormal:3.0,0.5 (mu, sigma логарифма) | none
+    """
+
+    def __init__(self, spec: str = "none", seed: int | None = None):
+        self.spec = spec
+        self._rnd = random.Random(seed)
+        kind, _, raw = spec.partition(":")
+        self.kind = kind
+        self.params = [float(p) for p in raw.split(",") if p]
+        if kind not in ("none", "const", "uniform", "lognormal"):
+            raise ValueError(f"Неизвестное распределение задержки: {spec}")
+
+    def sample(self) -> float:
+        """Задержка в секундах"""
+        if self.kind == "const":
+            ms = self.params[0]
+        elif self.kind == "uniform":
+            ms = self._rnd.uniform(self.params[0], self.params[1])
+        elif self.kind == "lognormal":
+            ms = self._rnd.lognormvariate(self.params[0], self.params[1])
+        else:
+            ms = 0.0
+        return ms / 1000
+
+
+class FakeBotAPI:
+    def __init__(self, latency: str = "none", method_latency: dict[str, str] | None = None,
+                 retry_after_ratio: float = 0.0, retry_after: int = 1, global_rps: float | None = None,
+                 blocked_chat_ids=(), seed: int | None = None):
+        self.latency = LatencyModel(latency, seed)
+        self.method_latency = {m: LatencyModel(s, seed) for m, s in (method_latency or {}).items()}
+        self.retry_after_ratio = retry_after_ratio
+        self.retry_after = retry_after
+        self.global_rps = global_rps
+        self.blocked_chat_ids = {str(c) for c in blocked_chat_ids}
+        self._rnd = random.Random(seed)
+
+        self.calls = Counter()
+        self.errors = Counter()
+        self.latencies = defaultdict(list)
+        self.requests = []  # (method, params) — для проверок в тестах
+        self._recent = deque()  # время последних запросов для global_rps
+
+        self._message_id = 0
+        self._invite_id = 0
+        self._members: dict[tuple[str, str], str] = {}
+        self._updates: list[dict] = []
+        self._update_id = 0
+        self._updates_event = asyncio.Event()
+
+        self.handlers = {
+            "getMe": self.get_me,
+            "deleteWebhook": self.ok,
+            "sendMessage": self.send_message,
+            "editMessageText": self.send_message,
+            "sendDocument": self.send_message,
+            "sendInvoice": self.send_invoice,
+            "createInvoiceLink": self.create_invoice_link,
+            "createChatInviteLink": self.create_chat_invite_link,
+            "revokeChatInviteLink": self.revoke_chat_invite_link,
+            "approveChatJoinRequest": self.approve_chat_join_request,
+            "declineChatJoinRequest": self.ok,
+            "banChatMember": self.ban_chat_member,
+            "unbanChatMember": self.ok,
+            "getChatMember": self.get_chat_member,
+            "answerPreCheckoutQuery": self.ok,
+            "answerCallbackQuery": self.ok,
+            "getUpdates": self.get_updates,
+        }
+
+    # ─── Приложение ───────────────────────────────────────────────────────────
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/_stats", self.stats_view)
+        app.router.add_post("/_reset", self.reset_view)
+        app.router.add_post("/_updates", self.push_update_view)
+        app.router.add_route("*", "/bot{token}/{method}", self.dispatch)
+        return app
+
+    async def dispatch(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post()) if request.method == "POST" else dict(request.query)
+        started = time.perf_counter()
+
+        self.calls[method] += 1
+        self.requests.append((method, params))
+
+        handler = self.handlers.get(method)
+        if handler is None:
+            return self.error(method, 404, "Not Found: method not found")
+
+        if method != "getUpdates":
+            limited = self._check_rate_limit()
+            if limited:
+                return self.error(method, 429, f"Too Many Requests: retry after {limited}",
+                                  parameters={"retry_after": limited})
+            delay = self.method_latency.get(method, self.latency).sample()
+            if delay:
+                await asyncio.sleep(delay)
+            chat_id = params.get("chat_id")
+            if chat_id is not None and chat_id in self.blocked_chat_ids:
+                return self.error(method, 403, "Forbidden: bot was blocked by the user")
+
+        result = await handler(params)
+        self.latencies[method].append(time.perf_counter() - started)
+        return web.json_response({"ok": True, "result": result})
+
+    def _check_rate_limit(self) -> int | None:
+        if self.retry_after_ratio and self._rnd.random() < self.retry_after_ratio:
+            return self.retry_after
+        if self.global_rps:
+            now = time.monotonic()
+            while self._recent and now - self._recent[0] > 1:
+                self._recent.popleft()
+            if len(self._recent) >= self.global_rps:
+                return 1
+            self._recent.append(now)
+        return None
+
+    def error(self, method, code, description, parameters=None):
+        self.errors[(method, code)] += 1
+        payload = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            payload["parameters"] = parameters
+        return web.json_response(payload, status=code)
+
+    # ─── Служебные эндпоинты ──────────────────────────────────────────────────
+
+    def stats(self) -> dict:
+        latency = {}
+        for method, values in self.latencies.items():
+            ordered = sorted(values)
+            latency[method] = {
+                "count": len(ordered),
+                "p50_ms": round(ordered[len(ordered) // 2] * 1000, 2),
+                "p99_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000, 2),
+            }
+        return {
+            "calls": dict(self.calls),
+            "calls_total": sum(self.calls.values()),
+            "errors": {f"{m}:{c}": n for (m, c), n in self.errors.items()},
+            "latency": latency,
+        }
+
+    def reset(self):
+        self.calls.clear()
+        self.errors.clear()
+        self.latencies.clear()
+        self.requests.clear()
+        self._recent.clear()
+
+    def push_update(self, update: dict) -> int:
+        self._update_id += 1
+        self._updates.append({**update, "update_id": self._update_id})
+        self._updates_event.set()
+        return self._update_id
+
+    async def stats_view(self, request):
+        return web.json_response(self.stats())
+
+    async def reset_view(self, request):
+        self.reset()
+        return web.json_response({"ok": True})
+
+    async def push_update_view(self, request):
+        return web.json_response({"ok": True, "update_id": self.push_update(await request.json())})
+
+    # ─── Методы Bot API ───────────────────────────────────────────────────────
+
+    def _message(self, params, **extra):
+        self._message_id += 1
+        chat_id = params.get("chat_id", 0)
+        return {
+            "message_id": int(params.get("message_id") or self._message_id),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id) if str(chat_id).lstrip("-").isdigit() else 0, "type": "private"},
+            "from": BOT_USER,
+            **extra,
+        }
+
+    async def ok(self, params):
+        return True
+
+    async def get_me(self, params):
+        return BOT_USER
+
+    async def send_message(self, params):
+        return self._message(params, text=params.get("text", ""))
+
+    async def send_invoice(self, params):
+        return self._message(params, invoice={
+            "title": params.get("title", ""),
+            "description": params.get("description", ""),
+            "start_parameter": params.get("start_parameter", ""),
+            "currency": params.get("currency", "RUB"),
+            "total_amount": sum(p["amount"] for p in json.loads(params.get("prices", "[]"))),
+        })
+
+    async def create_invoice_link(self, params):
+        self._invite_id += 1
+        return f"https://t.me/$fakeinvoice{self._invite_id}"
+
+    def _invite(self, params, link=None, revoked=False):
+        if link is None:
+            self._invite_id += 1
+            link = f"https://t.me/+fake{self._invite_id}"
+        return {
+            "invite_link": link,
+            "creator": BOT_USER,
+            "creates_join_request": params.get("creates_join_request") == "true",
+            "is_primary": False,
+            "is_revoked": revoked,
+            "name": params.get("name"),
+        }
+
+    async def create_chat_invite_link(self, params):
+        return self._invite(params)
+
+    async def revoke_chat_invite_link(self, params):
+        return self._invite(params, link=params.get("invite_link"), revoked=True)
+
+    async def approve_chat_join_request(self, params):
+        self._members[(params.get("chat_id"), params.get("user_id"))] = "member"
+        return True
+
+    async def ban_chat_member(self, params):
+        self._members[(params.get("chat_id"), params.get("user_id"))] = "kicked"
+        return True
+
+    async def get_chat_member(self, params):
+        user_id = params.get("user_id")
+        status = self._members.get((params.get("chat_id"), user_id), "left")
+        user = {"id": int(user_id), "is_bot": False, "first_name": "User"}
+        if status == "kicked":
+            return {"status": status, "user": user, "until_date": 0}
+        return {"status": status, "user": user}
+
+    async def get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates and timeout:
+            self._updates_event.clear()
+            try:
+                await asyncio.wait_for(self._updates_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:int(params.get("limit") or 100)]
+
+
+async def start_server(api: FakeBotAPI, host: str = "127.0.0.1", port: int = 0) -> tuple[web.AppRunner, str]:
+    """Запускает сервер и возвращает (runner, base_url). port=0 — свободный порт"""
+    runner = web.AppRunner(api.make_app())
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    real_port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{real_port}"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Фейковый сервер Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", default="none", help="const:5 | uniform:5,20 | lognormal:3.0,0.5 (мс)")
+    parser.add_argument("--method-latency", type=json.loads, default={},
+                        help='Задержка по методам, например {"sendMessage": "uniform:50,150"}')
+    parser.add_argument("--retry-after-ratio", type=float, default=0.0, help="Доля запросов, получающих 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Значение retry_after в ответе 429")
+    parser.add_argument("--global-rps", type=float, default=None, help="Глобальный лимит запросов в секунду")
+    parser.add_argument("--blocked", default="", help="chat_id через запятую, которые «заблокировали» бота")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args(argv)
+
+
+async def main(argv=None):
+    args = parse_args(argv)
+    api = FakeBotAPI(
+        latency=args.latency, method_latency=args.method_latency,
+        retry_after_ratio=args.retry_after_ratio, retry_after=args.retry_after,
+        global_rps=args.global_rps, blocked_chat_ids=[c for c in args.blocked.split(",") if c],
+        seed=args.seed,
+    )
+    runner, base_url = await start_server(api, args.host, args.port)
+    print(f"Fake Bot API: {base_url} (TELEGRAM_API_BASE_URL={base_url})")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
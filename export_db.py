@@ -0,0 +1,152 @@
+# export_db.py
+# Выгрузка базы в CSV-дампы, совместимые с merge_db.py
+# Запуск: docker compose exec bot python export_db.py --label vol5
+#         docker compose exec bot python export_db.py --label vol5 --since 2025-12-01 --gzip --plans
+
+import argparse
+import asyncio
+import csv
+import gzip
+import os
+from datetime import datetime
+from dotenv import load_dotenv
+
+# Грузим .env так же, как это делает main.py
+load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), "app", ".env"))
+
+from sqlalchemy import select
+from app.database import async_init_db, get_async_session_maker, \
+    User, UserSubscription, SubscriptionPlan, PaymentError
+from app.archive import subscription_history
+
+DUMP_DIR   = os.path.join(os.path.dirname(__file__), "dump_data")
+BATCH_SIZE = 5000
+
+# Префикс файла → (модель, колонка для --since)
+# Префиксы users_/subs_ совпадают с теми, что читает merge_db.py
+TABLES = {
+    "users":          (User, User.created_at),
+    "subs":           (UserSubscription, UserSubscription.start_date),
+    "payment_errors": (PaymentError, PaymentError.payment_time),
+    "plans":          (SubscriptionPlan, None),
+}
+DEFAULT_TABLES = ["users", "subs", "payment_errors"]
+# Таблицы, у которых часть истории лежит в архиве: выгружаем UNION ALL с архивом
+HISTORY = {
+    "subs": subscription_history,
+}
+
+
+# ─── Вспомогательные функции ──────────────────────────────────────────────────
+
+def format_value(val) -> str:
+    """Значение в формате psql \\copy ... csv: NULL → '', bool → 't'/'f'"""
+    if val is None:
+        return ""
+    if isinstance(val, bool):
+        return "t" if val else "f"
+    if isinstance(val, datetime):
+        return val.isoformat(sep=" ")
+    return str(val)
+
+
+def dump_path(out_dir: str, prefix: str, label: str, compress: bool) -> str:
+    return os.path.join(out_dir, f"{prefix}_{label}.csv" + (".gz" if compress else ""))
+
+
+def open_dump(path: str, compress: bool):
+    if compress:
+        return gzip.open(path, "wt", encoding="utf-8", newline="")
+    return open(path, "w", encoding="utf-8", newline="")
+
+
+# ─── Основная логика ──────────────────────────────────────────────────────────
+
+async def export_table(session_maker, prefix: str, out_dir: str, label: str,
+                       since: datetime | None = None, compress: bool = False,
+                       batch_size: int = BATCH_SIZE) -> int:
+    """
+    Потоково выгружает одну таблицу в CSV.
+    Строки читаются серверным курсором пачками по batch_size и сразу пишутся в файл,
+    поэтому расход памяти не зависит от размера таблицы.
+    """
+    model, since_column = TABLES[prefix]
+    table = HISTORY[prefix]() if prefix in HISTORY else model.__table__
+    if since_column is not None:
+        since_column = table.c[since_column.name]
+
+    stmt = select(table).order_by(table.c.id)
+    if since is not None and since_column is not None:
+        stmt = stmt.where(since_column >= since)
+    stmt = stmt.execution_options(stream_results=True, yield_per=batch_size)
+
+    path = dump_path(out_dir, prefix, label, compress)
+    tmp_path = path + ".tmp"
+    rows = 0
+
+    async with session_maker() as session:
+        with open_dump(tmp_path, compress) as f:
+            writer = csv.writer(f)
+            writer.writerow([c.name for c in table.columns])
+
+            result = await session.stream(stmt)
+            async for partition in result.partitions():
+                writer.writerows([format_value(v) for v in row] for row in partition)
+                rows += len(partition)
+
+    # Файл появляется под итоговым именем только целиком
+    os.replace(tmp_path, path)
+    return rows
+
+
+async def export_all(session_maker, label: str, out_dir: str = DUMP_DIR,
+                     tables: list[str] | None = None, since: datetime | None = None,
+                     compress: bool = False, batch_size: int = BATCH_SIZE) -> dict[str, int]:
+    os.makedirs(out_dir, exist_ok=True)
+    totals = {}
+    for prefix in tables or DEFAULT_TABLES:
+        totals[prefix] = await export_table(
+            session_maker, prefix, out_dir, label,
+            since=since, compress=compress, batch_size=batch_size
+        )
+    return totals
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Выгрузка базы в CSV-дампы для merge_db.py")
+    parser.add_argument("--label", default=datetime.utcnow().strftime("%Y%m%d_%H%M%S"),
+                        help="Суффикс файлов: users_<label>.csv, subs_<label>.csv ...")
+    parser.add_argument("--out", default=DUMP_DIR, help="Папка для дампов")
+    parser.add_argument("--since", type=datetime.fromisoformat, default=None,
+                        help="Инкрементальная выгрузка: только строки с created_at/start_date >= даты (UTC)")
+    parser.add_argument("--gzip", action="store_true", help="Сжимать дампы (*.csv.gz)")
+    parser.add_argument("--plans", action="store_true", help="Выгрузить также subscription_plans")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Размер пачки серверного курсора")
+    return parser.parse_args(argv)
+
+
+async def main(argv=None):
+    args = parse_args(argv)
+    tables = DEFAULT_TABLES + (["plans"] if args.plans else [])
+
+    engine        = await async_init_db()
+    session_maker = get_async_session_maker(engine)
+
+    print(f"📁 Папка для дампов: {args.out}")
+    if args.since:
+        print(f"⏱  Инкрементальная выгрузка с {args.since}")
+
+    totals = await export_all(
+        session_maker, args.label, out_dir=args.out, tables=tables,
+        since=args.since, compress=args.gzip, batch_size=args.batch_size
+    )
+    await engine.dispose()
+
+    print(f"\n{'=' * 45}")
+    print(f"✅ ГОТОВО")
+    for prefix, rows in totals.items():
+        print(f"   {dump_path(args.out, prefix, args.label, args.gzip)} : {rows} строк")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
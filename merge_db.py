@@ -4,6 +4,7 @@
 
 import asyncio
 import csv
+import gzip
 import os
 from datetime import datetime
 from dotenv import load_dotenv
@@ -11,9 +12,10 @@ from dotenv import load_dotenv
 # Грузим .env так же, как это делает main.py
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), "app", ".env"))
 
-from sqlalchemy import select
+from sqlalchemy import select, func
 from app.database import async_init_db, get_async_session_maker, \
     User, UserSubscription, SubscriptionPlan
+from app.migrations import add_telegram_id_columns, backfill_telegram_ids, telegram_id_filter
 
 DUMP_DIR = os.path.join(os.path.dirname(__file__), "dump_data")
 VOLUMES  = ["vol1", "vol2", "vol3", "vol4"]
@@ -42,11 +44,28 @@ def parse_bool(val) -> bool:
     return str(val).strip().lower() in ("t", "true", "1", "yes")
 
 
+def find_dump(prefix: str, label: str) -> str:
+    """users_vol1.csv или сжатый users_vol1.csv.gz (см. export_db.py --gzip)"""
+    path = os.path.join(DUMP_DIR, f"{prefix}_{label}.csv")
+    if not os.path.exists(path) and os.path.exists(path + ".gz"):
+        return path + ".gz"
+    return path
+
+
+def open_dump(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, encoding="utf-8")
+
+
 # ─── Основная логика ──────────────────────────────────────────────────────────
 
 async def main():
     engine       = await async_init_db()
     session_maker = get_async_session_maker(engine)
+    # Колонки telegram_id в старой базе и их заполнение до слияния
+    await add_telegram_id_columns(engine)
+    await backfill_telegram_ids(session_maker)
 
     # Проверяем что планы уже есть (бот должен быть запущен до этого)
     async with session_maker() as session:
@@ -70,8 +89,8 @@ async def main():
     total = {"users_new": 0, "users_dup": 0, "subs_new": 0, "subs_dup": 0}
 
     for label in VOLUMES:
-        users_file = os.path.join(DUMP_DIR, f"users_{label}.csv")
-        subs_file  = os.path.join(DUMP_DIR, f"subs_{label}.csv")
+        users_file = find_dump("users", label)
+        subs_file  = find_dump("subs", label)
 
         if not os.path.exists(users_file):
             print(f"⚠️  {users_file} не найден — пропускаем")
@@ -83,13 +102,13 @@ async def main():
 
         # ── Пользователи ──────────────────────────────────────────────────────
         async with session_maker() as session:
-            with open(users_file, encoding="utf-8") as f:
+            with open_dump(users_file) as f:
                 for row in csv.DictReader(f):
-                    tg_id  = row["telegram_user_id"].strip()
+                    tg_id  = int(row["telegram_user_id"].strip())
                     old_id = row["id"].strip()
 
                     res = await session.execute(
-                        select(User).where(User.telegram_user_id == tg_id)
+                        select(User).where(telegram_id_filter(User, tg_id))
                     )
                     existing = res.scalar_one_or_none()
 
@@ -98,7 +117,7 @@ async def main():
                         total["users_dup"] += 1
                     else:
                         user = User(
-                            telegram_user_id         = tg_id,
+                            telegram_id              = tg_id,
                             first_name               = str_val(row.get("first_name")),
                             is_active                = parse_bool(row.get("is_active", "t")),
                             email                    = str_val(row.get("email")),
@@ -121,7 +140,7 @@ async def main():
             continue
 
         async with session_maker() as session:
-            with open(subs_file, encoding="utf-8") as f:
+            with open_dump(subs_file) as f:
                 for row in csv.DictReader(f):
                     old_uid = row["user_id"].strip()
 
@@ -170,11 +189,11 @@ async def main():
     print(f"   Пропущено подписок      : {total['subs_dup']}")
 
     async with session_maker() as session:
-        u = len((await session.execute(select(User))).scalars().all())
-        s = len((await session.execute(select(UserSubscription))).scalars().all())
-        a = len((await session.execute(
-            select(UserSubscription).where(UserSubscription.is_active == True)
-        )).scalars().all())
+        u = (await session.execute(select(func.count(User.id)))).scalar_one()
+        s = (await session.execute(select(func.count(UserSubscription.id)))).scalar_one()
+        a = (await session.execute(
+            select(func.count(UserSubscription.id)).where(UserSubscription.is_active == True)
+        )).scalar_one()
 
     print(f"\n📊 Итоговое состояние базы:")
     print(f"   Пользователей  : {u}")
@@ -1,7 +1,13 @@
 import pytest
 from unittest.mock import AsyncMock, ANY
-from app.main import show_payment_errors, resolve_payment_error
-from app.database import PaymentError
+from app import main as main_module
+from app.main import (show_payment_errors, resolve_payment_error, stats_command,
+                      payment_errors_page, payment_errors_group, payment_error_details)
+from app.database import PaymentError, SubscriptionPlan, UserSubscription, DailyStat
+from app.subscription_service import subscription_service
+from app import stats_service
+from datetime import datetime, timedelta
+from sqlalchemy import select
 from aiogram import types
 from aiogram.fsm.context import FSMContext
 
@@ -29,4 +35,93 @@ async def test_resolve_payment_error(session):
     assert error.is_resolved is True
     assert error.resolution_notes == "Выдали руками"
     # Используем ANY для любых строк
-    app.main.bot.send_message.assert_called_with(chat_id="123", text=ANY)
\ No newline at end of file
+    app.main.bot.send_message.assert_called_with(chat_id=123, text=ANY)
+
+@pytest.mark.asyncio
+async def test_stats_rollups_and_command(session):
+    plan = SubscriptionPlan(name="Месяц", price=18000, duration_days=30, channel_id="-1009999")
+    session.add(plan)
+    await session.commit()
+
+    # Две покупки и отмена одной из них — счетчики обновляются в тех же транзакциях
+    sub_id = await subscription_service.create_subscription(111, plan_id=plan.id, payment_amount=18000)
+    await subscription_service.create_subscription(222, plan_id=plan.id, payment_amount=15000)
+    sub = (await session.execute(select(UserSubscription).where(UserSubscription.id == sub_id))).scalar_one()
+    await subscription_service.remove_user_access(sub, reason='cancelled')
+
+    rows = (await session.execute(select(DailyStat))).scalars().all()
+    assert len(rows) == 1
+    assert (rows[0].plan_id, rows[0].new_count, rows[0].cancelled_count, rows[0].revenue) == (plan.id, 2, 1, 33000)
+
+    stats_service.clear_cache()
+    message = AsyncMock()
+    message.from_user.id = 123456789
+    await stats_command(message, AsyncMock())
+
+    text = message.answer.call_args.args[0]
+    assert "Активных подписчиков: 1" in text
+    assert "новых 2" in text and "отменено 1" in text and "выручка 330₽" in text
+    assert "Месяц: 330₽" in text
+    stats_service.clear_cache()
+
+    # Пересозданный тариф с тем же названием — отдельная строка выручки
+    twin = SubscriptionPlan(name="Месяц", price=20000, duration_days=30, channel_id="-1009999")
+    session.add(twin)
+    await session.commit()
+    await subscription_service.create_subscription(333, plan_id=twin.id, payment_amount=20000)
+    summary = await stats_service.get_stats_summary(subscription_service.async_session_maker)
+    assert summary['revenue_by_plan'] == [(f"Месяц (#{plan.id})", 33000), (f"Месяц (#{twin.id})", 20000)]
+    stats_service.clear_cache()
+
+
+@pytest.mark.asyncio
+async def test_payment_errors_grouped_and_paginated(session, monkeypatch):
+    monkeypatch.setattr(main_module, "PAYMENT_ERRORS_PAGE_SIZE", 2)
+    # 3 группы по тексту ошибки: A×3, B×1, C×1; у C самая свежая ошибка
+    for i, text in enumerate(["A", "A", "B", "A", "C"]):
+        session.add(PaymentError(
+            telegram_user_id=str(100 + i), provider_payment_charge_id=f"charge_{i}",
+            error_message=f"Ошибка {text}", stack_trace=f"Traceback {i}", is_resolved=False
+        ))
+    await session.commit()
+    ids = {e.provider_payment_charge_id: e.id for e in (await session.execute(select(PaymentError))).scalars()}
+
+    message = AsyncMock()
+    message.from_user.id = 123456789
+    await show_payment_errors(message, AsyncMock())
+
+    # Одно сообщение со сводкой вместо сообщения на каждую ошибку, без стеков
+    message.answer.assert_called_once()
+    text, keyboard = message.answer.call_args.args[0], message.answer.call_args.kwargs["reply_markup"]
+    assert "Неразрешенные ошибки платежей: 5" in text
+    assert "1× Ошибка C" in text and "3× Ошибка A" in text and "Ошибка B" not in text
+    assert "Traceback" not in text
+    nav = keyboard.inline_keyboard[-1]
+    assert [b.callback_data for b in nav] == [f"pe_page:n:{ids['charge_3']}"]
+
+    callback = AsyncMock()
+    callback.from_user.id = 123456789
+    callback.data = nav[0].callback_data
+    await payment_errors_page(callback)
+    text, keyboard = callback.message.edit_text.call_args.args[0], callback.message.edit_text.call_args.kwargs["reply_markup"]
+    assert "1× Ошибка B" in text and "Ошибка A" not in text
+    assert [b.callback_data for b in keyboard.inline_keyboard[-1]] == [f"pe_page:p:{ids['charge_2']}"]
+
+    # Назад на первую страницу
+    callback.data = keyboard.inline_keyboard[-1][0].callback_data
+    await payment_errors_page(callback)
+    assert "3× Ошибка A" in callback.message.edit_text.call_args.args[0]
+
+    # Группа A: ошибки с пагинацией по id
+    callback.data = f"pe_grp:{ids['charge_3']}"
+    await payment_errors_group(callback)
+    text, keyboard = callback.message.edit_text.call_args.args[0], callback.message.edit_text.call_args.kwargs["reply_markup"]
+    assert f"#{ids['charge_3']}" in text and f"#{ids['charge_1']}" in text and f"#{ids['charge_0']}" not in text
+    callback.data = keyboard.inline_keyboard[-1][-1].callback_data
+    await payment_errors_group(callback)
+    assert f"#{ids['charge_0']}" in callback.message.edit_text.call_args.args[0]
+
+    # Полный стек — только в карточке ошибки
+    callback.data = f"pe_err:{ids['charge_0']}"
+    await payment_error_details(callback)
+    assert "Traceback 0" in callback.message.answer.call_args.args[0]
@@ -0,0 +1,75 @@
+import csv
+import pytest
+from datetime import datetime, timedelta
+from sqlalchemy import select
+from app.database import (User, SubscriptionPlan, UserSubscription, UserSubscriptionArchive, ScheduledNotification,
+                          PlanChannel, ChannelMember)
+from app.archive import archive_expired_subscriptions, subscription_history
+from export_db import export_all
+
+@pytest.mark.asyncio
+async def test_archive_moves_only_cold_subscriptions(session, db_session_maker, tmp_path):
+    plan = SubscriptionPlan(name="Plan", price=100, duration_days=30, channel_id="-100777")
+    bundle = SubscriptionPlan(name="Bundle", price=300, duration_days=30, channel_id="-100777")
+    user = User(telegram_user_id="111")
+    stranger = User(telegram_user_id="222")
+    session.add_all([plan, bundle, user, stranger])
+    await session.flush()
+    session.add_all([
+        PlanChannel(plan_id=bundle.id, channel_id="-100777", position=0),
+        PlanChannel(plan_id=bundle.id, channel_id="-100888", position=1),
+        # Выход подтвержден только из основного канала; о stranger в channel_members ничего нет
+        ChannelMember(channel_id="-100777", telegram_id=111, status='kicked'),
+        ChannelMember(channel_id="-100888", telegram_id=111, status='member'),
+    ])
+    await session.commit()
+
+    now = datetime.utcnow()
+    old = [
+        UserSubscription(user_id=user.id, plan_id=plan.id, is_active=False,
+                         start_date=now - timedelta(days=400 - i), end_date=now - timedelta(days=370 - i))
+        for i in range(5)
+    ]
+    # Истекла давно, но все еще активна (зачистка не подтвердила) — остается
+    unverified = UserSubscription(user_id=user.id, plan_id=plan.id, is_active=True,
+                                  start_date=now - timedelta(days=300), end_date=now - timedelta(days=270))
+    recent = UserSubscription(user_id=user.id, plan_id=plan.id, is_active=False,
+                              start_date=now - timedelta(days=40), end_date=now - timedelta(days=10))
+    current = UserSubscription(user_id=user.id, plan_id=plan.id, is_active=True,
+                               start_date=now, end_date=now + timedelta(days=30))
+    # Погашены без проверки членства (expire_due_subscriptions) — в архив не переносятся
+    not_left = UserSubscription(user_id=stranger.id, plan_id=plan.id, is_active=False,
+                                start_date=now - timedelta(days=400), end_date=now - timedelta(days=370))
+    bundle_partial = UserSubscription(user_id=user.id, plan_id=bundle.id, is_active=False,
+                                      start_date=now - timedelta(days=400), end_date=now - timedelta(days=370))
+    session.add_all(old + [unverified, recent, current, not_left, bundle_partial])
+    await session.commit()
+    session.add(ScheduledNotification(subscription_id=old[0].id, user_id=user.id, kind='expired',
+                                      due_at=old[0].end_date, status='sent'))
+    await session.commit()
+    old_ids = sorted(sub.id for sub in old)
+
+    # Пачки по 2 строки: три короткие транзакции
+    assert await archive_expired_subscriptions(db_session_maker, batch_size=2) == 5
+    assert await archive_expired_subscriptions(db_session_maker, batch_size=2) == 0
+
+    hot = (await session.execute(select(UserSubscription.id))).scalars().all()
+    assert sorted(hot) == sorted([unverified.id, recent.id, current.id, not_left.id, bundle_partial.id])
+    archived = (await session.execute(select(UserSubscriptionArchive))).scalars().all()
+    assert sorted(row.id for row in archived) == old_ids
+    assert all(row.archived_at and row.end_date < now for row in archived)
+    assert (await session.execute(select(ScheduledNotification))).scalars().all() == []
+
+    # История по пользователю видна целиком
+    history = subscription_history(archived_flag=True)
+    rows = (await session.execute(select(history).where(history.c.user_id == user.id).order_by(history.c.id))).all()
+    assert len(rows) == 9
+    assert sum(row.archived for row in rows) == 5
+
+    # Выгрузка для merge_db включает архив
+    totals = await export_all(db_session_maker, "t", out_dir=str(tmp_path), tables=["subs"])
+    assert totals == {"subs": 10}
+    with open(tmp_path / "subs_t.csv", encoding="utf-8") as f:
+        subs = list(csv.DictReader(f))
+    assert [int(row["id"]) for row in subs] == sorted(old_ids + hot)
+    assert "archived_at" not in subs[0]
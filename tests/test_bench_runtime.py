@@ -0,0 +1,29 @@
+import json
+import asyncio
+import pytest
+from app import runtime_profile
+from app.bot_session import create_bot_session
+from benchmarks.bench_runtime import main
+
+
+def test_bench_runtime_smoke(tmp_path):
+    out = tmp_path / "runtime.json"
+    report = main(["--updates", "30", "--out", str(out)])
+
+    assert [r["profile"] for r in report["results"]] == ["default", "fast"]
+    for result in report["results"]:
+        assert result["send_message_calls"] == 30
+        assert result["updates_per_s"] > 0
+        assert result["p99_ms"] >= result["p50_ms"] > 0
+    assert report["results"][0]["loop"] == "asyncio" and report["results"][0]["json"] == "json"
+    assert json.loads(out.read_text(encoding="utf-8"))["results"] == report["results"]
+
+
+def test_fast_profile_falls_back_without_packages(monkeypatch):
+    monkeypatch.setattr(runtime_profile, 'uvloop', None)
+    monkeypatch.setattr(runtime_profile, 'orjson', None)
+    assert runtime_profile.describe('fast') == {'profile': 'fast', 'loop': 'asyncio', 'json': 'json'}
+    assert runtime_profile.run(asyncio.sleep(0, 'ok'), 'fast') == 'ok'
+    assert create_bot_session(base_url='http://127.0.0.1:1', fast_json=True).stats()['json'] == 'json'
+    with pytest.raises(ValueError):
+        runtime_profile.is_fast('turbo')
@@ -0,0 +1,14 @@
+import json
+import pytest
+from benchmarks.bench_scheduler import main, JOBS
+
+@pytest.mark.asyncio
+async def test_bench_scheduler_smoke(tmp_path):
+    out = tmp_path / "bench.json"
+    report = await main(["--sizes", "50", "--out", str(out)])
+
+    assert [r["job"] for r in report["results"]] == JOBS
+    for result in report["results"]:
+        assert result["queries"] > 0
+        assert result["peak_mem_kb"] > 0
+    assert json.loads(out.read_text(encoding="utf-8"))["results"] == report["results"]
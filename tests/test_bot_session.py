@@ -0,0 +1,31 @@
+import asyncio
+import pytest
+from aiogram import Bot
+from app.bot_session import create_bot_session, TunedAiohttpSession
+from benchmarks.fake_bot_api import FakeBotAPI, start_server
+
+TOKEN = '123456789:AABBCCDDEEFFaabbccddeeff1234567890'
+
+
+@pytest.mark.asyncio
+async def test_tuned_session_reuses_connections():
+    api = FakeBotAPI(latency="const:5")
+    runner, base_url = await start_server(api)
+    session = create_bot_session(base_url=base_url, limit=10, limit_per_host=2, keepalive_timeout=30)
+    bot = Bot(token=TOKEN, session=session)
+    try:
+        assert isinstance(session, TunedAiohttpSession)
+        messages = await asyncio.gather(*(bot.send_message(chat_id=i, text="кешбэк 100 %") for i in range(6)))
+        assert [m.text for m in messages] == ["кешбэк 100 %"] * 6
+
+        stats = session.stats()
+        # Не больше двух соединений на хост: остальные запросы ждали слот и переиспользовали соединения
+        assert stats["requests"] == 6
+        assert stats["connections_created"] <= 2
+        assert stats["connections_reused"] >= 4
+        assert stats["queued"] >= 4
+        assert stats["limit_per_host"] == 2
+        assert stats["in_flight"] == 0
+    finally:
+        await bot.session.close()
+        await runner.cleanup()
@@ -0,0 +1,142 @@
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+from datetime import datetime, timedelta
+from sqlalchemy import select, update
+from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
+from app.database import User, SubscriptionPlan, UserSubscription, BroadcastJob, BroadcastRecipient
+from app.broadcast_service import BroadcastService
+
+
+async def _seed_users(session):
+    plan = SubscriptionPlan(name="Plan", price=100, duration_days=30, channel_id="-1009999")
+    session.add(plan)
+    users = [User(telegram_user_id=str(1000 + i), is_active=True) for i in range(4)]
+    users.append(User(telegram_user_id="2000", is_active=False))
+    session.add_all(users)
+    await session.commit()
+    session.add(UserSubscription(user_id=users[0].id, plan_id=plan.id, is_active=True,
+                                 end_date=datetime.utcnow() + timedelta(days=10)))
+    await session.commit()
+    return users
+
+
+def _make_service(db_session_maker, blocked=(), bad_text=None):
+    service = BroadcastService(db_session_maker)
+    bot = AsyncMock()
+
+    async def send_message(chat_id, text, **kwargs):
+        if text == bad_text:
+            raise TelegramBadRequest(method=MagicMock(), message="Bad Request: can't parse entities")
+        if chat_id in blocked:
+            raise TelegramForbiddenError(method=MagicMock(), message="Forbidden: bot was blocked by the user")
+
+    bot.send_message = AsyncMock(side_effect=send_message)
+    service.set_bot(bot)
+    return service, bot
+
+
+@pytest.mark.asyncio
+async def test_broadcast_delivers_and_deactivates_blocked(db_session_maker, session):
+    users = await _seed_users(session)
+    service, bot = _make_service(db_session_maker, blocked={1003})
+
+    assert await service.count_audience('subscribers') == 1
+    assert await service.count_audience('no_subscription') == 3
+
+    # Строка, которую backfill еще не дошел: Telegram ID берется из старой строковой колонки
+    await session.execute(update(User).where(User.id == users[2].id).values(telegram_id=None))
+    await session.commit()
+    job_id = await service.create_job("Привет", 'all', created_by=123456789)
+    await service.run(job_id)
+
+    job = await service.get_job(job_id)
+    assert (job.status, job.total, job.sent, job.blocked, job.failed) == ('done', 4, 3, 1, 0)
+    sent_to = {call.kwargs['chat_id'] for call in bot.send_message.call_args_list}
+    assert sent_to == {1000, 1001, 1002, 1003}
+
+    await session.refresh(users[3])
+    assert users[3].is_active is False
+    statuses = dict((await session.execute(
+        select(BroadcastRecipient.telegram_id, BroadcastRecipient.status).where(BroadcastRecipient.job_id == job_id)
+    )).all())
+    assert statuses == {1000: "sent", 1001: "sent", 1002: "sent", 1003: "blocked"}
+
+
+@pytest.mark.asyncio
+async def test_broadcast_resumes_only_pending_recipients(db_session_maker, session):
+    await _seed_users(session)
+    service, bot = _make_service(db_session_maker)
+    job_id = await service.create_job("Привет", 'no_subscription')
+
+    # Имитируем перезапуск посреди рассылки: часть получателей уже обработана
+    await session.execute(update(BroadcastJob).where(BroadcastJob.id == job_id).values(status='running', sent=1))
+    await session.execute(
+        update(BroadcastRecipient)
+        .where(BroadcastRecipient.job_id == job_id, BroadcastRecipient.telegram_id == 1001)
+        .values(status='sent')
+    )
+    await session.commit()
+
+    assert await service.resume_pending() == [job_id]
+    await service._tasks[job_id]
+
+    assert sorted(call.kwargs['chat_id'] for call in bot.send_message.call_args_list) == [1002, 1003]
+    job = await service.get_job(job_id)
+    assert (job.status, job.sent) == ('done', 3)
+
+
+@pytest.mark.asyncio
+async def test_broadcast_cancelled_job_is_not_delivered(db_session_maker, session):
+    await _seed_users(session)
+    service, bot = _make_service(db_session_maker)
+    job_id = await service.create_job("Привет", 'all')
+
+    assert await service.cancel(job_id) is True
+    await service.run(job_id)
+
+    bot.send_message.assert_not_called()
+    assert (await service.get_job(job_id)).status == 'cancelled'
+
+
+@pytest.mark.asyncio
+async def test_broadcast_bad_message_does_not_deactivate_users(db_session_maker, session):
+    users = await _seed_users(session)
+    service, bot = _make_service(db_session_maker, bad_text="<b>Привет")
+    job_id = await service.create_job("<b>Привет", 'all')
+    await service.run(job_id)
+
+    job = await service.get_job(job_id)
+    assert (job.status, job.sent, job.blocked, job.failed) == ('done', 0, 0, 4)
+    # Одна попытка на получателя: повтор с тем же текстом не поможет
+    assert bot.send_message.call_count == 4
+    active = (await session.execute(
+        select(User.is_active).where(User.id.in_([user.id for user in users[:4]])).execution_options(populate_existing=True)
+    )).scalars().all()
+    assert active == [True] * 4
+
+
+@pytest.mark.asyncio
+async def test_broadcast_retry_after_does_not_use_attempts(db_session_maker, session, monkeypatch):
+    from aiogram.exceptions import TelegramRetryAfter
+    from app import broadcast_service as broadcast_module
+    await _seed_users(session)
+    service, bot = _make_service(db_session_maker)
+    flood = {'left': 4}
+
+    async def send_message(chat_id, text, **kwargs):
+        # Подряд больше 429, чем BROADCAST_MAX_ATTEMPTS, затем отправка проходит
+        if chat_id == 1001 and flood['left']:
+            flood['left'] -= 1
+            raise TelegramRetryAfter(method=MagicMock(), message="Too Many Requests", retry_after=0)
+
+    bot.send_message = AsyncMock(side_effect=send_message)
+    monkeypatch.setattr(broadcast_module, 'BROADCAST_MAX_ATTEMPTS', 2)
+    job_id = await service.create_job("Привет", 'no_subscription')
+    await service.run(job_id)
+
+    job = await service.get_job(job_id)
+    assert (job.status, job.sent, job.failed) == ('done', 3, 0)
+    attempts = dict((await session.execute(
+        select(BroadcastRecipient.telegram_id, BroadcastRecipient.attempts).where(BroadcastRecipient.job_id == job_id)
+    )).all())
+    assert attempts == {1001: 1, 1002: 1, 1003: 1}
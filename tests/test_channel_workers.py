@@ -0,0 +1,125 @@
+import asyncio
+import pytest
+from sqlalchemy import select
+from app.channel_workers import ChannelWorkers
+from app.database import SubscriptionPlan, PlanChannel, UserSubscription, SubscriptionInvite
+
+
+@pytest.mark.asyncio
+async def test_slow_channel_does_not_block_others():
+    workers = ChannelWorkers(concurrency=1)
+    release = asyncio.Event()
+    order = []
+
+    async def job(name, wait=False):
+        if wait:
+            await release.wait()
+        order.append(name)
+        return name
+
+    slow = [workers.submit('-100slow', job, f'slow{i}', wait=True) for i in range(3)]
+    assert await workers.run('-100fast', job, 'fast') == 'fast'
+    assert order == ['fast']
+    assert workers.stats()['-100slow']['queued'] == 2  # один выполняется, два ждут
+
+    release.set()
+    assert await asyncio.gather(*slow) == ['slow0', 'slow1', 'slow2']
+    assert order == ['fast', 'slow0', 'slow1', 'slow2']
+    assert workers.stats()['-100slow'] == {'queued': 0, 'workers': 0, 'done': 3, 'failed': 0}
+
+
+@pytest.mark.asyncio
+async def test_bundle_plan_invites_and_revocation(session):
+    from app.subscription_service import subscription_service
+
+    plan = SubscriptionPlan(name="Bundle", price=300, duration_days=30, channel_id="-100901")
+    session.add(plan)
+    await session.flush()
+    session.add_all([
+        PlanChannel(plan_id=plan.id, channel_id="-100901", position=0),
+        PlanChannel(plan_id=plan.id, channel_id="-100902", position=1),
+    ])
+    await session.commit()
+
+    async def create_link(chat_id, **kwargs):
+        # Ссылки создаются параллельно: первый канал отвечает позже второго
+        if chat_id == "-100901":
+            await asyncio.sleep(0.01)
+        return type('Link', (), {'invite_link': f"https://t.me/+bundle_{chat_id[-1]}"})()
+
+    subscription_service.bot.create_chat_invite_link.side_effect = create_link
+    subscription_id = await subscription_service.create_subscription(55555, plan_id=plan.id)
+
+    result = await session.execute(
+        select(SubscriptionInvite.channel_id, SubscriptionInvite.invite_link).order_by(SubscriptionInvite.id)
+    )
+    assert result.all() == [("-100901", "https://t.me/+bundle_1"), ("-100902", "https://t.me/+bundle_2")]
+    sub = await session.get(UserSubscription, subscription_id)
+    assert sub.invite_link == "https://t.me/+bundle_1"
+    info = await subscription_service.get_subscription_info(55555)
+    assert info['invite_links'] == ["https://t.me/+bundle_1", "https://t.me/+bundle_2"]
+
+    # Ссылка действует только в своем канале и только для владельца
+    assert await subscription_service.is_valid_join_request("https://t.me/+bundle_2", 55555, chat_id=-100902)
+    assert not await subscription_service.is_valid_join_request("https://t.me/+bundle_2", 55555, chat_id=-100901)
+    assert not await subscription_service.is_valid_join_request("https://t.me/+bundle_2", 66666, chat_id=-100902)
+
+    await subscription_service.revoke_used_invite(-100902, "https://t.me/+bundle_2")
+    assert not await subscription_service.is_valid_join_request("https://t.me/+bundle_2", 55555, chat_id=-100902)
+
+    # Отзыв доступа: бан в каждом канале пакета и отзыв оставшейся ссылки
+    await subscription_service.remove_user_access(sub)
+    banned = {call.kwargs['chat_id'] for call in subscription_service.bot.ban_chat_member.call_args_list}
+    assert banned == {"-100901", "-100902"}
+    subscription_service.bot.revoke_chat_invite_link.assert_any_call(chat_id="-100901", invite_link="https://t.me/+bundle_1")
+    session.expire_all()
+    sub = await session.get(UserSubscription, subscription_id)
+    assert sub.is_active is False and sub.invite_link is None
+    result = await session.execute(select(SubscriptionInvite).where(SubscriptionInvite.revoked_at.is_(None)))
+    assert result.scalars().all() == []
+
+
+@pytest.mark.asyncio
+async def test_telegram_calls_outside_db_transactions(session):
+    from sqlalchemy import event
+    from app.subscription_service import subscription_service
+    sync_engine = subscription_service.async_session_maker.kw['bind'].sync_engine
+    open_transactions = []
+    seen = []
+
+    def on_begin(conn):
+        open_transactions.append(conn)
+
+    def on_end(conn):
+        open_transactions.clear()
+
+    async def telegram_call(*args, **kwargs):
+        # К моменту вызова Telegram ни одна транзакция приложения не открыта
+        seen.append(len(open_transactions))
+        return type('Link', (), {'invite_link': f"https://t.me/+tx_{len(seen)}"})()
+
+    plan = SubscriptionPlan(name="Tx", price=100, duration_days=30, channel_id="-100903")
+    session.add(plan)
+    await session.commit()
+    bot = subscription_service.bot
+    bot.create_chat_invite_link.side_effect = telegram_call
+    bot.ban_chat_member.side_effect = telegram_call
+
+    event.listen(sync_engine, 'begin', on_begin)
+    event.listen(sync_engine, 'commit', on_end)
+    event.listen(sync_engine, 'rollback', on_end)
+    try:
+        subscription_id = await subscription_service.create_subscription(77777, plan_id=plan.id)
+        await subscription_service.create_subscription_invites(77777)
+        await subscription_service.remove_user_access(await session.get(UserSubscription, subscription_id))
+    finally:
+        event.remove(sync_engine, 'begin', on_begin)
+        event.remove(sync_engine, 'commit', on_end)
+        event.remove(sync_engine, 'rollback', on_end)
+
+    assert seen == [0, 0, 0]
+    session.expire_all()
+    sub = await session.get(UserSubscription, subscription_id)
+    assert sub.is_active is False
+    result = await session.execute(select(SubscriptionInvite.invite_link).order_by(SubscriptionInvite.id))
+    assert result.scalars().all() == ["https://t.me/+tx_1", "https://t.me/+tx_2"]
@@ -0,0 +1,67 @@
+import asyncio
+import pytest
+from types import SimpleNamespace
+from app.checkout import PendingCheckouts, PreCheckoutValidator
+
+PLANS = [SimpleNamespace(id=1, name='Подписка на 1 месяц', price=18000, duration_days=30)]
+
+
+def query(query_id, payload, user_id=42, amount=18000):
+    return SimpleNamespace(id=query_id, invoice_payload=payload, total_amount=amount,
+                           from_user=SimpleNamespace(id=user_id))
+
+
+async def catalog():
+    return list(PLANS)
+
+
+@pytest.mark.asyncio
+async def test_pre_checkout_checks_catalog_and_payments_in_flight():
+    clock = [0.0]
+    validator = PreCheckoutValidator(catalog, PendingCheckouts(ttl=300, clock=lambda: clock[0]))
+
+    assert await validator.check(query('q1', 'plan_1', amount=6000)) is not None   # сумма не совпадает с тарифом
+    assert await validator.check(query('q2', 'wrong_payload')) is not None
+    assert await validator.check(query('q3', 'plan_1')) is None
+    # Оплата q3 еще не завершена: оплата другого счета того же пользователя отклоняется, другого — нет
+    assert await validator.check(query('q4', 'extend_1')) is not None
+    assert await validator.check(query('q5', 'extend_1', user_id=43)) is None
+    validator.pending.complete(42)
+    assert await validator.check(query('q6', 'extend_99')) is None  # тарифа нет в каталоге
+    # Незавершенная оплата забывается через ttl
+    clock[0] = 301
+    assert await validator.check(query('q7', 'plan_1')) is None
+
+    validator.record_answer(0.004)
+    stats = validator.stats()
+    assert (stats['ok'], stats['rejected'], stats['unverified']) == (3, 3, 1)
+    assert stats['pending'] == 1 and stats['answer_p99_ms'] == 4.0
+    assert stats['validation_max_ms'] >= stats['validation_p50_ms'] >= 0
+    assert len(validator.validation_latency) == 7
+
+
+@pytest.mark.asyncio
+async def test_pre_checkout_retry_after_declined_payment():
+    validator = PreCheckoutValidator(catalog, PendingCheckouts(ttl=300))
+    assert await validator.check(query('q1', 'plan_1')) is None
+    # Провайдер отклонил карту: successful_payment не пришел, пользователь платит тот же счет снова
+    assert await validator.check(query('q2', 'plan_1')) is None
+    assert validator.pending.active(42)[0] == 'q2'
+    assert validator.stats()['ok'] == 2
+
+
+@pytest.mark.asyncio
+async def test_pre_checkout_answers_ok_when_budget_exceeded():
+    loads = []
+
+    async def slow_catalog():
+        await asyncio.sleep(0.2)
+        loads.append(True)
+        return list(PLANS)
+
+    validator = PreCheckoutValidator(slow_catalog, budget_ms=20)
+    assert await validator.check(query('q1', 'plan_1', amount=1)) is None
+    assert validator.stats()['budget_exceeded'] == 1 and validator.stats()['validation_max_ms'] < 150
+    # Загрузка каталога не отменилась и закончилась в фоне
+    await asyncio.sleep(0.3)
+    assert loads == [True]
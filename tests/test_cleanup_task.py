@@ -27,8 +27,62 @@ async def test_force_cleanup_expired(session):
     await subscription_service.force_cleanup_expired()
 
     # Проверяем, что его удалили
-    subscription_service.bot.ban_chat_member.assert_called_with(chat_id="-100777", user_id="88888")
+    subscription_service.bot.ban_chat_member.assert_called_with(chat_id="-100777", user_id=88888)
     
     # Проверяем статус в БД
     await session.refresh(sub)
-    assert sub.is_active is False
\ No newline at end of file
+    assert sub.is_active is False
+
+@pytest.mark.asyncio
+async def test_cleanup_uses_channel_members(session):
+    from app.subscription_service import subscription_service
+    from app.database import ChannelMember
+    from app.membership import record_membership
+    from sqlalchemy import select
+    import app.main
+    from aiogram.types import ChatMemberUpdated, ChatMemberLeft, Chat
+
+    plan = SubscriptionPlan(name="Plan", price=100, duration_days=30, channel_id=app.main.CHANNEL_IDS['premium_subscription'])
+    users = [User(telegram_id=70000 + i, is_active=True) for i in range(3)]
+    session.add_all([plan] + users)
+    await session.commit()
+    expired_date = datetime.utcnow() - timedelta(hours=3)
+    session.add_all([
+        UserSubscription(user_id=user.id, plan_id=plan.id, is_active=True, start_date=expired_date, end_date=expired_date)
+        for user in users
+    ])
+    await session.commit()
+
+    # 70000 вышел сам (апдейт chat_member), 70001 известен как участник, про 70002 ничего не известно
+    left = ChatMemberUpdated(
+        chat=Chat(id=int(plan.channel_id), type="channel"),
+        from_user=AiogramUser(id=70000, is_bot=False, first_name="A"),
+        date=datetime.utcnow(),
+        old_chat_member=ChatMemberMember(user=AiogramUser(id=70000, is_bot=False, first_name="A"), status="member"),
+        new_chat_member=ChatMemberLeft(user=AiogramUser(id=70000, is_bot=False, first_name="A"), status="left"),
+    )
+    await app.main.process_chat_member(left)
+    # Более старое событие не перезаписывает новое
+    await record_membership(session, plan.channel_id, 70000, 'member', at=datetime.utcnow() - timedelta(days=1))
+    await record_membership(session, plan.channel_id, 70001, 'member')
+    await session.commit()
+
+    subscription_service.bot.get_chat_member.return_value = ChatMemberLeft(
+        user=AiogramUser(id=70002, is_bot=False, first_name="A"), status="left"
+    )
+    await subscription_service.force_cleanup_expired()
+
+    # Telegram спрашиваем только о неизвестном, кикаем только известного участника
+    subscription_service.bot.get_chat_member.assert_called_once_with(chat_id=plan.channel_id, user_id=70002)
+    subscription_service.bot.ban_chat_member.assert_called_once_with(chat_id=plan.channel_id, user_id=70001)
+    result = await session.execute(select(ChannelMember.telegram_id, ChannelMember.status).order_by(ChannelMember.telegram_id))
+    assert result.all() == [(70000, 'left'), (70001, 'left'), (70002, 'left')]
+    result = await session.execute(select(UserSubscription.is_active))
+    assert not any(result.scalars().all())
+
+    # Повторная зачистка не делает ни одного запроса к API
+    subscription_service.bot.get_chat_member.reset_mock()
+    subscription_service.bot.ban_chat_member.reset_mock()
+    await subscription_service.force_cleanup_expired()
+    subscription_service.bot.get_chat_member.assert_not_called()
+    subscription_service.bot.ban_chat_member.assert_not_called()
@@ -0,0 +1,107 @@
+import asyncio
+import pytest
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+from app.concurrency import UpdateConcurrencyMiddleware
+
+
+def make_update(user_id, text="/details"):
+    message = SimpleNamespace(text=text, chat=SimpleNamespace(id=user_id))
+    return SimpleNamespace(message=message), {"event_from_user": SimpleNamespace(id=user_id), "bot": AsyncMock()}
+
+
+@pytest.mark.asyncio
+async def test_updates_of_one_user_are_serialized():
+    middleware = UpdateConcurrencyMiddleware(max_concurrent=10)
+    running = {}
+    overlaps = []
+
+    async def handler(event, data):
+        user_id = data["event_from_user"].id
+        running[user_id] = running.get(user_id, 0) + 1
+        overlaps.append((user_id, running[user_id], sum(running.values())))
+        await asyncio.sleep(0.01)
+        running[user_id] -= 1
+
+    await asyncio.gather(*(middleware(handler, *make_update(user_id)) for user_id in (1, 1, 1, 2, 2)))
+
+    # Один пользователь — никогда два апдейта сразу, разные пользователи — параллельно
+    assert max(per_user for _, per_user, _ in overlaps) == 1
+    assert max(total for _, _, total in overlaps) == 2
+    # Блокировки простаивающих пользователей удалены
+    assert middleware.stats()["user_locks"] == 0
+
+
+@pytest.mark.asyncio
+async def test_global_cap_and_degraded_reply():
+    middleware = UpdateConcurrencyMiddleware(max_concurrent=2, degraded_replies={"/start": "Попробуйте позже"})
+    release = asyncio.Event()
+    peak = 0
+
+    async def handler(event, data):
+        nonlocal peak
+        peak = max(peak, middleware.active)
+        await release.wait()
+
+    tasks = [asyncio.create_task(middleware(handler, *make_update(user_id))) for user_id in range(1, 5)]
+    await asyncio.sleep(0.01)
+    assert middleware.stats()["active"] == 2 and middleware.stats()["waiting"] == 2
+
+    # Насыщение: /start получает быстрый ответ, обработчик не вызывается
+    start_handler = AsyncMock()
+    event, data = make_update(99, text="/start")
+    await middleware(start_handler, event, data)
+    start_handler.assert_not_called()
+    data["bot"].send_message.assert_called_once_with(chat_id=99, text="Попробуйте позже", parse_mode="HTML")
+
+    release.set()
+    await asyncio.gather(*tasks)
+    assert peak == 2
+    assert middleware.stats() == {"active": 0, "waiting": 0, "degraded": 1, "user_locks": 0}
+
+
+@pytest.mark.asyncio
+async def test_pre_checkout_bypasses_user_lock_and_cap():
+    middleware = UpdateConcurrencyMiddleware(max_concurrent=1)
+    release = asyncio.Event()
+
+    async def slow_handler(event, data):
+        await release.wait()
+
+    # Слот занят медленным апдейтом того же пользователя
+    busy = asyncio.create_task(middleware(slow_handler, *make_update(1)))
+    await asyncio.sleep(0.01)
+    assert middleware.saturated
+
+    event = SimpleNamespace(pre_checkout_query=SimpleNamespace(id="q1"))
+    handler = AsyncMock(return_value="answered")
+    result = await asyncio.wait_for(middleware(handler, event, {"event_from_user": SimpleNamespace(id=1)}), 0.1)
+    assert result == "answered"
+
+    release.set()
+    await busy
+    assert middleware.stats() == {"active": 0, "waiting": 0, "degraded": 0, "user_locks": 0}
+
+
+@pytest.mark.asyncio
+async def test_pre_checkout_latency_counted_from_update_receipt():
+    from app.concurrency import UpdateReceivedMiddleware
+    from app.checkout import PreCheckoutValidator
+    import app.main
+
+    validator = PreCheckoutValidator(AsyncMock(return_value=[]))
+    query = SimpleNamespace(id="q1", invoice_payload="plan_1", total_amount=100, from_user=SimpleNamespace(id=7))
+    app.main.bot = AsyncMock()
+
+    async def queued_handler(event, data):
+        await asyncio.sleep(0.05)  # ожидание в очередях после получения апдейта
+        await app.main.process_pre_checkout_query(query, update_received=data["update_received"])
+
+    original = app.main.pre_checkout
+    app.main.pre_checkout = validator
+    try:
+        await UpdateReceivedMiddleware()(queued_handler, SimpleNamespace(), {})
+    finally:
+        app.main.pre_checkout = original
+        app.main.bot = None
+    assert validator.stats()["answer_max_ms"] >= 50
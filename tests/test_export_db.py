@@ -0,0 +1,54 @@
+import csv
+import gzip
+import pytest
+from datetime import datetime, timedelta
+from app.database import User, SubscriptionPlan, UserSubscription, PaymentError
+from export_db import export_all
+from merge_db import parse_bool, parse_pg_date
+
+@pytest.mark.asyncio
+async def test_export_is_merge_db_compatible(session, db_session_maker, tmp_path):
+    plan = SubscriptionPlan(name="Plan", price=100, duration_days=30, channel_id="-100777")
+    old_user = User(telegram_user_id="111", is_active=True, created_at=datetime(2024, 1, 1))
+    new_user = User(telegram_user_id="222", first_name="Новый", is_active=False, created_at=datetime(2025, 6, 1))
+    session.add_all([plan, old_user, new_user])
+    await session.commit()
+
+    sub = UserSubscription(
+        user_id=new_user.id, plan_id=plan.id, is_active=True,
+        start_date=datetime(2025, 6, 1, 12, 30), end_date=datetime(2025, 7, 1, 12, 30)
+    )
+    error = PaymentError(telegram_user_id="222", provider_payment_charge_id="c1", error_message="boom")
+    session.add_all([sub, error])
+    await session.commit()
+
+    totals = await export_all(db_session_maker, "t", out_dir=str(tmp_path), batch_size=1)
+    assert totals == {"users": 2, "subs": 1, "payment_errors": 1}
+
+    with open(tmp_path / "users_t.csv", encoding="utf-8") as f:
+        users = list(csv.DictReader(f))
+    assert [u["telegram_user_id"] for u in users] == ["111", "222"]
+    assert parse_bool(users[1]["is_active"]) is False
+    assert users[0]["first_name"] == ""
+
+    with open(tmp_path / "subs_t.csv", encoding="utf-8") as f:
+        subs = list(csv.DictReader(f))
+    assert subs[0]["user_id"] == str(new_user.id)
+    assert parse_pg_date(subs[0]["start_date"]) == datetime(2025, 6, 1, 12, 30)
+
+@pytest.mark.asyncio
+async def test_export_since_gzip(session, db_session_maker, tmp_path):
+    session.add_all([
+        User(telegram_user_id="111", created_at=datetime.utcnow() - timedelta(days=10)),
+        User(telegram_user_id="222", created_at=datetime.utcnow()),
+    ])
+    await session.commit()
+
+    since = datetime.utcnow() - timedelta(days=1)
+    totals = await export_all(db_session_maker, "inc", out_dir=str(tmp_path),
+                              tables=["users", "plans"], since=since, compress=True)
+    assert totals == {"users": 1, "plans": 0}
+
+    with gzip.open(tmp_path / "users_inc.csv.gz", "rt", encoding="utf-8") as f:
+        users = list(csv.DictReader(f))
+    assert [u["telegram_user_id"] for u in users] == ["222"]
@@ -0,0 +1,61 @@
+import pytest
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError
+from benchmarks.fake_bot_api import FakeBotAPI, LatencyModel, start_server
+
+TOKEN = '123456789:AABBCCDDEEFFaabbccddeeff1234567890'
+
+async def make_bot(api):
+    runner, base_url = await start_server(api)
+    bot = Bot(token=TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(base_url)))
+    return runner, bot
+
+@pytest.mark.asyncio
+async def test_fake_bot_api_round_trip():
+    api = FakeBotAPI(latency="const:1", blocked_chat_ids=["666"])
+    runner, bot = await make_bot(api)
+    try:
+        message = await bot.send_message(chat_id=42, text="hi")
+        assert message.text == "hi"
+
+        link = await bot.create_chat_invite_link(chat_id=-100777, name="Subscription_42", creates_join_request=True)
+        assert link.invite_link.startswith("https://t.me/+fake")
+
+        await bot.approve_chat_join_request(chat_id=-100777, user_id=42)
+        member = await bot.get_chat_member(chat_id=-100777, user_id=42)
+        assert member.status == "member"
+        await bot.ban_chat_member(chat_id=-100777, user_id=42)
+        member = await bot.get_chat_member(chat_id=-100777, user_id=42)
+        assert member.status == "kicked"
+
+        with pytest.raises(TelegramForbiddenError):
+            await bot.send_message(chat_id=666, text="blocked")
+
+        stats = api.stats()
+        assert stats["calls"]["sendMessage"] == 2
+        assert stats["calls"]["getChatMember"] == 2
+        assert stats["errors"] == {"sendMessage:403": 1}
+    finally:
+        await bot.session.close()
+        await runner.cleanup()
+
+@pytest.mark.asyncio
+async def test_fake_bot_api_retry_after_injection():
+    api = FakeBotAPI(retry_after_ratio=1.0, retry_after=7)
+    runner, bot = await make_bot(api)
+    try:
+        with pytest.raises(TelegramRetryAfter) as exc_info:
+            await bot.send_message(chat_id=42, text="hi")
+        assert exc_info.value.retry_after == 7
+    finally:
+        await bot.session.close()
+        await runner.cleanup()
+
+def test_latency_model():
+    assert LatencyModel("const:5").sample() == 0.005
+    assert 0.005 <= LatencyModel("uniform:5,20", seed=1).sample() <= 0.02
+    assert LatencyModel("none").sample() == 0
+    with pytest.raises(ValueError):
+        LatencyModel("gauss:1")
@@ -0,0 +1,100 @@
+import asyncio
+import pytest
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+from aiogram import Bot
+from sqlalchemy import select
+from app.bot_session import create_bot_session
+from app.database import SubscriptionPlan, UserSubscription
+from app.invoice_links import InvoiceLinkCache, invoice_payload, parse_invoice_payload
+from benchmarks.fake_bot_api import FakeBotAPI, start_server
+
+TOKEN = '123456789:AABBCCDDEEFFaabbccddeeff1234567890'
+
+
+def test_invoice_payload_roundtrip():
+    assert parse_invoice_payload(invoice_payload(3)) == ('plan', 3, None)
+    assert parse_invoice_payload(invoice_payload(3, is_extension=True)) == ('extend', 3, None)
+    assert parse_invoice_payload(invoice_payload(3, is_extension=True, subscription_id=17)) == ('extend', 3, 17)
+    for payload in ('wrong_payload', 'plan_x', 'plan_1_2', 'extend_', '', None):
+        assert parse_invoice_payload(payload) is None
+
+
+@pytest.mark.asyncio
+async def test_invoice_links_created_once_per_plan_and_kind():
+    api = FakeBotAPI(latency="const:20")
+    runner, base_url = await start_server(api)
+    bot = Bot(token=TOKEN, session=create_bot_session(base_url=base_url))
+    cache = InvoiceLinkCache()
+    plans = [SimpleNamespace(id=1, name='Премиум', price=19000, duration_days=30),
+             SimpleNamespace(id=2, name='Премиум', price=49000, duration_days=90)]
+    try:
+        # Одновременные выборы одного тарифа — один createInvoiceLink
+        links = await asyncio.gather(*(cache.get_or_create(bot, plans[0], False, 'provider') for _ in range(5)))
+        assert len(set(links)) == 1 and api.calls['createInvoiceLink'] == 1
+
+        assert await cache.warm(bot, plans, 'provider') == 4
+        assert api.calls['createInvoiceLink'] == 4
+        assert cache.warm_in_background(bot, plans, 'provider') is None
+        payloads = sorted(params['payload'] for method, params in api.requests if method == 'createInvoiceLink')
+        assert payloads == ['extend_1', 'extend_2', 'plan_1', 'plan_2']
+
+        # Цена тарифа изменилась — ссылка создается заново
+        plans[0].price = 21000
+        assert await cache.get_or_create(bot, plans[0], False, 'provider') != links[0]
+        assert cache.stats() == {'links': 4, 'created': 5, 'hits': 1, 'errors': 0}
+    finally:
+        await bot.session.close()
+        await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_extension_paid_by_link_without_fsm_state(session):
+    from app.main import process_successful_payment, subscription_service
+    plan = SubscriptionPlan(name="Test Plan", price=100, duration_days=30, channel_id="-100123456789")
+    session.add(plan)
+    await session.commit()
+    own_id = await subscription_service.create_subscription(555000111, plan_id=plan.id, payment_amount=100)
+    other_id = await subscription_service.create_subscription(555000222, plan_id=plan.id, payment_amount=100)
+    before = {sub.id: sub.end_date for sub in (await session.execute(select(UserSubscription))).scalars()}
+
+    async def pay(payload):
+        message = AsyncMock()
+        message.from_user.id = 555000111
+        message.successful_payment = MagicMock(invoice_payload=payload, provider_payment_charge_id=f"charge_{payload}",
+                                               total_amount=100, currency="RUB")
+        state = AsyncMock()
+        state.get_data.return_value = {}
+        await process_successful_payment(message, state)
+
+    # Общая ссылка (без подписки в payload) и payload с чужой подпиской продлевают подписку плательщика
+    await pay(f"extend_{plan.id}")
+    await pay(f"extend_{plan.id}_{other_id}")
+
+    session.expire_all()
+    after = {sub.id: sub.end_date for sub in (await session.execute(select(UserSubscription))).scalars()}
+    assert (after[own_id] - before[own_id]).days == 60
+    assert after[other_id] == before[other_id]
+
+
+@pytest.mark.asyncio
+async def test_extension_paid_without_subscription_creates_new_one(session):
+    from app.database import PaymentError
+    from app.main import process_successful_payment
+    plan = SubscriptionPlan(name="Test Plan", price=100, duration_days=30, channel_id="-100123456789")
+    session.add(plan)
+    await session.commit()
+
+    # Общая ссылка на продление у пользователя без подписки: деньги списаны — оформляется новая подписка
+    message = AsyncMock()
+    message.from_user.id = 555000333
+    message.successful_payment = MagicMock(invoice_payload=f"extend_{plan.id}", provider_payment_charge_id="charge_new",
+                                           total_amount=100, currency="RUB")
+    state = AsyncMock()
+    state.get_data.return_value = {}
+    await process_successful_payment(message, state)
+
+    subscriptions = (await session.execute(select(UserSubscription))).scalars().all()
+    assert len(subscriptions) == 1 and subscriptions[0].is_active and subscriptions[0].plan_id == plan.id
+    assert subscriptions[0].provider_payment_charge_id == "charge_new"
+    assert (await session.execute(select(PaymentError))).scalars().all() == []
@@ -0,0 +1,46 @@
+import asyncio
+import logging
+import time
+import pytest
+from app.loop_watchdog import LoopWatchdog, enable_loop_debug
+
+
+async def blocking_sweep():
+    # Синхронный вызов внутри корутины: цикл событий стоит
+    time.sleep(0.3)
+
+
+@pytest.mark.asyncio
+async def test_watchdog_reports_stall_with_stack(caplog):
+    watchdog = LoopWatchdog(interval=0.02, threshold_ms=100)
+    with caplog.at_level(logging.WARNING, logger='app.loop_watchdog'):
+        watchdog.start()
+        try:
+            await asyncio.sleep(0.1)
+            await asyncio.create_task(blocking_sweep(), name='sweep')
+            await asyncio.sleep(0.1)
+        finally:
+            watchdog.stop()
+
+    stats = watchdog.stats()
+    assert stats['stalls'] == 1
+    assert stats['lag_max_ms'] >= 200
+    assert stats['lag_p50_ms'] < 100
+    assert stats['last_stall_task'] == 'sweep'
+    stall = next(record for record in caplog.records if record.name == 'app.loop_watchdog')
+    assert 'blocking_sweep' in stall.getMessage() and 'time.sleep(0.3)' in stall.getMessage()
+
+
+@pytest.mark.asyncio
+async def test_loop_debug_flags_slow_callbacks(caplog):
+    loop = asyncio.get_running_loop()
+    debug, slow = loop.get_debug(), loop.slow_callback_duration
+    try:
+        with caplog.at_level(logging.WARNING, logger='asyncio'):
+            enable_loop_debug(loop, slow_callback_ms=50)
+            await asyncio.create_task(blocking_sweep())
+    finally:
+        loop.set_debug(debug)
+        loop.slow_callback_duration = slow
+    assert any('blocking_sweep' in record.getMessage() and 'took' in record.getMessage()
+               for record in caplog.records if record.name == 'asyncio')
@@ -0,0 +1,82 @@
+import pytest
+from sqlalchemy import text, select, inspect
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from app import migrations
+from app.database import User, PaymentError
+from app.migrations import add_telegram_id_columns, backfill_telegram_ids, telegram_id_filter
+
+@pytest.mark.asyncio
+async def test_telegram_id_online_migration(monkeypatch):
+    monkeypatch.setattr(migrations, 'telegram_id_backfilled', False)
+    engine = create_async_engine('sqlite+aiosqlite:///:memory:')
+    session_maker = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+    # Схема до миграции: Telegram ID только строкой
+    async with engine.begin() as conn:
+        await conn.execute(text(
+            "CREATE TABLE users (id INTEGER PRIMARY KEY, first_name VARCHAR, telegram_user_id VARCHAR NOT NULL UNIQUE, "
+            "is_active BOOLEAN, email VARCHAR, created_at DATETIME NOT NULL, first_start_reminder_sent BOOLEAN)"
+        ))
+        await conn.execute(text(
+            "CREATE TABLE payment_errors (id INTEGER PRIMARY KEY, telegram_user_id VARCHAR NOT NULL, plan_id INTEGER, "
+            "provider_payment_charge_id VARCHAR NOT NULL, payment_amount INTEGER, payment_currency VARCHAR, "
+            "payment_time DATETIME NOT NULL, error_message TEXT NOT NULL, invoice_payload VARCHAR, payment_info TEXT, "
+            "stack_trace TEXT, is_resolved BOOLEAN, resolution_notes TEXT, resolution_time DATETIME)"
+        ))
+        for i in range(5):
+            await conn.execute(text(
+                f"INSERT INTO users (telegram_user_id, created_at) VALUES ('{7000000000 + i}', '2025-01-01 00:00:00')"
+            ))
+        await conn.execute(text(
+            "INSERT INTO payment_errors (telegram_user_id, provider_payment_charge_id, payment_time, error_message) "
+            "VALUES ('7000000001', 'c1', '2025-01-01 00:00:00', 'boom')"
+        ))
+
+    try:
+        assert await add_telegram_id_columns(engine) == ['users', 'payment_errors']
+        assert await add_telegram_id_columns(engine) == []  # повторный запуск ничего не делает
+        async with engine.connect() as conn:
+            indexes = await conn.run_sync(lambda c: inspect(c).get_indexes('users'))
+        assert any(index['name'] == 'ix_users_telegram_id' and index['unique'] for index in indexes)
+
+        async with session_maker() as session:
+            # Двойное чтение: старая строка находится до backfill, новая пишет обе колонки
+            user = (await session.execute(select(User).where(telegram_id_filter(User, 7000000003)))).scalar_one()
+            assert user.telegram_id is None and user.tg_id == 7000000003
+            session.add(User(telegram_id=8000000000))
+            await session.commit()
+            new_user = (await session.execute(select(User).where(telegram_id_filter(User, 8000000000)))).scalar_one()
+            assert new_user.telegram_user_id == '8000000000'
+
+        # Пачки по 2 строки: 5 пользователей и 1 ошибка платежа
+        assert await backfill_telegram_ids(session_maker, batch_size=2) == 6
+        assert migrations.telegram_id_backfilled is True
+        assert await backfill_telegram_ids(session_maker, batch_size=2) == 0
+
+        async with session_maker() as session:
+            ids = (await session.execute(select(User.telegram_id).order_by(User.id))).scalars().all()
+            assert ids == [7000000000 + i for i in range(5)] + [8000000000]
+            error = (await session.execute(select(PaymentError))).scalar_one()
+            assert error.telegram_id == 7000000001
+            # После backfill чтение только по BIGINT колонке
+            assert str(telegram_id_filter(User, 1)) == 'users.telegram_id = :telegram_id_1'
+    finally:
+        await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_data_migration_runs_once(session):
+    from app.subscription_service import subscription_service
+    from app.database import DataMigration
+    from app.migrations import run_data_migration
+    calls = []
+
+    async def migrate(session_maker):
+        calls.append(session_maker)
+        return 3
+
+    session_maker = subscription_service.async_session_maker
+    assert await run_data_migration(session_maker, 'test_backfill', migrate) == 3
+    # Отметка сохранена: следующий запуск полный проход не повторяет
+    assert await run_data_migration(session_maker, 'test_backfill', migrate) is None
+    assert calls == [session_maker]
+    assert await session.get(DataMigration, 'test_backfill') is not None
@@ -4,7 +4,7 @@ from aiogram import types
 from app.main import process_pre_checkout_query
 
 @pytest.mark.asyncio
-async def test_pre_checkout_valid():
+async def test_pre_checkout_valid(db_session_maker):
     query = MagicMock()
     query.id = "query_123"
     query.invoice_payload = "plan_1"
@@ -16,7 +16,7 @@ async def test_pre_checkout_valid():
     app.main.bot.answer_pre_checkout_query.assert_called_once_with("query_123", ok=True)
 
 @pytest.mark.asyncio
-async def test_pre_checkout_invalid():
+async def test_pre_checkout_invalid(db_session_maker):
     query = MagicMock()
     query.id = "query_456"
     query.invoice_payload = "wrong_payload"
@@ -0,0 +1,67 @@
+import asyncio
+import pytest
+from unittest.mock import AsyncMock
+from app import profiling
+
+async def busy_work(duration):
+    loop = asyncio.get_running_loop()
+    end = loop.time() + duration
+    while loop.time() < end:
+        sum(i * i for i in range(20000))
+        await asyncio.sleep(0)
+
+@pytest.mark.asyncio
+async def test_profile_cpu_samples_busy_coroutine():
+    work = asyncio.create_task(busy_work(0.3))
+    sampler = await profiling.profile_cpu(0.3, interval=0.002)
+    await work
+
+    assert sampler.samples > 0
+    assert "busy_work" in sampler.collapsed()
+    assert "busy_work" in sampler.report()
+
+@pytest.mark.asyncio
+async def test_profile_memory_reports_growth():
+    leak = []
+
+    async def allocate():
+        for _ in range(20):
+            leak.append(bytearray(100_000))
+            await asyncio.sleep(0.01)
+
+    work = asyncio.create_task(allocate())
+    report = await profiling.profile_memory(0.3, steps=2)
+    await work
+
+    assert "Рост по строкам кода" in report
+    assert "test_profiling.py" in report
+
+def test_parse_seconds():
+    assert profiling.parse_seconds("/profile_cpu") == 30
+    assert profiling.parse_seconds("/profile_cpu 5") == 5
+    assert profiling.parse_seconds("/profile_cpu 100000") == profiling.PROFILE_MAX_SECONDS
+
+@pytest.mark.asyncio
+async def test_profile_cpu_command_sends_report(db_session_maker, monkeypatch):
+    import app.main
+    monkeypatch.setattr(profiling, 'PROFILING_ENABLED', True)
+    message = AsyncMock()
+    message.from_user.id = 123456789
+    message.chat.id = 123456789
+    message.text = "/profile_cpu 1"
+
+    await app.main.profile_cpu_command(message, AsyncMock())
+    message.answer.assert_called_once()
+    # Пока профиль снимается, второй запуск отклоняется
+    assert profiling.is_running()
+    busy = AsyncMock()
+    busy.text = "/profile_mem 1"
+    await app.main.profile_mem_command(busy, AsyncMock())
+    assert "уже выполняется" in busy.answer.call_args[0][0]
+    await asyncio.gather(*app.main._profiling_tasks)
+    assert not profiling.is_running()
+
+    documents = app.main.bot.send_document.call_args_list
+    assert len(documents) == 2
+    assert documents[0].kwargs["chat_id"] == 123456789
+    assert documents[0].kwargs["document"].filename.startswith("cpu_profile_")
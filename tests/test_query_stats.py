@@ -0,0 +1,61 @@
+import logging
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+from sqlalchemy import select
+from app.database import User
+from app.query_stats import install_query_stats, track_queries, statement_shape, QueryStatsMiddleware
+from app.main import start_command
+
+install_query_stats()
+
+@pytest.mark.asyncio
+async def test_start_command_query_budget(session):
+    session.add(User(telegram_user_id="11111", first_name="Test", is_active=True))
+    await session.commit()
+
+    message = AsyncMock()
+    message.from_user.id = 11111
+    message.from_user.first_name = "Test"
+
+    with track_queries("/start") as stats:
+        await start_command(message, AsyncMock())
+
+    stats.assert_budget(statements=5, sessions=5)
+    assert stats.suspected_n_plus_one() == []
+
+    with pytest.raises(AssertionError, match="Превышен бюджет"):
+        stats.assert_budget(statements=1)
+
+@pytest.mark.asyncio
+async def test_n_plus_one_detected(session, caplog):
+    users = [User(telegram_user_id=str(i), is_active=True) for i in range(3)]
+    session.add_all(users)
+    await session.commit()
+
+    async def handler(event, data):
+        for user in users:
+            await session.execute(select(User).where(User.id == user.id))
+
+    event = MagicMock(event_type="message")
+    with caplog.at_level(logging.WARNING, logger="app.query_stats"):
+        await QueryStatsMiddleware()(handler, event, {})
+
+    assert "Возможный N+1 в update:message" in caplog.text
+
+def test_statement_shape():
+    assert statement_shape("SELECT *\n  FROM users WHERE id IN (?, ?, ?)") == "SELECT * FROM users WHERE id IN (?)"
+    assert statement_shape("SELECT * FROM users WHERE id IN ($1, $2)") == "SELECT * FROM users WHERE id IN (?)"
+
+@pytest.mark.asyncio
+async def test_failed_statement_does_not_leak_start_time(session):
+    from sqlalchemy import text
+    from sqlalchemy.exc import OperationalError
+    with track_queries("error") as stats:
+        with pytest.raises(OperationalError):
+            await session.execute(text("SELECT * FROM no_such_table"))
+        await session.rollback()
+        await session.execute(select(User))
+        connection = await session.connection()
+        # Отметка упавшего запроса снята, стек пуст
+        assert connection.sync_connection.info.get("query_stats_start") == []
+    assert stats.statements == 1
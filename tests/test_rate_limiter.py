@@ -0,0 +1,79 @@
+import asyncio
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage, GetMe
+from app import rate_limiter as rate_limiter_module
+from app.rate_limiter import RateLimitMiddleware, TokenBucket, background_priority, retry_delay
+
+
+@pytest.mark.asyncio
+async def test_retry_after_pauses_chat_and_retries():
+    limiter = RateLimitMiddleware(global_rate=1000, chat_rate=1000, max_retries=2)
+    method = SendMessage(chat_id=42, text="hi")
+    calls = []
+
+    async def make_request(bot, m):
+        calls.append(asyncio.get_running_loop().time())
+        if len(calls) == 1:
+            raise TelegramRetryAfter(method=m, message="Too Many Requests", retry_after=0.05)
+        return "ok"
+
+    assert await limiter(make_request, None, method) == "ok"
+    # Повтор выполнен после паузы, которую просил Telegram, пауза — только у этого чата
+    assert calls[1] - calls[0] >= 0.04
+    assert limiter.stats()["retry_after"] == 1
+    assert limiter._chat_buckets[42].paused_until > 0
+    assert limiter.global_bucket.paused_until == 0
+
+    # Исчерпав повторы, ошибка уходит вызывающему коду
+    async def always_429(bot, m):
+        raise TelegramRetryAfter(method=m, message="Too Many Requests", retry_after=0.01)
+
+    with pytest.raises(TelegramRetryAfter):
+        await limiter(always_429, None, GetMe())
+    assert limiter.global_bucket.paused_until > 0
+
+
+@pytest.mark.asyncio
+async def test_background_keeps_reserve_for_users():
+    limiter = RateLimitMiddleware(global_rate=10, chat_rate=1000)
+    done = []
+
+    async def make_request(bot, m):
+        done.append(m.chat_id)
+        return True
+
+    async def background():
+        with background_priority():
+            await asyncio.gather(*(limiter(make_request, None, SendMessage(chat_id=1000 + i, text="x")) for i in range(10)))
+
+    task = asyncio.create_task(background())
+    await asyncio.sleep(0.01)
+    # Фон успел выбрать бакет только до резерва (30 %), пользователь проходит без ожидания
+    assert len(done) == 7
+    await asyncio.wait_for(limiter(make_request, None, SendMessage(chat_id=1, text="answer")), timeout=0.05)
+    assert done[-1] == 1
+    await task
+
+
+def test_token_bucket_and_retry_delay():
+    bucket = TokenBucket(rate=1, capacity=2)
+    assert bucket.try_acquire() == 0 and bucket.try_acquire() == 0
+    assert bucket.try_acquire() > 0
+    bucket.pause(5)
+    assert bucket.try_acquire() > 4
+
+    assert retry_delay(TelegramRetryAfter(method=GetMe(), message="", retry_after=7), 1.5) == 7
+    assert retry_delay(Exception("fail"), 1.5) == 1.5
+
+
+def test_token_bucket_starts_empty_after_pause(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(rate_limiter_module.time, 'monotonic', lambda: now[0])
+    bucket = TokenBucket(rate=10, capacity=10)
+    bucket.pause(2)
+    assert bucket.try_acquire() == pytest.approx(2)
+    # Через 0.15 сек после конца паузы накопилось полтора токена, а не весь бакет
+    now[0] = 102.15
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() > 0
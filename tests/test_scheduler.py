@@ -21,11 +21,11 @@ async def test_scheduler_setup():
 
     expected_jobs = [
         'send_registration_reminders',
-        'send_subscription_reminders',
-        'send_last_day_reminders',
-        'send_expired_reminders',
+        'send_due_notifications',
         'check_expired_subscriptions',
-        'force_cleanup_expired'
+        'force_cleanup_expired',
+        'archive_expired_subscriptions',
+        'slow_query_report'
     ]
 
     for job_id in expected_jobs:
@@ -36,5 +36,10 @@ async def test_scheduler_setup():
 
     # apscheduler intervals are timedeltas
     assert job_map['send_registration_reminders'].trigger.interval.total_seconds() == 600.0
-    assert job_map['send_subscription_reminders'].trigger.interval.total_seconds() == 3600.0
+    assert job_map['send_due_notifications'].trigger.interval.total_seconds() == 300.0
     assert job_map['check_expired_subscriptions'].trigger.interval.total_seconds() == 300.0
+    assert job_map['archive_expired_subscriptions'].trigger.interval.total_seconds() == 86400.0
+
+    # Почасовые сканирования по флагам заменены диспетчером расписания
+    for job_id in ('send_subscription_reminders', 'send_last_day_reminders', 'send_expired_reminders'):
+        assert job_id not in job_ids
@@ -0,0 +1,59 @@
+import logging
+import pytest
+from types import SimpleNamespace
+from sqlalchemy import event
+from app import slow_queries
+from app.slow_queries import SlowQueryLog, redact_parameters
+
+
+def test_redact_parameters():
+    assert redact_parameters((123456789, 'user@example.com', None, True)) == ['<int>', '<str>', None, True]
+    assert redact_parameters({'telegram_id': 42}) == {'telegram_id': '<int>'}
+    assert redact_parameters([(1, 'a'), (2, 'b')], executemany=True) == {'rows': 2, 'first': ['<int>', '<str>']}
+
+
+def test_explain_only_reads_on_postgres():
+    pg = SimpleNamespace(dialect=SimpleNamespace(name='postgresql'))
+    sqlite = SimpleNamespace(dialect=SimpleNamespace(name='sqlite'))
+    assert SlowQueryLog._explainable(pg, "  SELECT 1", False)
+    assert SlowQueryLog._explainable(pg, "SELECT users.id FROM users WHERE users.telegram_id = %(id)s", False)
+    # EXPLAIN ANALYZE выполнил бы запрос повторно: CTE с изменением данных, блокировки, последовательности
+    assert not SlowQueryLog._explainable(pg, "WITH gone AS (DELETE FROM users RETURNING id) SELECT * FROM gone", False)
+    assert not SlowQueryLog._explainable(pg, "SELECT * FROM users WHERE id = 1 FOR UPDATE", False)
+    assert not SlowQueryLog._explainable(pg, "SELECT * FROM users FOR NO KEY UPDATE SKIP LOCKED", False)
+    assert not SlowQueryLog._explainable(pg, "SELECT * INTO backup FROM users", False)
+    assert not SlowQueryLog._explainable(pg, "SELECT nextval('users_id_seq')", False)
+    assert not SlowQueryLog._explainable(pg, "UPDATE users SET is_active = false", False)
+    assert not SlowQueryLog._explainable(pg, "SELECT 1", True)
+    assert not SlowQueryLog._explainable(sqlite, "SELECT 1", False)
+
+
+@pytest.mark.asyncio
+async def test_slow_queries_logged_with_caller(db_session_maker, monkeypatch, caplog):
+    from app.subscription_service import subscription_service
+    log = SlowQueryLog(threshold_ms=0)
+    monkeypatch.setattr(slow_queries, 'slow_query_log', log)
+    engine = db_session_maker.kw['bind'].sync_engine
+    hooks = [('before_cursor_execute', slow_queries._before_cursor_execute),
+             ('after_cursor_execute', slow_queries._after_cursor_execute)]
+    for name, hook in hooks:
+        event.listen(engine, name, hook)
+    try:
+        with caplog.at_level(logging.WARNING, logger='app.slow_queries'):
+            await subscription_service.get_user_by_telegram_id(5550001)
+            await subscription_service.get_user_by_telegram_id(5550002)
+    finally:
+        for name, hook in hooks:
+            event.remove(engine, name, hook)
+
+    # Запрос пользователя по Telegram ID: одна форма на оба вызова, значения параметров скрыты
+    select_shape = next(shape for shape in log.shapes if shape.startswith('SELECT users.'))
+    assert log.shapes[select_shape].count == 2
+    assert log.shapes[select_shape].callers == {'SubscriptionService.get_user_by_telegram_id'}
+    messages = [record.getMessage() for record in caplog.records]
+    assert any('SubscriptionService.get_user_by_telegram_id' in message and '<int>' in message for message in messages)
+    assert not any('5550001' in message for message in messages)
+
+    report = log.report()
+    assert 'SubscriptionService.get_user_by_telegram_id' in report and select_shape[:100] in report
+    assert log.shapes == {} and log.report() == ''
@@ -0,0 +1,93 @@
+import os
+import subprocess
+import sys
+import pytest
+from datetime import datetime, timedelta
+from sqlalchemy import event, select, func
+from app.database import SubscriptionPlan, PlanChannel, User, UserSubscription
+from app.startup import StartupTimer
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def test_import_has_no_side_effects():
+    # Очищенное окружение: без DATABASE_URL, токенов и каналов импорт проходит,
+    # .env не читается, движок, session maker и бот не создаются
+    env = {'PATH': os.environ.get('PATH', ''), 'PYTHONPATH': os.pathsep.join([ROOT, os.path.join(ROOT, 'app')])}
+    code = (
+        "import pkgutil, importlib, dotenv\n"
+        "dotenv.load_dotenv = lambda *args, **kwargs: (_ for _ in ()).throw(AssertionError('load_dotenv при импорте'))\n"
+        "import app\n"
+        "for module in pkgutil.iter_modules(app.__path__):\n"
+        "    importlib.import_module(f'app.{module.name}')\n"
+        "import app.main, app.database, app.subscription_service\n"
+        "assert app.main.bot is None\n"
+        "assert app.database._engine is None and app.database._session_maker is None\n"
+        "assert app.subscription_service.subscription_service._async_session_maker is None\n"
+        "assert app.subscription_service.CHANNEL_IDS['premium_subscription'] is None\n"
+    )
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+
+@pytest.mark.asyncio
+async def test_init_subscription_plans_bulk(session):
+    from app.subscription_service import subscription_service, NEW_PLANS
+    test_engine = subscription_service.async_session_maker.kw['bind']
+
+    old_plan = SubscriptionPlan(name="Старый тариф", price=100, duration_days=30, channel_id="-100777")
+    user = User(telegram_id=31337, is_active=True)
+    session.add_all([old_plan, user])
+    await session.commit()
+    sub = UserSubscription(user_id=user.id, plan_id=old_plan.id, is_active=True,
+                           start_date=datetime.utcnow(), end_date=datetime.utcnow() + timedelta(days=3))
+    session.add(sub)
+    await session.commit()
+
+    statements = []
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(test_engine.sync_engine, 'before_cursor_execute', count)
+    try:
+        await subscription_service._init_subscription_plans()
+        first_run = len(statements)
+        statements.clear()
+        await subscription_service._init_subscription_plans()
+        second_run = len(statements)
+    finally:
+        event.remove(test_engine.sync_engine, 'before_cursor_execute', count)
+
+    # Число запросов не зависит от числа тарифов
+    assert first_run <= 6
+    assert second_run <= 4
+    assert await session.scalar(select(func.count(SubscriptionPlan.id))) == len(NEW_PLANS) + 1
+    assert await session.scalar(select(func.count()).select_from(PlanChannel)) == len(NEW_PLANS)
+
+    await session.refresh(sub)
+    month = (await session.execute(select(SubscriptionPlan).where(SubscriptionPlan.name == 'Подписка на 1 месяц'))).scalar_one()
+    assert sub.plan_id == month.id
+
+    # Каталог тарифов отдается из памяти, в порядке NEW_PLANS
+    try:
+        plans = await subscription_service.get_active_plans()
+        assert [plan.name for plan in plans] == [plan['name'] for plan in NEW_PLANS]
+        statements.clear()
+        event.listen(test_engine.sync_engine, 'before_cursor_execute', count)
+        try:
+            await subscription_service.get_active_plans()
+        finally:
+            event.remove(test_engine.sync_engine, 'before_cursor_execute', count)
+        assert statements == []
+    finally:
+        subscription_service.invalidate_plan_catalog()
+
+
+def test_startup_timer_report():
+    timer = StartupTimer()
+    with timer.stage('схема БД'):
+        pass
+    with timer.stage('тарифы'):
+        pass
+    report = timer.report().splitlines()
+    assert [line.split()[0] for line in report] == ['схема', 'тарифы', 'итого']
+    assert all(line.endswith('мс') for line in report)
@@ -0,0 +1,63 @@
+import io
+import json
+import logging
+import queue
+from app.structured_logging import (setup_logging, stop_logging, log_extra, audit_extra,
+                                    SamplingFilter, AsyncQueueHandler, parse_sampling)
+
+
+def test_sampling_filter():
+    sampling = SamplingFilter({'reminder_sent': 0.0, 'join_request': 0.5}, rand=lambda: 0.4)
+
+    def record(level=logging.INFO, **extra):
+        rec = logging.LogRecord('test', level, __file__, 1, 'msg', None, None)
+        rec.__dict__.update(extra)
+        return rec
+
+    assert not sampling.filter(record(**log_extra('reminder_sent')))
+    assert sampling.filter(record(**log_extra('join_request')))  # 0.4 < 0.5
+    assert sampling.filter(record(logging.WARNING, **log_extra('reminder_sent')))
+    assert sampling.filter(record(**audit_extra('reminder_sent')))
+    assert sampling.filter(record())
+    assert sampling.dropped == {'reminder_sent': 1}
+    assert parse_sampling("reminder_sent=0.01, join_request=1") == {'reminder_sent': 0.01, 'join_request': 1.0}
+
+
+def test_queue_pipeline_writes_json():
+    root = logging.getLogger()
+    saved_handlers, saved_level = list(root.handlers), root.level
+    stream = io.StringIO()
+    try:
+        setup_logging(level='INFO', fmt='json', sampling={'reminder_sent': 0.0}, stream=stream)
+        log = logging.getLogger('payments')
+        for i in range(100):
+            logging.info("Отправлено уведомление %s пользователю %s", 'expired_1h', i,
+                         extra=log_extra('reminder_sent', user_id=i))
+        log.info("[PAYMENT] Подписка создана для %s", 42, extra=audit_extra('payment', user_id=42, plan_id=7))
+        log.debug("не попадет по уровню: %s", object())
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            log.exception("[PAYMENT][ERROR] ошибка")
+    finally:
+        stop_logging()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        for handler in saved_handlers:
+            root.addHandler(handler)
+        root.setLevel(saved_level)
+
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [line['msg'] for line in lines] == ["[PAYMENT] Подписка создана для 42", "[PAYMENT][ERROR] ошибка"]
+    assert lines[0]['audit'] is True and lines[0]['category'] == 'payment'
+    assert lines[0]['user_id'] == 42 and lines[0]['plan_id'] == 7 and lines[0]['logger'] == 'payments'
+    assert 'ValueError: boom' in lines[1]['exc']
+
+
+def test_full_queue_drops_only_regular_records():
+    log_queue = queue.Queue(maxsize=1)
+    handler = AsyncQueueHandler(log_queue)
+    for i in range(3):
+        handler.handle(logging.LogRecord('test', logging.INFO, __file__, 1, 'msg %s', (i,), None))
+    assert handler.dropped == 2
+    assert log_queue.get_nowait().msg == 'msg 0'
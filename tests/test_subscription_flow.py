@@ -2,7 +2,8 @@ import pytest
 import asyncio
 from datetime import datetime, timedelta
 from app.subscription_service import subscription_service
-from app.database import User, SubscriptionPlan, UserSubscription
+from app.database import User, SubscriptionPlan, UserSubscription, ScheduledNotification
+from app.notifications import schedule_subscription_notifications
 from sqlalchemy import select
 from unittest.mock import MagicMock, AsyncMock
 
@@ -22,28 +23,40 @@ async def test_full_subscription_lifecycle(session):
     assert sub.is_active
     assert sub.reminder_sent is False
 
+    # Расписание уведомлений создано вместе с подпиской
+    result = await session.execute(
+        select(ScheduledNotification.kind).where(ScheduledNotification.subscription_id == sub_id)
+    )
+    assert sorted(result.scalars().all()) == ['expired', 'expiring_24h', 'last_day']
+
     # 2. Simulate 24h Reminder
-    # Move end_date to be in 23 hours (so < 24h)
+    # Move end_date to be in 23 hours (so < 24h) и перепланируем, как это делает продление
     sub.end_date = datetime.utcnow() + timedelta(hours=23)
+    await schedule_subscription_notifications(session, sub.id, sub.user_id, sub.end_date)
     session.add(sub)
     await session.commit()
 
     # Mock bot.send_message
     subscription_service.bot.send_message.reset_mock()
-    await subscription_service.send_subscription_reminders()
+    await subscription_service.send_due_notifications()
 
     # Verify reminder sent
-    subscription_service.bot.send_message.assert_called()
-    call_kwargs = subscription_service.bot.send_message.call_args[1]
-    assert "завтра Ваша подписка истекает" in call_kwargs['text']
+    texts = [call.kwargs['text'] for call in subscription_service.bot.send_message.call_args_list]
+    assert any("завтра Ваша подписка истекает" in text for text in texts)
 
     # Verify flag updated in DB
     await session.refresh(sub)
     assert sub.reminder_sent is True
 
+    # Повторный запуск диспетчера ничего не шлет
+    subscription_service.bot.send_message.reset_mock()
+    await subscription_service.send_due_notifications()
+    assert not any("завтра" in call.kwargs['text'] for call in subscription_service.bot.send_message.call_args_list)
+
     # 3. Simulate Expiration
     # Move end_date to past
     sub.end_date = datetime.utcnow() - timedelta(minutes=1)
+    await schedule_subscription_notifications(session, sub.id, sub.user_id, sub.end_date)
     session.add(sub)
     await session.commit()
 
@@ -58,13 +71,70 @@ async def test_full_subscription_lifecycle(session):
     await session.refresh(sub)
     assert sub.is_active is False
 
-    # 5. Check Expired Reminder
+    # 5. Check Expired Reminder (уведомление запланировано с небольшой задержкой после окончания)
     subscription_service.bot.send_message.reset_mock()
-    await subscription_service.send_expired_reminders()
+    await subscription_service.send_due_notifications(now=datetime.utcnow() + timedelta(minutes=15))
 
-    subscription_service.bot.send_message.assert_called()
+    subscription_service.bot.send_message.assert_called_once()
     call_kwargs = subscription_service.bot.send_message.call_args[1]
     assert "подписка истекла" in call_kwargs['text']
 
     await session.refresh(sub)
     assert sub.expired_reminder_sent is True
+
+
+@pytest.mark.asyncio
+async def test_expired_notification_skipped_after_renewal(session):
+    plan = SubscriptionPlan(name="Monthly", price=1000, duration_days=30, channel_id="-123")
+    session.add(plan)
+    await session.commit()
+
+    old_id = await subscription_service.create_subscription(777, plan_id=plan.id)
+    # Новая подписка отменяет расписание старой
+    await subscription_service.create_subscription(777, plan_id=plan.id)
+    result = await session.execute(
+        select(ScheduledNotification.status).where(ScheduledNotification.subscription_id == old_id)
+    )
+    assert set(result.scalars().all()) == {'cancelled'}
+
+    subscription_service.bot.send_message.reset_mock()
+    await subscription_service.send_due_notifications(now=datetime.utcnow() + timedelta(days=29, hours=1))
+    texts = [call.kwargs['text'] for call in subscription_service.bot.send_message.call_args_list]
+    # Уведомления только по новой подписке: одно «за сутки», без дублей от старой
+    assert sum("завтра Ваша подписка истекает" in text for text in texts) == 1
+    assert not any("подписка истекла" in text for text in texts)
+
+
+@pytest.mark.asyncio
+async def test_registration_reminder_queue(session):
+    plan = SubscriptionPlan(name="Monthly", price=1000, duration_days=30, channel_id="-123")
+    session.add(plan)
+    await session.commit()
+
+    # Регистрация ставит напоминание в очередь, оплата снимает его
+    waiting = await subscription_service.get_user_by_telegram_id(5001)
+    paid = await subscription_service.get_user_by_telegram_id(5002)
+    await subscription_service.create_subscription(5002, plan_id=plan.id)
+
+    subscription_service.bot.send_message.reset_mock()
+    assert await subscription_service.send_registration_reminders() == 0  # еще не наступило
+
+    later = datetime.utcnow() + timedelta(hours=3, minutes=1)
+    # Временная ошибка: запись остается в очереди до исчерпания попыток
+    subscription_service.bot.send_message.side_effect = Exception("network error")
+    await subscription_service.send_due_notifications(now=later, kinds=('registration',))
+    subscription_service.bot.send_message.side_effect = None
+    assert await subscription_service.send_due_notifications(now=later, kinds=('registration',)) == 1
+
+    chat_ids = [call.kwargs['chat_id'] for call in subscription_service.bot.send_message.call_args_list]
+    assert chat_ids == [5001, 5001]
+    result = await session.execute(select(User.first_start_reminder_sent).where(User.id == waiting.id))
+    assert result.scalar_one() is True
+
+    result = await session.execute(
+        select(ScheduledNotification.user_id, ScheduledNotification.status, ScheduledNotification.attempts)
+        .where(ScheduledNotification.kind == 'registration')
+    )
+    assert sorted(result.all()) == sorted([(waiting.id, 'sent', 2), (paid.id, 'cancelled', 0)])
+    # Очередь пуста — следующий запуск ничего не делает
+    assert await subscription_service.send_due_notifications(now=later, kinds=('registration',)) == 0
@@ -1,7 +1,8 @@
 import pytest
-from app.database import async_init_db, get_async_session_maker, User, SubscriptionPlan
+from sqlalchemy import select
+from app.database import async_init_db, get_async_session_maker, User, SubscriptionPlan, UserSubscription, DailyStat
 from app.subscription_manager import SubscriptionManager
-from datetime import datetime
+from datetime import datetime, timedelta
 
 @pytest.mark.asyncio
 async def test_subscribe_and_extend():
@@ -23,4 +24,33 @@ async def test_subscribe_and_extend():
         # Продлить подписку
         old_end = sub.end_date
         sub2 = await manager.extend_subscription(sub.id, 2)
-        assert sub2.end_date > old_end 
\ No newline at end of file
+        assert sub2.end_date > old_end 
+
+@pytest.mark.asyncio
+async def test_expire_due_subscriptions_bulk(session):
+    user = User(telegram_user_id='65432', is_active=True)
+    plan = SubscriptionPlan(name='Тест', price=100, duration_days=30, channel_id='test')
+    session.add_all([user, plan])
+    await session.commit()
+    now = datetime.utcnow()
+    subs = [
+        UserSubscription(user_id=user.id, plan_id=plan.id, is_active=True, end_date=now - timedelta(days=i + 1))
+        for i in range(5)
+    ]
+    subs.append(UserSubscription(user_id=user.id, plan_id=plan.id, is_active=True, end_date=now + timedelta(days=1)))
+    session.add_all(subs)
+    await session.commit()
+
+    # Порции по 2: 2 + 2 + 1, возвращаются легкие строки, а не ORM-объекты
+    expired = await SubscriptionManager(session).expire_due_subscriptions(now=now, chunk_size=2)
+    assert sorted(row.id for row in expired) == sorted(s.id for s in subs[:5])
+    assert {(row.user_id, row.plan_id) for row in expired} == {(user.id, plan.id)}
+
+    active = (await session.execute(
+        select(UserSubscription.id).where(UserSubscription.is_active == True)
+    )).scalars().all()
+    assert active == [subs[5].id]
+    stat = (await session.execute(select(DailyStat))).scalar_one()
+    assert stat.expired_count == 5
+
+    assert await SubscriptionManager(session).expire_due_subscriptions(now=now) == []